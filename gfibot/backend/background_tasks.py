@@ -3,13 +3,12 @@ All functions in this section are called from the backend
 """
 
 import logging
-import random
 from datetime import datetime, timezone, timedelta
 from typing import Optional
 
-import requests
 from fastapi import HTTPException
 
+from gfibot import github_client
 from gfibot.collections import *
 from gfibot.backend.scheduled_tasks import (
     update_gfi_info,
@@ -43,8 +42,7 @@ def has_write_access(
     if not token:
         logging.debug("No token provided")
         return False
-    url = f"https://api.github.com/repos/{owner}/{name}"
-    response = requests.get(url, headers={"Authorization": f"token {token}"})
+    response = github_client.get(f"/repos/{owner}/{name}", token)
     if response.status_code == 200:
         data = response.json()
         try:
@@ -157,7 +155,7 @@ def schedule_repo_update_now(
     Run a temporary repo update job once
     owner: Repo owner
     name: Repo name
-    token: if None, random choice a token from the token pool
+    token: if None, the token with the most quota is picked when the job runs
     send_email: if True, send email to user after update
     """
     from .server import get_scheduler
@@ -168,13 +166,8 @@ def schedule_repo_update_now(
     if scheduler.get_job(job_id):
         scheduler.remove_job(job_id)
 
-    if not token:
-        valid_tokens = get_valid_tokens()
-        if not valid_tokens:
-            raise HTTPException(status_code=500, detail="No valid tokens available")
-        # random choice 1 of the valid tokens
-        random.seed(datetime.now())
-        token = random.choice(valid_tokens)
+    if not token and not get_valid_tokens():
+        raise HTTPException(status_code=500, detail="No valid tokens available")
 
     # run once
     scheduler.add_job(update_gfi_info, id=job_id, args=[token, owner, name, send_email])
@@ -6,8 +6,8 @@ from fastapi import APIRouter, HTTPException, Header
 from fastapi.responses import RedirectResponse
 from numpy import full
 from pydantic import BaseModel, HttpUrl
-import requests
 
+from gfibot import github_client
 from gfibot.collections import *
 from gfibot.backend.models import (
     GFIResponse,
@@ -168,7 +168,7 @@ def redirect_from_github(code: str, redirect_from: str = "github_app_login"):
         )
 
     # auth github app
-    r = requests.post(
+    r = github_client.post(
         GITHUB_OAUTH_URL,
         data={
             "client_id": oauth_record.client_id,
@@ -186,9 +186,7 @@ def redirect_from_github(code: str, redirect_from: str = "github_app_login"):
     access_token = dict(parse_qsl(r.text))["access_token"]
 
     # get user info
-    r = requests.get(
-        GITHUB_USER_API_URL, headers={"Authorization": f"token {access_token}"}
-    )
+    r = github_client.get(GITHUB_USER_API_URL, access_token)
     if r.status_code != 200:
         logger.error(
             f"error getting user info via oauth: code={code} response={r.text}"
@@ -4,26 +4,29 @@ Do NOT call them directly from the backend
 """
 
 import argparse
-import json
 from pydoc import describe
 from typing import Optional, Callable
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from functools import wraps
 import logging
-import random
 import datetime
 
-import requests
 import yagmail
 from graphql import is_type_node
 import mongoengine
 from apscheduler.schedulers.background import BackgroundScheduler
 from github import BadCredentialsException, RateLimitExceededException
 
-from gfibot import CONFIG, TOKENS
-from gfibot.data.update import update_repo
+from gfibot import CONFIG, TOKENS, github_client
+from gfibot.data.update import update_repo, drain_user_queue
 from gfibot.collections import *
-from gfibot.check_tokens import check_tokens
+from gfibot.check_tokens import (
+    TOKEN_CHECK_INTERVAL,
+    get_cached_valid_tokens,
+    mark_token_invalid,
+    refresh_token_status,
+)
+from gfibot.token_broker import TokenBroker
 from gfibot.data.dataset import get_dataset_for_repo, get_dataset_all
 
 # from gfibot.model._predictor import (
@@ -38,6 +41,7 @@ executor = ThreadPoolExecutor(max_workers=10)
 logger = logging.getLogger(__name__)
 
 DEFAULT_JOB_ID = "gfi_daemon"
+TOKEN_REFRESH_JOB_ID = "gfi_token_refresh"
 
 
 def _add_comment_to_github_issue(
@@ -49,14 +53,10 @@ def _add_comment_to_github_issue(
     user_token = GfiUsers.objects(Q(github_login=github_login)).first().github_app_token
     if user_token:
         try:
-            headers = {
-                "Authorization": "token {}".format(user_token),
-                "Content-Type": "application/json",
-            }
-            url = "https://api.github.com/repos/{}/{}/issues/{}/comments".format(
+            url = "/repos/{}/{}/issues/{}/comments".format(
                 repo_owner, repo_name, issue_number
             )
-            r = requests.post(url, headers=headers, data=json.dumps({"body": comment}))
+            r = github_client.post(url, user_token, json={"body": comment})
             r.raise_for_status()
         except Exception as e:
             logger.warning(
@@ -79,11 +79,10 @@ def _add_gfi_label_to_github_issue(
     user_token = GfiUsers.objects(Q(github_login=github_login)).first().github_app_token
     if user_token:
         try:
-            headers = {"Authorization": "token {}".format(user_token)}
-            url = "https://api.github.com/repos/{}/{}/issues/{}/labels".format(
+            url = "/repos/{}/{}/issues/{}/labels".format(
                 repo_owner, repo_name, issue_number
             )
-            r = requests.post(url, headers=headers, json=["{}".format(label_name)])
+            r = github_client.post(url, user_token, json=["{}".format(label_name)])
             r.raise_for_status()
         except Exception as e:
             logger.warning(
@@ -187,16 +186,28 @@ def _tag_and_comment(github_login, owner, name):
                     )
 
 
-def get_valid_tokens() -> List[str]:
-    """
-    Get valid tokens
-    """
+def _get_all_tokens() -> List[str]:
     tokens = [
         user.github_access_token
         for user in GfiUsers.objects()
         if user.github_access_token is not None
     ] + TOKENS
-    return list(set(tokens) - check_tokens(tokens))
+    return list(set(tokens))
+
+
+def get_valid_tokens() -> List[str]:
+    """
+    Get valid tokens from the token registry,
+      only tokens that are not checked recently are probed
+    """
+    return get_cached_valid_tokens(_get_all_tokens())
+
+
+def refresh_tokens():
+    """
+    Probe all tokens and refresh the token registry
+    """
+    refresh_token_status(_get_all_tokens())
 
 
 def update_gfi_tags_and_comments(owner: str, name: str, send_email: bool = False):
@@ -228,10 +239,12 @@ def update_gfi_tags_and_comments(owner: str, name: str, send_email: bool = False
     )
 
 
-def update_gfi_info(token: str, owner: str, name: str, send_email: bool = False):
+def update_gfi_info(
+    token: Optional[str], owner: str, name: str, send_email: bool = False
+):
     """
     Repository manual updater (will block until done)
-    token: GitHub token
+    token: GitHub token, if None, the valid token with the most quota is used
     owner: GitHub repository owner
     name: GitHub repository name
     send_email: if True, send email to user
@@ -251,17 +264,21 @@ def update_gfi_info(token: str, owner: str, name: str, send_email: bool = False)
     try:
         # 1. fetch repo data
         try:
-            update_repo(token, owner, name)
+            valid_tokens = get_valid_tokens()
+            if token is None:
+                token = TokenBroker(valid_tokens).acquire()
+            update_repo(token, owner, name, user_tokens=valid_tokens)
         except (BadCredentialsException, RateLimitExceededException) as e:
             # second try with a new token
             logger.error(e)
-            valid_tokens = get_valid_tokens()
+            if isinstance(e, BadCredentialsException):
+                mark_token_invalid(token)
+            valid_tokens = [t for t in get_valid_tokens() if t != token]
             if not valid_tokens:
                 logger.error("No valid tokens found.")
                 return
-            random.seed(datetime.now())
-            token = random.choice(valid_tokens)
-            update_repo(token, owner, name)
+            token = TokenBroker(valid_tokens).acquire()
+            update_repo(token, owner, name, user_tokens=valid_tokens)
 
         # 2. rebuild repo dataset
         begin_datetime = datetime(2008, 1, 1)
@@ -285,10 +302,17 @@ def update_gfi_info(token: str, owner: str, name: str, send_email: bool = False)
 def start_scheduler() -> BackgroundScheduler:
     scheduler = BackgroundScheduler()
     scheduler.add_job(daemon, "cron", hour=0, minute=0, id=DEFAULT_JOB_ID)
+    scheduler.add_job(
+        refresh_tokens,
+        "interval",
+        seconds=TOKEN_CHECK_INTERVAL.total_seconds(),
+        id=TOKEN_REFRESH_JOB_ID,
+        replace_existing=True,
+    )
     valid_tokens = get_valid_tokens()
     if not valid_tokens:
         raise Exception("No valid tokens found.")
-    for i, query in enumerate(GfiQueries.objects()):
+    for query in GfiQueries.objects():
         if query.update_config:
             update_config = query.update_config
             task_id = update_config.task_id
@@ -296,7 +320,8 @@ def start_scheduler() -> BackgroundScheduler:
             scheduler.add_job(
                 update_gfi_info,
                 "interval",
-                args=[valid_tokens[i % len(valid_tokens)], query.owner, query.name],
+                # the token is picked by the broker each time the job runs
+                args=[None, query.owner, query.name],
                 seconds=interval,
                 next_run_time=datetime.utcnow(),
                 id=task_id,
@@ -323,13 +348,14 @@ def daemon(init=False):
     valid_tokens = get_valid_tokens()
     if not valid_tokens:
         raise Exception("No valid tokens found.")
+    broker = TokenBroker(valid_tokens)
     if init:
         logger.info("Fetching ALL repo data from github")
-        for i, project in enumerate(CONFIG["gfibot"]["projects"]):
+        for project in CONFIG["gfibot"]["projects"]:
             owner, name = project.split("/")
-            update_repo(valid_tokens[i % len(valid_tokens)], owner, name)
+            update_repo(broker.acquire(), owner, name, drain_users=False)
     else:
-        for i, repo in enumerate(list(Repo.objects().only("owner", "name"))):
+        for repo in list(Repo.objects().only("owner", "name")):
             repo_query = GfiQueries.objects(
                 Q(name=repo.name) & Q(owner=repo.owner)
             ).first()
@@ -337,7 +363,9 @@ def daemon(init=False):
                 logger.info(
                     "Fetching repo data from github: %s/%s", repo.owner, repo.name
                 )
-                update_repo(valid_tokens[i % len(valid_tokens)], repo.owner, repo.name)
+                update_repo(broker.acquire(), repo.owner, repo.name, drain_users=False)
+    logger.info("Fetching users in the refresh queue")
+    drain_user_queue(valid_tokens)
 
     logger.info("Building dataset")
     get_dataset_all(datetime(2008, 1, 1))
@@ -385,8 +413,8 @@ def mongoengine_fork_safe_wrapper(*mongoengine_args, **mongoengine_kwargs):
     tz_aware=True,
     uuidRepresentation="standard",
 )
-def update_repo_mp(token: str, owner: str, name: str):
-    update_repo(token, owner, name)
+def update_repo_mp(tokens: List[str], owner: str, name: str):
+    update_repo(TokenBroker(tokens).acquire(), owner, name, drain_users=False)
 
 
 @mongoengine_fork_safe_wrapper(
@@ -444,14 +472,25 @@ def daemon_mp(init=False, n_workers: Optional[int] = None):
     logger.info("Fetching %d repos from github", len(repos_to_update))
 
     if n_workers is not None:
-        with ProcessPoolExecutor(max_workers=n_workers):
-            for i, (owner, name) in enumerate(repos_to_update):
-                executor.submit(
-                    update_repo_mp, valid_tokens[i % len(valid_tokens)], owner, name
-                )
+        # users are drained only after every update has enqueued its users
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = {
+                pool.submit(update_repo_mp, valid_tokens, owner, name): (owner, name)
+                for owner, name in repos_to_update
+            }
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    logger.error(
+                        "Failed to update %s/%s: %s",
+                        *futures[future],
+                        future.exception(),
+                    )
     else:
-        for i, (owner, name) in enumerate(repos_to_update):
-            update_repo(valid_tokens[i % len(valid_tokens)], owner, name)
+        broker = TokenBroker(valid_tokens)
+        for owner, name in repos_to_update:
+            update_repo(broker.acquire(), owner, name, drain_users=False)
+    logger.info("Fetching users in the refresh queue")
+    drain_user_queue(valid_tokens)
 
     # 2. build dataset
     logger.info("Building dataset")
@@ -460,10 +499,10 @@ def daemon_mp(init=False, n_workers: Optional[int] = None):
     # 3. update training summary
     # 4. update prediction
     if n_workers is not None:
-        with ProcessPoolExecutor(max_workers=n_workers):
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
             for threshold in [1, 2, 3, 4, 5]:
                 for i, (owner, name) in enumerate(repos_to_update):
-                    executor.submit(
+                    pool.submit(
                         update_training_summary_and_prediction_mp,
                         owner,
                         name,
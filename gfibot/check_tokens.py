@@ -1,105 +1,196 @@
 import logging
-import requests
 
-from . import TOKENS
+from . import CONFIG, TOKENS
 from pprint import pformat
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
 
-from typing import Set, List
+from typing import Set, List, Tuple
+
+from gfibot import github_client
+from gfibot.collections import TokenStatus
+from gfibot.token_broker import report_quota
+
+# max number of tokens probed concurrently
+CHECK_WORKERS = 16
+
+try:
+    # how often the token registry is refreshed in the background
+    TOKEN_CHECK_INTERVAL = timedelta(minutes=CONFIG["gfibot"]["token_check_interval"])
+except KeyError:
+    TOKEN_CHECK_INTERVAL = timedelta(minutes=30)
 
 
 def _mask_token(token: str) -> str:
     return "*" * (len(token) - 5) + token[-5:]
 
 
+def _probe_token(token: str) -> Tuple[bool, List[Tuple[str, int, int, datetime]]]:
+    """
+    Check a token against the REST and GraphQL APIs.
+    :return: whether the token is valid, and the quotas seen as
+        (api, remaining, limit, reset_at) tuples
+    """
+    quotas = []
+
+    # quotas are reported by the caller, which may run without a database
+    r = github_client.get("/", token, track_quota=False)
+    logging.info("Token: %s", _mask_token(token))
+    logging.info("  Status %s: %s", r.status_code, r.reason)
+
+    if r.status_code == 401:
+        logging.info("  Token %s is invalid", _mask_token(token))
+        return False, quotas
+
+    rate_limit, remaining, reset_at = (
+        int(r.headers["X-RateLimit-Limit"]),
+        int(r.headers["X-RateLimit-Remaining"]),
+        datetime.fromtimestamp(int(r.headers["X-RateLimit-Reset"]), timezone.utc),
+    )
+    quotas.append(("rest", remaining, rate_limit, reset_at))
+
+    logging.info(
+        "  (REST) Rate limit: %d, remaining: %d, reset at: %s",
+        rate_limit,
+        remaining,
+        reset_at.isoformat(),
+    )
+    if rate_limit != 5000:
+        logging.error("  The token is likely not valid!")
+    if remaining == 0:
+        logging.error("  Rate limit exceeded!")
+
+    r = github_client.post(
+        "/graphql",
+        token,
+        track_quota=False,
+        json={
+            "query": """
+            {
+                rateLimit {
+                    limit
+                    remaining
+                    resetAt
+                }
+            }
+            """
+        },
+    )
+    if r.status_code == 401:
+        logging.info("  Token %s is invalid", _mask_token(token))
+        return False, quotas
+
+    res = r.json()["data"]
+
+    rate_limit, remaining, reset_at = (
+        int(res["rateLimit"]["limit"]),
+        int(res["rateLimit"]["remaining"]),
+        datetime.fromisoformat(res["rateLimit"]["resetAt"].replace("Z", "+00:00")),
+    )
+    quotas.append(("graphql", remaining, rate_limit, reset_at))
+
+    logging.info(
+        "  (GraphQL) Rate limit: %d, remaining: %d, reset at: %s",
+        rate_limit,
+        remaining,
+        reset_at.isoformat(),
+    )
+    if rate_limit != 5000:
+        logging.error("  The token is likely not valid!")
+    if remaining == 0:
+        logging.error("  Rate limit exceeded!")
+
+    return True, quotas
+
+
+def _probe_tokens(
+    tokens: List[str],
+) -> List[Tuple[bool, List[Tuple[str, int, int, datetime]]]]:
+    """Probe at most CHECK_WORKERS tokens concurrently, results are in token order"""
+    with ThreadPoolExecutor(max_workers=min(CHECK_WORKERS, len(tokens))) as executor:
+        return list(executor.map(_probe_token, tokens))
+
+
 def check_tokens(tokens: List[str]) -> Set[str]:
     """
     Check if the tokens are valid.
     :return: A set of invalid tokens.
     """
-    failed_tokens = set()
-
     if len(tokens) == 0:
         logging.error("No tokens found")
         exit(1)
 
-    for token in tokens:
-        url = "https://api.github.com/"
-        r = requests.get(url, headers={"Authorization": "token " + token})
-        logging.info("Token: %s", _mask_token(token))
-        logging.info("  Status %s: %s", r.status_code, r.reason)
-
-        if r.status_code == 401:
-            logging.info("  Token %s is invalid", _mask_token(token))
-            failed_tokens.add(token)
-            continue
-
-        rate_limit, remaining, reset_at = (
-            int(r.headers["X-RateLimit-Limit"]),
-            int(r.headers["X-RateLimit-Remaining"]),
-            datetime.fromtimestamp(int(r.headers["X-RateLimit-Reset"])),
-        )
+    failed_tokens = set(
+        token for token, (valid, _) in zip(tokens, _probe_tokens(tokens)) if not valid
+    )
 
+    if len(failed_tokens) > 0:
         logging.info(
-            "  (REST) Rate limit: %d, remaining: %d, reset at: %s",
-            rate_limit,
-            remaining,
-            reset_at.isoformat(),
-        )
-        if rate_limit != 5000:
-            logging.error("  The token is likely not valid!")
-        if remaining == 0:
-            logging.error("  Rate limit exceeded!")
-
-        url = "https://api.github.com/graphql"
-        r = requests.post(
-            url,
-            headers={"Authorization": "token " + token},
-            json={
-                "query": """
-                {
-                    rateLimit {
-                        limit
-                        remaining
-                        resetAt
-                    }
-                }
-                """
-            },
+            "Failed tokens: %s", pformat([_mask_token(x) for x in failed_tokens])
         )
-        if r.status_code == 401:
-            logging.info("  Token %s is invalid", _mask_token(token))
-            failed_tokens.add(token)
-            continue
 
-        res = r.json()["data"]
+    logging.info("Done!")
+
+    return failed_tokens
 
-        rate_limit, remaining, reset_at = (
-            int(res["rateLimit"]["limit"]),
-            int(res["rateLimit"]["remaining"]),
-            datetime.fromisoformat(res["rateLimit"]["resetAt"].replace("Z", "")),
-        )
 
-        logging.info(
-            "  (GraphQL) Rate limit: %d, remaining: %d, reset at: %s",
-            rate_limit,
-            remaining,
-            reset_at.isoformat(),
-        )
-        if rate_limit != 5000:
-            logging.error("  The token is likely not valid!")
-        if remaining == 0:
-            logging.error("  Rate limit exceeded!")
+def refresh_token_status(tokens: List[str]) -> Set[str]:
+    """
+    Probe tokens concurrently and record their status in TokenStatus
+      and their quotas in TokenQuota.
+    :return: A set of invalid tokens.
+    """
+    tokens = sorted(set(tokens))
+    if len(tokens) == 0:
+        return set()
 
-    if len(failed_tokens) > 0:
-        logging.info(
-            "Failed tokens: %s", pformat([_mask_token(x) for x in failed_tokens])
+    failed_tokens = set()
+    for token, (valid, quotas) in zip(tokens, _probe_tokens(tokens)):
+        TokenStatus.objects(token=token).update_one(
+            upsert=True,
+            set__valid=valid,
+            set__checked_at=datetime.now(timezone.utc),
         )
+        for api, remaining, limit, reset_at in quotas:
+            report_quota(token, api, remaining, limit, reset_at)
+        if not valid:
+            failed_tokens.add(token)
 
-    logging.info("Done!")
-
+    logging.info(
+        "Token registry refreshed, %d/%d tokens valid",
+        len(tokens) - len(failed_tokens),
+        len(tokens),
+    )
     return failed_tokens
 
 
+def get_cached_valid_tokens(tokens: List[str]) -> List[str]:
+    """
+    Look up valid tokens in the token registry. Only tokens that have never been
+      checked, or whose background refresh is overdue, are probed before returning.
+    """
+    tokens = list(dict.fromkeys(tokens))
+    fresh_since = datetime.now(timezone.utc) - 2 * TOKEN_CHECK_INTERVAL
+    status = {
+        s["token"]: s["valid"]
+        for s in TokenStatus.objects(token__in=tokens, checked_at__gte=fresh_since)
+        .only("token", "valid")
+        .as_pymongo()
+    }
+    stale = [token for token in tokens if token not in status]
+    if len(stale) > 0:
+        failed_tokens = refresh_token_status(stale)
+        status.update({token: token not in failed_tokens for token in stale})
+    return [token for token in tokens if status[token]]
+
+
+def mark_token_invalid(token: str) -> None:
+    """Record a token rejected by GitHub, until the next probe finds otherwise"""
+    TokenStatus.objects(token=token).update_one(
+        upsert=True, set__valid=False, set__checked_at=datetime.now(timezone.utc)
+    )
+    logging.info("Token %s marked as invalid", _mask_token(token))
+
+
 if __name__ == "__main__":
     check_tokens(TOKENS)
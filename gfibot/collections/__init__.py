@@ -2,3 +2,5 @@ from .data import *
 from .model import *
 from .backend import *
 from .log import *
+from .cache import *
+from .token import *
@@ -0,0 +1,44 @@
+from datetime import datetime
+from mongoengine import *
+
+
+class HttpCache(Document):
+    """
+    Cached GitHub REST API responses, revalidated with conditional requests.
+    Attributes:
+        url: Request path and sorted query parameters, uniquely identifies a response
+        etag: Value of the ETag header, sent back as If-None-Match
+        last_modified: Value of the Last-Modified header, sent back as If-Modified-Since
+        data: JSON encoded response body
+        updated_at: The time when this response is last fetched or revalidated,
+            responses not used for 30 days are removed by MongoDB
+    """
+
+    url: str = StringField(required=True)
+    etag: str = StringField(null=True)
+    last_modified: str = StringField(null=True)
+    data: str = StringField(required=True)
+    updated_at: datetime = DateTimeField(required=True)
+
+    meta = {
+        "indexes": [
+            {"fields": ["url"], "unique": True},
+            {"fields": ["updated_at"], "expireAfterSeconds": 30 * 24 * 3600},
+        ]
+    }
+
+
+class GitEmailLogin(Document):
+    """
+    GitHub logins of commit emails seen in local git mirrors (see gfibot.data.git_mirror)
+    Attributes:
+        email: A commit author or committer email
+        login: The GitHub user linked to the email, None if there is none
+        resolved_at: The time when the email is resolved
+    """
+
+    email: str = StringField(required=True)
+    login: str = StringField(null=True)
+    resolved_at: datetime = DateTimeField(required=True)
+
+    meta = {"indexes": [{"fields": ["email"], "unique": True}]}
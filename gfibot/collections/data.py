@@ -219,6 +219,9 @@ class OpenIssue(Document):
     created_at: datetime = DateTimeField(required=True)
     updated_at: datetime = DateTimeField(required=True)
     events: List[IssueEvent] = ListField(EmbeddedDocumentField(IssueEvent))
+    # GraphQL cursor of the last fetched timeline item, only newer events are
+    #   fetched in the next update; None means the full timeline is refetched
+    timeline_cursor: str = StringField(null=True)
     meta = {"indexes": [{"fields": ["owner", "name", "number"], "unique": True}]}
 
 
@@ -300,10 +303,14 @@ class RepoCommit(Document):
     committed_at: datetime = DateTimeField(required=True)
 
     message: str = StringField(required=True)
+    # Issue numbers referenced in the commit message (e.g., "fixes #1"),
+    #   extracted when the commit is fetched
+    referenced_issues: List[int] = ListField(IntField(), default=None)
 
     meta = {
         "indexes": [
             {"fields": ["owner", "name", "sha"], "unique": True},
+            {"fields": ["owner", "name", "referenced_issues"]},
             {"fields": ["author"]},
             {"fields": ["authored_at"]},
             {"fields": ["committer"]},
@@ -335,6 +342,9 @@ class RepoIssue(Document):
     merged_at: datetime = DateTimeField(
         null=True
     )  # If a PR, the time when this PR is merged
+    updated_at: datetime = DateTimeField(
+        null=True
+    )  # The time when this issue/PR is last updated on GitHub
 
     title: str = StringField(required=True)
     body: str = StringField(null=True)
@@ -349,6 +359,28 @@ class RepoIssue(Document):
     }
 
 
+class RepoPullDetail(Document):
+    """
+    Commits and comments of a pull request, used to locate issue resolvers.
+    Only refetched when the pull request is updated on GitHub.
+    """
+
+    owner: str = StringField(required=True)
+    name: str = StringField(required=True)
+    number: int = IntField(required=True, min_value=0)
+
+    commits: List[str] = ListField(StringField(required=True))  # Commit SHAs
+    comments: List[str] = ListField(StringField(null=True))  # Comment bodies
+    # The updated_at of the pull request when its details are fetched
+    updated_at: datetime = DateTimeField(null=True)
+
+    meta = {
+        "indexes": [
+            {"fields": ["owner", "name", "number"], "unique": True},
+        ],
+    }
+
+
 class RepoStar(Document):
     """Repository star statistics for RecGFI training"""
 
@@ -362,71 +394,55 @@ class RepoStar(Document):
 
 
 class User(Document):
-    """User statistics for RecGFI training"""
-
-    class Issue(EmbeddedDocument):
-        # repo info
-        owner: str = StringField(required=True)
-        name: str = StringField(required=True)
-        repo_stars: int = IntField(required=True, min_value=0)
-        # issue number (state can not be updated incrementally)
-        state: str = StringField(required=True)
-        number: int = IntField(required=True, min_value=0)
-        created_at: datetime = DateTimeField(required=True)
-
-    class Pull(EmbeddedDocument):
-        # repo info
-        owner: str = StringField(required=True)
-        name: str = StringField(required=True)
-        repo_stars: int = IntField(required=True, min_value=0)
-        # pull request number  (state can not be updated incrementally)
-        state: str = StringField(required=True)
-        number: int = IntField(required=True)
-        created_at: datetime = DateTimeField(required=True)
-
-    class Review(EmbeddedDocument):
-        # repo info
-        owner: str = StringField(required=True)
-        name: str = StringField(required=True)
-        repo_stars: int = IntField(required=True, min_value=0)
-        # review number & state
-        number: int = IntField(required=True)
-        state: str = StringField(required=True)
-        created_at: datetime = DateTimeField(required=True)
-
-    class CommitContribution(EmbeddedDocument):
-        # repo info
-        owner: str = StringField(required=True)
-        name: str = StringField(required=True)
-        repo_stars: int = IntField(required=True, min_value=0)
-        # commit count
-        commit_count: int = IntField(required=True, min_value=0)
-        created_at: datetime = DateTimeField(required=True)
+    """
+    User statistics for RecGFI training.
+    Contributions of the user are stored in UserContribution.
+    """
 
     _created_at: datetime = DateTimeField(required=True)  # created in the database
     _updated_at: datetime = DateTimeField(required=True)  # updated in the database
 
     name: str = StringField(null=True)
     login: str = StringField(required=True)
-    # issues, issueComments, pulls (use end cursor to paginate)
-    issues: List[Issue] = EmbeddedDocumentListField(Issue)
-    pulls: List[Pull] = EmbeddedDocumentListField(Pull)
-    # reviews, commits (use date to paginate)
-    pull_reviews: List[Review] = EmbeddedDocumentListField(Review)
-    commit_contributions: List[CommitContribution] = EmbeddedDocumentListField(
-        CommitContribution
-    )
 
     meta = {
         "indexes": [
             {"fields": ["login"], "unique": True},
-            {"fields": ["issues.owner", "issues.name"]},
-            {"fields": ["issues.created_at"]},
-            {"fields": ["pulls.owner", "pulls.name"]},
-            {"fields": ["pulls.created_at"]},
-            {"fields": ["pull_reviews.owner", "pull_reviews.name"]},
-            {"fields": ["pull_reviews.created_at"]},
-            {"fields": ["commit_contributions.owner", "commit_contributions.name"]},
-            {"fields": ["commit_contributions.created_at"]},
+        ],
+        # users not migrated yet still embed their contributions
+        #   (see gfibot.data.migrate_users)
+        "strict": False,
+    }
+
+
+class UserContribution(Document):
+    """
+    An issue, pull request, review or daily commit count of a user on GitHub,
+      so that contributions before a time can be counted with an index
+    """
+
+    login: str = StringField(required=True)
+    kind: str = StringField(
+        required=True, choices=["issue", "pull", "review", "commit"]
+    )
+    # repo info
+    owner: str = StringField(required=True)
+    name: str = StringField(required=True)
+    repo_stars: int = IntField(required=True, min_value=0)
+    # issue, pull request or reviewed pull request number (None for commits)
+    number: int = IntField(null=True)
+    # state of issues and pull requests (can not be updated incrementally) and reviews
+    state: str = StringField(null=True)
+    # number of commits on the day of created_at (None except for commits)
+    commit_count: int = IntField(null=True, min_value=0)
+    created_at: datetime = DateTimeField(required=True)
+
+    meta = {
+        "indexes": [
+            {"fields": ["login", "kind", "created_at"]},
+            {
+                "fields": ["login", "kind", "owner", "name", "number", "created_at"],
+                "unique": True,
+            },
         ]
     }
@@ -1,6 +1,7 @@
 import psutil
 import logging
 
+from typing import List
 from datetime import datetime
 from mongoengine import *
 
@@ -33,11 +34,74 @@ class GitHubFetchLog(Log):
     updated_resolved_issues: int = IntField(null=True)
     updated_users: int = IntField(null=True)
 
+    # documents created / changed by bulk writes
+    inserted_stars: int = IntField(null=True)
+    modified_stars: int = IntField(null=True)
+    inserted_commits: int = IntField(null=True)
+    modified_commits: int = IntField(null=True)
+    inserted_issues: int = IntField(null=True)
+    modified_issues: int = IntField(null=True)
+
     rate: int = IntField(null=True)
     rate_repo_stat: int = IntField(null=True)
     rate_resolved_issue: int = IntField(null=True)
     rate_open_issue: int = IntField(null=True)
     rate_user: int = IntField(null=True)
+    # GraphQL cost of issue timelines, the other rate_* fields count REST requests
+    rate_graphql: int = IntField(null=True)
+
+
+class GitHubFetchCheckpoint(Document):
+    """
+    Progress of an unfinished GitHub fetch, so that an interrupted update
+      resumes where it stopped. Deleted when the update finishes.
+    Attributes:
+        owner, name: The repository being updated
+        since: Fetch data since this time, kept when resuming
+        watermark: The time the update began, becomes Repo.updated_at when finished
+        completed: Phases that have finished
+        stars_page: The next star page to fetch (stars are fetched backwards),
+            None if no star page has been fetched
+        commits_page, issues_page: The next commit / issue page to fetch
+        updated_at: The time of the latest progress
+    """
+
+    owner: str = StringField(required=True)
+    name: str = StringField(required=True)
+    since: datetime = DateTimeField(required=True)
+    watermark: datetime = DateTimeField(required=True)
+    completed: List[str] = ListField(StringField(), default=[])
+    stars_page: int = IntField(null=True)
+    commits_page: int = IntField(default=0)
+    issues_page: int = IntField(default=0)
+    updated_at: datetime = DateTimeField(required=True)
+
+    meta = {"indexes": [{"fields": ["owner", "name"], "unique": True}]}
+
+
+class UserRefreshRequest(Document):
+    """
+    A user waiting in the global user refresh queue. Repository updates enqueue
+      their users here, so a user shared by many repositories is fetched once.
+    Attributes:
+        login: The user to fetch, unique in the queue
+        requested_at: The time the user was first enqueued
+        claim: Identifies the worker that is fetching the user, None if not claimed
+        claimed_at: The time the user was claimed, stale claims can be taken over
+    """
+
+    login: str = StringField(required=True)
+    requested_at: datetime = DateTimeField(required=True)
+    claim: str = StringField(null=True)
+    claimed_at: datetime = DateTimeField(null=True)
+
+    meta = {
+        "indexes": [
+            {"fields": ["login"], "unique": True},
+            {"fields": ["claimed_at", "requested_at"]},
+            {"fields": ["claim"]},
+        ]
+    }
 
 
 class DatasetBuildLog(Log):
@@ -0,0 +1,43 @@
+from datetime import datetime
+from mongoengine import *
+
+
+class TokenQuota(Document):
+    """
+    The last known rate limit quota of a GitHub token, shared by all processes
+    through the token broker.
+    Attributes:
+        token: The GitHub token
+        api: The rate limit category, can be rest or graphql
+        remaining: The number of requests remaining in the current window
+        limit: The number of requests allowed in a window
+        reset_at: The time when the current window resets
+        updated_at: The time when this quota is last reported
+    """
+
+    token: str = StringField(required=True)
+    api: str = StringField(required=True, choices=["rest", "graphql"])
+    remaining: int = IntField(required=True)
+    limit: int = IntField(required=True)
+    reset_at: datetime = DateTimeField(required=True)
+    updated_at: datetime = DateTimeField(required=True)
+
+    meta = {"indexes": [{"fields": ["token", "api"], "unique": True}]}
+
+
+class TokenStatus(Document):
+    """
+    The health of a GitHub token in the token registry, refreshed in the background
+    so that valid tokens can be looked up without probing GitHub.
+    The quota seen by the latest probe is recorded in TokenQuota.
+    Attributes:
+        token: The GitHub token
+        valid: Whether GitHub accepted the token in the latest probe
+        checked_at: The time of the latest probe
+    """
+
+    token: str = StringField(required=True)
+    valid: bool = BooleanField(required=True)
+    checked_at: datetime = DateTimeField(required=True)
+
+    meta = {"indexes": [{"fields": ["token"], "unique": True}]}
@@ -195,26 +195,50 @@ def _get_user_data(
 
     # GitHub global features
     if all_github:
-        query = User.objects(login=user)
-
-        if query.count() == 0:
+        if User.objects(login=user).count() == 0:
             return feat
 
-        user: User = query.first()
-        commits = [c for c in user.commit_contributions if c.created_at <= t]
-        issues = [i for i in user.issues if i.created_at <= t]
-        pulls = [p for p in user.pulls if p.created_at <= t]
-        reviews = [r for r in user.pull_reviews if r.created_at <= t]
-        feat.n_commits_all = sum(c.commit_count for c in commits)
-        feat.n_issues_all = len(issues)
-        feat.n_pulls_all = len(pulls)
-        feat.n_reviews_all = len(reviews)
-        feat.max_stars_commit = max([c.repo_stars for c in commits] + [0])
-        feat.max_stars_issue = max([i.repo_stars for i in issues] + [0])
-        feat.max_stars_pull = max([p.repo_stars for p in pulls] + [0])
-        feat.max_stars_review = max([r.repo_stars for r in reviews] + [0])
+        # one indexed range scan per kind of contribution
+        stats = {
+            s["_id"]: s
+            for s in UserContribution.objects(
+                login=user,
+                kind__in=["issue", "pull", "review", "commit"],
+                created_at__lte=t,
+            ).aggregate(
+                [
+                    {
+                        "$group": {
+                            "_id": "$kind",
+                            "count": {"$sum": 1},
+                            "commit_count": {"$sum": "$commit_count"},
+                            "max_stars": {"$max": "$repo_stars"},
+                            "repos": {
+                                "$addToSet": {"owner": "$owner", "name": "$name"}
+                            },
+                        }
+                    }
+                ]
+            )
+        }
+        empty = {"count": 0, "commit_count": 0, "max_stars": 0, "repos": []}
+        commits, issues, pulls, reviews = (
+            stats.get(kind, empty) for kind in ["commit", "issue", "pull", "review"]
+        )
+        feat.n_commits_all = commits["commit_count"]
+        feat.n_issues_all = issues["count"]
+        feat.n_pulls_all = pulls["count"]
+        feat.n_reviews_all = reviews["count"]
+        feat.max_stars_commit = commits["max_stars"]
+        feat.max_stars_issue = issues["max_stars"]
+        feat.max_stars_pull = pulls["max_stars"]
+        feat.max_stars_review = reviews["max_stars"]
         feat.n_repos = len(
-            set((x.owner, x.name) for x in commits + issues + pulls + reviews)
+            set(
+                (r["owner"], r["name"])
+                for s in [commits, issues, pulls, reviews]
+                for r in s["repos"]
+            )
         )
 
     return feat
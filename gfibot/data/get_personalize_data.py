@@ -6,16 +6,17 @@ import multiprocessing as mp
 import traceback
 from typing import *
 import json
-import requests
 import time
 import gc
 import os
 import argparse
 from collections import defaultdict
-from datetime import datetime, timedelta
-from gfibot import CONFIG, TOKENS
+import mongoengine
+from datetime import datetime, timedelta, timezone
+from gfibot import CONFIG, TOKENS, github_client
 from gfibot.check_tokens import check_tokens
 from gfibot.collections import *
+from gfibot.token_broker import TokenBroker
 
 
 def remove_and_match(lst1, lst2, value):
@@ -25,40 +26,23 @@ def remove_and_match(lst1, lst2, value):
         del lst2[index_to_remove]
 
 
-def run_query(query, variables, token):
-    global v4tokenid, sleep_token
+def run_query(query, variables):
     for _ in range(0, 3):
-        v4tokenid = v4tokenid + 1
-        token = valid_tokens[v4tokenid % len(valid_tokens)]
-        while token in sleep_token:
-            time.sleep(10)
-            v4tokenid = v4tokenid + 1
-            token = valid_tokens[v4tokenid % len(valid_tokens)]
-        headers = {
-            "Authorization": "token " + token,
-            "Accept": "application/vnd.github.hawkgirl-preview+json",
-        }
+        # blocks until some token has quota left, shared by all pool processes
+        token = token_broker.acquire("graphql", min_remaining=100)
+        headers = {"Accept": "application/vnd.github.hawkgirl-preview+json"}
         try:
-            request = requests.post(
-                "https://api.github.com/graphql",
+            # the quota in response headers is reported to the token broker
+            request = github_client.post(
+                "/graphql",
+                token,
                 json={"query": query, "variables": variables},
                 headers=headers,
             )
             content = request.json()
             remaining = content["data"]["rateLimit"]["remaining"]
-            resetAt = content["data"]["rateLimit"]["resetAt"]
-            resetAt = datetime.strptime(resetAt, "%Y-%m-%dT%H:%M:%SZ") + timedelta(
-                hours=8
-            )
-            resetAt = resetAt.timestamp()
-            sleep_time = resetAt - time.time() + 10
             if remaining < 100:
-                logging.info(
-                    "Rate limit reached, wait for {} seconds...".format(sleep_time)
-                )
-                sleep_token.append(token)
-                time.sleep(max(1.0, sleep_time))
-                sleep_token.remove(token)
+                logging.info("Rate limit reached for token %s", token[0:6])
             else:
                 return content
         except Exception as ex:
@@ -827,10 +811,19 @@ def get_issues(x):
     return res
 
 
+def _connect_mongodb() -> None:
+    # token quotas are shared through MongoDB, reconnect in a new process
+    mongoengine.connect(
+        CONFIG["mongodb"]["db"],
+        host=CONFIG["mongodb"]["url"],
+        tz_aware=True,
+        uuidRepresentation="standard",
+    )
+
+
 def main():
-    global prodesdict, valid_tokens, sleep_token
+    global prodesdict, token_broker
     logger = logging.getLogger(__name__)
-    sleep_token = []
     prodesdict = {}
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", action="store_true")
@@ -869,14 +862,14 @@ def main():
 
     failed_tokens = check_tokens(TOKENS)
     valid_tokens = list(set(TOKENS) - failed_tokens)
+    token_broker = TokenBroker(valid_tokens)
 
     logger.info("Personalized data collection started at {}".format(datetime.now()))
 
-    params = defaultdict(list)
-    for i, issue in enumerate(issuelist):
-        params[valid_tokens[i % len(valid_tokens)]].append(issue)
-    with mp.Pool(min(args.nprocess, len(valid_tokens))) as pool:
-        res = pool.starmap(get_issues, issuelist)
+    with mp.Pool(
+        min(args.nprocess, len(valid_tokens)), initializer=_connect_mongodb
+    ) as pool:
+        res = pool.map(get_issues, issuelist, chunksize=1)
         res = [i for i in res if i is not None]
     res.extend(existdata)
     res = np.array(res)
@@ -0,0 +1,397 @@
+import os
+import re
+import gzip
+import logging
+import argparse
+import multiprocessing as mp
+
+from typing import List, Dict, Tuple, Any, Optional, Iterable
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from gfibot import CONFIG, TOKENS
+from gfibot.check_tokens import check_tokens
+from gfibot.token_broker import TokenBroker
+from gfibot.collections import *
+from gfibot.data.rest import _loads, parse_github_date
+from gfibot.data.git_mirror import resolve_logins
+from gfibot.data.update import _bulk_upsert, _connect_mongodb, _match_issue_numbers
+
+
+logger = logging.getLogger(__name__)
+
+# number of hourly archive files decoded before their events are written
+IMPORT_CHUNK_SIZE = 24
+# commits are tracked on the default branch, which push events do not name
+DEFAULT_BRANCHES = ["refs/heads/master", "refs/heads/main"]
+# issue actions that become IssueEvent types (see IssueTimelineFetcher)
+ISSUE_ACTIONS = ["closed", "reopened", "labeled", "unlabeled", "assigned", "unassigned"]
+
+# hourly files are named like 2015-01-01-15.json.gz
+_ARCHIVE_FILE = re.compile(r"^(\d{4})-(\d{2})-(\d{2})-(\d{1,2})\.json(\.gz)?$")
+# the repository of an event is matched before the line is decoded,
+#   since most events in an archive belong to repositories that are not tracked
+_EVENT_REPO = re.compile(rb'"repo":\s*\{"id":\s*\d+,\s*"name":\s*"([^"]+)"')
+
+
+def _archive_hour(path: str) -> Optional[datetime]:
+    """The hour of events in an archive file, None if it is not an archive file"""
+    match = _ARCHIVE_FILE.match(os.path.basename(path))
+    if match is None:
+        return None
+    year, month, day, hour = map(int, match.groups()[:4])
+    return datetime(year, month, day, hour, tzinfo=timezone.utc)
+
+
+def list_archive_files(paths: Iterable[str]) -> List[str]:
+    """Archive files in the given files and directories, in chronological order"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, f) for f in os.listdir(path))
+        else:
+            files.append(path)
+    return sorted((f for f in files if _archive_hour(f) is not None), key=_archive_hour)
+
+
+def _issue_doc(
+    owner: str, name: str, issue: Dict[str, Any], is_pull: bool
+) -> Dict[str, Any]:
+    """Map an issue or pull request in an event payload to a RepoIssue document"""
+    if is_pull:
+        merged_at = issue.get("merged_at")
+    else:
+        merged_at = (issue.get("pull_request") or {}).get("merged_at")
+    return {
+        "owner": owner,
+        "name": name,
+        "number": issue["number"],
+        "user": (issue.get("user") or {}).get("login", "ghost"),
+        "state": issue["state"],
+        "created_at": parse_github_date(issue["created_at"]),
+        "closed_at": parse_github_date(issue.get("closed_at"))
+        if issue["state"] == "closed"
+        else None,
+        "title": issue["title"],
+        "body": issue.get("body"),
+        "labels": [label["name"] for label in issue.get("labels", [])],
+        "is_pull": is_pull or "pull_request" in issue,
+        "merged_at": parse_github_date(merged_at),
+        "updated_at": parse_github_date(issue.get("updated_at")),
+    }
+
+
+def _extract_events(
+    path: str, repos: Dict[str, Tuple[str, str]]
+) -> Dict[str, List[Any]]:
+    """
+    Decode an archive file and extract events of tracked repositories
+    :param repos: lower case "owner/name" -> (owner, name) of tracked repositories
+    :return: "stars", "issues", "commits" (with author emails) and "events"
+        (owner, name, number, IssueEvent dict) in the order they happened
+    """
+    results = {"stars": [], "issues": [], "commits": [], "events": []}
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        for line in f:
+            match = _EVENT_REPO.search(line)
+            if match is None:
+                continue
+            repo = repos.get(match.group(1).decode("utf-8", "ignore").lower())
+            if repo is None:
+                continue
+            try:
+                event = _loads(line)
+            except ValueError:
+                logger.error("Malformed event in %s: %s", path, line[:100])
+                continue
+            _extract_event(event, *repo, results)
+    return results
+
+
+def _extract_event(
+    event: Dict[str, Any], owner: str, name: str, results: Dict[str, List[Any]]
+) -> None:
+    t = parse_github_date(event["created_at"])
+    actor = (event.get("actor") or {}).get("login")
+    payload = event.get("payload") or {}
+
+    if event["type"] == "WatchEvent" and payload.get("action") == "started":
+        results["stars"].append(
+            {"owner": owner, "name": name, "user": actor, "starred_at": t}
+        )
+    elif event["type"] in ["IssuesEvent", "IssueCommentEvent"]:
+        issue = payload["issue"]
+        results["issues"].append(_issue_doc(owner, name, issue, False))
+        action = payload.get("action")
+        if event["type"] == "IssueCommentEvent" and action == "created":
+            comment = payload["comment"]
+            commenter = (comment.get("user") or {}).get("login")
+            e = {
+                "type": "commented",
+                "time": parse_github_date(comment["created_at"]),
+                "actor": commenter,
+                "comment": comment["body"],
+                "commenter": commenter,
+            }
+        elif event["type"] == "IssuesEvent" and action in ISSUE_ACTIONS:
+            e = {"type": action, "time": t, "actor": actor}
+            if action in ["labeled", "unlabeled"] and payload.get("label"):
+                e["label"] = payload["label"]["name"]
+            if action in ["assigned", "unassigned"] and payload.get("assignee"):
+                e["assignee"] = payload["assignee"]["login"]
+        else:
+            return
+        results["events"].append((owner, name, issue["number"], e))
+    elif event["type"] == "PullRequestEvent":
+        results["issues"].append(_issue_doc(owner, name, payload["pull_request"], True))
+    elif event["type"] == "PushEvent" and payload.get("ref") in DEFAULT_BRANCHES:
+        for commit in payload.get("commits", []):
+            if not commit.get("distinct", True):
+                continue
+            results["commits"].append(
+                {
+                    "owner": owner,
+                    "name": name,
+                    "sha": commit["sha"],
+                    "author_email": commit["author"]["email"],
+                    # commit times are not archived, the push is the closest
+                    "authored_at": t,
+                    "committer": actor,
+                    "committed_at": t,
+                    "message": commit["message"],
+                }
+            )
+
+
+def _write_issues(issues: List[Dict[str, Any]]) -> int:
+    """Upsert issues, unless the database already has a newer version of them"""
+    latest = {}
+    for issue in issues:
+        latest[(issue["owner"], issue["name"], issue["number"])] = issue
+    by_repo = defaultdict(list)
+    for (owner, name, number), issue in latest.items():
+        by_repo[(owner, name)].append(issue)
+
+    docs = []
+    for (owner, name), repo_issues in by_repo.items():
+        updated_at = {
+            i["number"]: i.get("updated_at")
+            for i in RepoIssue.objects(
+                owner=owner, name=name, number__in=[i["number"] for i in repo_issues]
+            )
+            .only("number", "updated_at")
+            .as_pymongo()
+        }
+        for issue in repo_issues:
+            existing = updated_at.get(issue["number"])
+            if existing is not None and issue["updated_at"] is not None:
+                if existing.replace(tzinfo=timezone.utc) > issue["updated_at"]:
+                    continue
+            docs.append(issue)
+    inserted, _ = _bulk_upsert(RepoIssue, ["owner", "name", "number"], docs)
+    return inserted
+
+
+def _write_commits(commits: List[Dict[str, Any]], token: Optional[str]) -> int:
+    """Insert commits that are not in the database, which has exact commit times"""
+    by_repo = defaultdict(list)
+    for commit in commits:
+        by_repo[(commit["owner"], commit["name"])].append(commit)
+
+    docs = []
+    for (owner, name), repo_commits in by_repo.items():
+        logins = resolve_logins(
+            owner,
+            name,
+            [{**c, "committer_email": c["author_email"]} for c in repo_commits],
+            token,
+        )
+        for commit in repo_commits:
+            doc = {k: v for k, v in commit.items() if k != "author_email"}
+            doc["author"] = logins.get(commit["author_email"])
+            doc["referenced_issues"] = _match_issue_numbers(commit["message"])
+            docs.append(doc)
+    inserted, _ = _bulk_upsert(
+        RepoCommit, ["owner", "name", "sha"], docs, overwrite=False
+    )
+    return inserted
+
+
+def _write_open_issue_events(events: List[Tuple[str, str, int, Dict[str, Any]]]) -> int:
+    """
+    Create OpenIssue documents with the archived events of issues that are still open.
+    Open issues already in the database keep their timelines fetched from GitHub.
+    """
+    by_issue = defaultdict(list)
+    for owner, name, number, event in events:
+        by_issue[(owner, name, number)].append(event)
+
+    docs = []
+    for (owner, name, number), issue_events in by_issue.items():
+        issue = RepoIssue.objects(
+            owner=owner, name=name, number=number, state="open", is_pull=False
+        ).first()
+        if issue is None:
+            continue
+        docs.append(
+            {
+                "owner": owner,
+                "name": name,
+                "number": number,
+                "created_at": issue.created_at,
+                "updated_at": issue.updated_at or issue.created_at,
+                "events": [IssueEvent(**e) for e in issue_events],
+            }
+        )
+    inserted, _ = _bulk_upsert(
+        OpenIssue, ["owner", "name", "number"], docs, overwrite=False
+    )
+    return inserted
+
+
+def _checkpoint_repos(
+    repos: List[Tuple[str, str]], start: datetime, end: datetime
+) -> int:
+    """
+    Leave a GitHubFetchCheckpoint for tracked repositories, as if an update from
+      their last update to the end of the archives had been interrupted after
+      fetching stars, commits and issues. The next update_repo() resumes it, so
+      resolved issues and open issue timelines are still computed with GitHub
+      for the archived window before Repo.updated_at moves to its end.
+    Repositories last updated before the first archive are left alone, since events
+      in between are not imported, as are those already updated past the archives
+      or with an unfinished update of their own.
+    :return: number of repositories checkpointed
+    """
+    checkpointed = 0
+    for owner, name in repos:
+        if GitHubFetchCheckpoint.objects(owner=owner, name=name).count() > 0:
+            logger.warning("%s/%s has an unfinished update, not resumed", owner, name)
+            continue
+        repo = Repo.objects(owner=owner, name=name).first()
+        if repo is None:
+            # the archives are the whole history of repositories not updated yet
+            since = start
+        else:
+            since = repo.updated_at if repo.updated_at else repo.repo_created_at
+        if since < start:
+            logger.warning(
+                "%s/%s was last updated at %s, before the archives begin at %s",
+                owner,
+                name,
+                since,
+                start,
+            )
+            continue
+        if since >= end:
+            continue
+        GitHubFetchCheckpoint(
+            owner=owner,
+            name=name,
+            since=since,
+            watermark=end,
+            completed=["stars", "commits", "issues"],
+            updated_at=datetime.now(timezone.utc),
+        ).save()
+        checkpointed += 1
+    return checkpointed
+
+
+def import_archives(
+    paths: Iterable[str],
+    repos: List[Tuple[str, str]],
+    n_workers: int = None,
+    token: Optional[str] = None,
+) -> Optional[datetime]:
+    """
+    Import stars, issues, pull requests, issue events and default branch commits
+      of tracked repositories from hourly GH Archive files on local disk.
+    Files are decoded in parallel processes and written in chronological order,
+      IMPORT_CHUNK_SIZE files at a time. Issues are only updated if the archive has
+      a newer version, while commits and open issue timelines already in the
+      database are kept, since the archive only has their approximations.
+    Repositories are then checkpointed up to the end of the archives, so the
+      next update_repo() completes them (see _checkpoint_repos()).
+    :param paths: archive files, or directories of them
+    :param repos: (owner, name) of tracked repositories
+    :param n_workers: number of files decoded concurrently (defaults to CPU count)
+    :param token: GitHub token to resolve unseen commit emails with (optional)
+    :return: the end of the latest imported hour, None if no file is imported
+    """
+    files = list_archive_files(paths)
+    tracked = {f"{owner}/{name}".lower(): (owner, name) for owner, name in repos}
+    events = []
+    n_workers = n_workers if n_workers is not None else mp.cpu_count()
+    logger.info("Importing %d archive files for %d repos", len(files), len(tracked))
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for i in range(0, len(files), IMPORT_CHUNK_SIZE):
+            chunk = files[i : i + IMPORT_CHUNK_SIZE]
+            results = defaultdict(list)
+            for file_results in executor.map(
+                _extract_events, chunk, [tracked] * len(chunk)
+            ):
+                for key, items in file_results.items():
+                    results[key].extend(items)
+
+            stars, _ = _bulk_upsert(
+                RepoStar, ["owner", "name", "user"], results["stars"]
+            )
+            issues = _write_issues(results["issues"])
+            commits = _write_commits(results["commits"], token)
+            events.extend(results["events"])
+            logger.info(
+                "%s: %d stars, %d issues and %d commits inserted",
+                os.path.basename(chunk[-1]),
+                stars,
+                issues,
+                commits,
+            )
+
+    open_issues = _write_open_issue_events(events)
+    logger.info("%d open issues created with archived events", open_issues)
+    if len(files) == 0:
+        return None
+
+    end = _archive_hour(files[-1]) + timedelta(hours=1)
+    checkpointed = _checkpoint_repos(
+        list(tracked.values()), _archive_hour(files[0]), end
+    )
+    logger.info("%d repos checkpointed until %s", checkpointed, end)
+    return end
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+", help="GH Archive files or directories")
+    parser.add_argument("--nprocess", type=int, default=mp.cpu_count())
+    parser.add_argument("--repos", type=str, default="")
+    parser.add_argument(
+        "--token",
+        type=str,
+        default="",
+        help="token to resolve commit emails with (defaults to the best valid token)",
+    )
+    args = parser.parse_args()
+    if args.repos == "":
+        repos = CONFIG["gfibot"]["projects"]
+    else:
+        repos = args.repos.split(",")
+
+    _connect_mongodb()
+    if args.token == "":
+        # emails left unresolved would leave archived commits without authors
+        valid_tokens = list(set(TOKENS) - check_tokens(TOKENS))
+        token = TokenBroker(valid_tokens).acquire("graphql")
+    else:
+        token = args.token
+    end = import_archives(
+        args.paths, [tuple(repo.split("/")) for repo in repos], args.nprocess, token
+    )
+    logger.info("GH Archive imported until %s", end)
+
+
+if __name__ == "__main__":
+    main()
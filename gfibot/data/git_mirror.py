@@ -0,0 +1,274 @@
+import os
+import re
+import shutil
+import logging
+import subprocess
+
+from typing import Dict, List, Tuple, Iterator, Optional, Any
+from datetime import datetime, timedelta, timezone
+from pymongo import UpdateOne
+
+from gfibot import CONFIG
+from gfibot.collections import GitEmailLogin
+from gfibot.data.graphql import get_client
+
+
+logger = logging.getLogger(__name__)
+
+# directory of local git mirrors, commits are fetched through REST if None
+try:
+    GIT_MIRROR_ROOT = CONFIG["gfibot"]["git_mirror_root"]
+except KeyError:
+    GIT_MIRROR_ROOT = None
+
+GIT_CLONE_URL = "https://github.com/{owner}/{name}.git"
+# seconds before a clone or fetch is given up, so a hung connection cannot block updates
+GIT_SYNC_TIMEOUT = 3600
+# number of commits in a page returned by GitMirror.iter_commits()
+GIT_LOG_PAGE_SIZE = 1000
+# number of commit emails resolved in one GraphQL query
+EMAIL_BATCH_SIZE = 50
+# emails without a GitHub user are resolved again after this time
+EMAIL_RETRY_INTERVAL = timedelta(days=30)
+
+# commits made on the GitHub web interface are committed by web-flow
+WEB_FLOW_EMAIL = "noreply@github.com"
+_NOREPLY_EMAIL = re.compile(r"^(?:\d+\+)?([A-Za-z0-9-]+)@users\.noreply\.github\.com$")
+
+# RS starts a commit and NUL separates its fields, neither appears in commit messages
+_LOG_FORMAT = "%x1e%H%x00%ae%x00%aI%x00%ce%x00%cI%x00%B"
+
+
+def _email_login(email: str) -> Optional[str]:
+    """The login of an email that GitHub generates for a user, None otherwise"""
+    if email == WEB_FLOW_EMAIL:
+        return "web-flow"
+    match = _NOREPLY_EMAIL.match(email)
+    return match.group(1) if match else None
+
+
+def _query_logins(
+    owner: str, name: str, samples: Dict[str, Tuple[str, str]], token: str
+) -> Dict[str, Optional[str]]:
+    """
+    Resolve emails with GraphQL, through the author or committer of a sample commit
+    :param samples: email -> (sha, "author" or "committer") of a commit with the email
+    :return: email -> login, emails in failed queries are left out
+    """
+    client = get_client(token)
+    items = list(samples.items())
+    logins = {}
+    for i in range(0, len(items), EMAIL_BATCH_SIZE):
+        batch = items[i : i + EMAIL_BATCH_SIZE]
+        objects = " ".join(
+            f'c{j}: object(oid: "{sha}") {{ ... on Commit {{ {role} {{ user {{ login }} }} }} }}'
+            for j, (_, (sha, role)) in enumerate(batch)
+        )
+        res = client.get_one(
+            f'query {{ repository(owner: "{owner}", name: "{name}") {{ {objects} }} '
+            "rateLimit { cost limit remaining resetAt } }"
+        )
+        if res is None:
+            logger.error(
+                "Failed to resolve %d emails of %s/%s", len(batch), owner, name
+            )
+            continue
+        repository = res["repository"] or {}
+        for j, (email, (_, role)) in enumerate(batch):
+            user = ((repository.get(f"c{j}") or {}).get(role) or {}).get("user")
+            logins[email] = user["login"] if user else None
+    return logins
+
+
+def resolve_logins(
+    owner: str, name: str, commits: List[Dict[str, Any]], token: Optional[str]
+) -> Dict[str, Optional[str]]:
+    """
+    Map author and committer emails of commits to GitHub logins.
+    Only emails that are neither generated by GitHub nor in GitEmailLogin are queried,
+      and their logins are cached in GitEmailLogin.
+    :param commits: commits parsed by GitMirror.iter_log()
+    :param token: GitHub token to query unseen emails with, None to leave them unresolved
+    """
+    logins, samples = {}, {}
+    for commit in commits:
+        for role in ["author", "committer"]:
+            email = commit[f"{role}_email"]
+            login = _email_login(email)
+            if login is not None:
+                logins[email] = login
+            elif email not in samples:
+                samples[email] = (commit["sha"], role)
+
+    retry_before = datetime.now(timezone.utc) - EMAIL_RETRY_INTERVAL
+    for cached in (
+        GitEmailLogin.objects(email__in=list(samples.keys()))
+        .only("email", "login", "resolved_at")
+        .as_pymongo()
+    ):
+        resolved_at = cached["resolved_at"].replace(tzinfo=timezone.utc)
+        if cached.get("login") is not None or resolved_at >= retry_before:
+            logins[cached["email"]] = cached.get("login")
+
+    unseen = {email: s for email, s in samples.items() if email not in logins}
+    if len(unseen) > 0 and token is not None:
+        resolved = _query_logins(owner, name, unseen, token)
+        now = datetime.now(timezone.utc)
+        if len(resolved) > 0:
+            GitEmailLogin._get_collection().bulk_write(
+                [
+                    UpdateOne(
+                        {"email": email},
+                        {"$set": {"login": login, "resolved_at": now}},
+                        upsert=True,
+                    )
+                    for email, login in resolved.items()
+                ],
+                ordered=False,
+            )
+        logins.update(resolved)
+        logger.info(
+            "%d/%d new emails of %s/%s resolved",
+            sum(login is not None for login in resolved.values()),
+            len(unseen),
+            owner,
+            name,
+        )
+    return logins
+
+
+def _parse_commit(record: str) -> Dict[str, Any]:
+    sha, author, authored_at, committer, committed_at, message = record.split("\x00", 5)
+    return {
+        "sha": sha,
+        "author_email": author,
+        "authored_at": datetime.fromisoformat(authored_at).astimezone(timezone.utc),
+        "committer_email": committer,
+        "committed_at": datetime.fromisoformat(committed_at).astimezone(timezone.utc),
+        # git log ends each message with a newline
+        "message": message.rstrip("\n"),
+    }
+
+
+class GitMirror(object):
+    """
+    A blobless bare clone of a GitHub repository, fetched incrementally,
+      to read commit history without the REST API
+    """
+
+    def __init__(
+        self, owner: str, name: str, root: str = None, url: Optional[str] = None
+    ):
+        """
+        :param owner: repository owner
+        :param name: repository name
+        :param root: directory of mirrors (defaults to GIT_MIRROR_ROOT)
+        :param url: URL to clone from (defaults to the GitHub repository)
+        """
+        self.owner = owner
+        self.name = name
+        root = root if root is not None else GIT_MIRROR_ROOT
+        self.path = os.path.join(root, owner, name + ".git")
+        self.url = (
+            url if url is not None else GIT_CLONE_URL.format(owner=owner, name=name)
+        )
+
+    def _git(self, *args: str, timeout: Optional[float] = None) -> str:
+        return subprocess.run(
+            ["git", "-C", self.path, *args],
+            check=True,
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+        ).stdout
+
+    def sync(self) -> None:
+        """
+        Clone the repository if it is not mirrored yet, otherwise fetch new commits
+        :raises subprocess.TimeoutExpired: if git takes longer than GIT_SYNC_TIMEOUT
+        """
+        if os.path.isdir(self.path):
+            logger.info("Fetching git mirror of %s/%s", self.owner, self.name)
+            self._git("fetch", "--prune", "--quiet", "origin", timeout=GIT_SYNC_TIMEOUT)
+            return
+
+        logger.info("Cloning %s into %s", self.url, self.path)
+        # clone next to the mirror, so an interrupted clone is never taken as one
+        tmp_path = self.path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        subprocess.run(
+            ["git", "clone", "--bare", "--filter=blob:none", "--quiet"]
+            + [self.url, tmp_path],
+            check=True,
+            capture_output=True,
+            timeout=GIT_SYNC_TIMEOUT,
+        )
+        # bare clones do not fetch into their branches by default
+        subprocess.run(
+            ["git", "-C", tmp_path, "config", "remote.origin.fetch"]
+            + ["+refs/heads/*:refs/heads/*"],
+            check=True,
+            capture_output=True,
+        )
+        os.rename(tmp_path, self.path)
+
+    def iter_log(self, since: datetime) -> Iterator[Dict[str, Any]]:
+        """
+        Yields commits of the default branch committed since the given time,
+          newest first, with author and committer emails instead of logins
+        """
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        with subprocess.Popen(
+            ["git", "-C", self.path, "log", "HEAD"]
+            + ["--since=" + since.isoformat(), "--format=" + _LOG_FORMAT],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            encoding="utf-8",
+            errors="replace",
+        ) as proc:
+            buffer = ""
+            for chunk in iter(lambda: proc.stdout.read(1 << 16), ""):
+                *records, buffer = (buffer + chunk).split("\x1e")
+                for record in records:
+                    if record:
+                        yield _parse_commit(record)
+            if buffer:
+                yield _parse_commit(buffer)
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+    def iter_commits(
+        self, since: datetime, token: Optional[str] = None
+    ) -> Iterator[Tuple[int, List[Dict[str, Any]]]]:
+        """
+        Yields (page index, commits) of commits since the given time, in the same
+          shape as RepoFetcher.iter_commits()
+        :param token: GitHub token to resolve unseen emails with (see resolve_logins())
+        """
+
+        def to_page(commits: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+            logins = resolve_logins(self.owner, self.name, commits, token)
+            return [
+                {
+                    "owner": self.owner,
+                    "name": self.name,
+                    "sha": c["sha"],
+                    "author": logins.get(c["author_email"]),
+                    "authored_at": c["authored_at"],
+                    "committer": logins.get(c["committer_email"]),
+                    "committed_at": c["committed_at"],
+                    "message": c["message"],
+                }
+                for c in commits
+            ]
+
+        p, commits = 0, []
+        for commit in self.iter_log(since):
+            commits.append(commit)
+            if len(commits) >= GIT_LOG_PAGE_SIZE:
+                yield p, to_page(commits)
+                p, commits = p + 1, []
+        if len(commits) > 0:
+            yield p, to_page(commits)
@@ -1,10 +1,16 @@
+import re
 import logging
 import time
+import threading
 
-from typing import Dict, List, Tuple, Callable, Any
-from datetime import datetime, timedelta
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Tuple, Callable, Any, Optional, Deque, Union
+from datetime import datetime, timedelta, timezone
 
 from gql import Client, gql
+from graphql import DocumentNode, GraphQLSchema, build_ast_schema, parse, validate
 from gql.transport.requests import RequestsHTTPTransport
 from gql.transport.exceptions import TransportQueryError, TransportServerError
 from dateutil.parser import parse as parse_date
@@ -15,9 +21,83 @@ from gql.transport.requests import log as requests_logger
 requests_logger.setLevel(logging.WARNING)
 
 # load the graphql schema
-from gfibot import CONFIG
+from gfibot import CONFIG, github_client
+from gfibot.token_broker import report_quota
 import requests
 
+# validate queries against the schema before sending them, off by default since all
+#   queries are generated by the fetchers below and GitHub rejects invalid ones anyway,
+#   turn it on when changing the query generators
+try:
+    VALIDATE_QUERIES = CONFIG["gfibot"]["graphql_validate_queries"]
+except KeyError:
+    VALIDATE_QUERIES = False
+
+# bounds of the adaptive page size (first: n) of paged connections
+MIN_PAGE_SIZE, MAX_PAGE_SIZE = 10, 100
+# queries with a higher rateLimit.cost or latency (seconds) shrink the page size,
+#   queries below half of both grow it back
+MAX_QUERY_COST, MAX_QUERY_LATENCY = 50, 10.0
+
+# max number of contributionsCollection date windows of a user fetched concurrently,
+#   1 walks the windows one query chain at a time
+try:
+    WINDOW_WORKERS = CONFIG["gfibot"]["user_window_workers"]
+except KeyError:
+    WINDOW_WORKERS = 1
+
+# contributionsCollection spans at most a year
+CONTRIBUTION_WINDOW = timedelta(days=365)
+
+
+class AdaptivePageSize(object):
+    def __init__(
+        self,
+        min_size: int = MIN_PAGE_SIZE,
+        max_size: int = MAX_PAGE_SIZE,
+        max_cost: int = MAX_QUERY_COST,
+        max_latency: float = MAX_QUERY_LATENCY,
+        history_size: int = 1000,
+    ) -> None:
+        """
+        Page size of paged connections that shrinks when queries time out or are
+          expensive and grows back when queries are cheap.
+        The page size, cost and latency of recent queries are kept in history.
+        :param min_size: {int} smallest page size
+        :param max_size: {int} largest page size, also the initial one
+        :param max_cost: {int} rateLimit.cost above which the page size is halved
+        :param max_latency: {float} seconds above which the page size is halved
+        :param history_size: {int} number of recent queries kept in history
+
+        >>> p = AdaptivePageSize()
+        >>> p.record(p.size, 80, 1.0)
+        >>> p.size
+        50
+        """
+        self.min_size, self.max_size = min_size, max_size
+        self.max_cost, self.max_latency = max_cost, max_latency
+        self.size = max_size
+        self.history: Deque[Tuple[int, Optional[int], float]] = deque(
+            maxlen=history_size
+        )
+        self._lock = threading.Lock()
+
+    def shrink(self) -> None:
+        with self._lock:
+            self.size = max(self.min_size, self.size // 2)
+
+    def record(self, size: int, cost: Optional[int], latency: float) -> None:
+        """Record a successful query and adapt the page size to it"""
+        with self._lock:
+            self.history.append((size, cost, latency))
+            expensive = cost is not None and cost > self.max_cost
+            if expensive or latency > self.max_latency:
+                self.size = max(self.min_size, self.size // 2)
+            elif (cost is None or cost <= self.max_cost / 2) and (
+                latency <= self.max_latency / 2
+            ):
+                self.size = min(self.max_size, self.size + max(1, self.size // 4))
+
 
 class GitHubGraphQLClient(object):
     @staticmethod
@@ -29,7 +109,7 @@ class GitHubGraphQLClient(object):
         except FileNotFoundError:
             logging.info("Could not load schema: %s, getting from GitHub", schema_path)
             try:
-                r = requests.get(schema_url)
+                r = github_client.get(schema_url)
                 if r.status_code == 200:
                     with open(schema_path, "w", encoding="utf-8") as f:
                         f.write(r.text)
@@ -42,12 +122,40 @@ class GitHubGraphQLClient(object):
                 logging.error("Could not load schema from GitHub: %s", e)
                 return None
 
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _get_graphql_schema(schema_path: str) -> Optional[GraphQLSchema]:
+        """Load and build the schema once per process"""
+        schema = GitHubGraphQLClient._load_graphql_schema(schema_path)
+        if not schema:
+            return None
+        return build_ast_schema(parse(schema))
+
+    @staticmethod
+    def _parse_query(query: str, schema: Optional[GraphQLSchema]) -> DocumentNode:
+        """
+        Parse a query, and validate it if a schema is given.
+        Documents are not cached, since generated queries embed cursors, dates
+          and aliases and are hardly ever sent twice.
+        """
+        document = gql(query)
+        if schema is not None:
+            errors = validate(schema, document)
+            if errors:
+                raise errors[0]
+        return document
+
     def __init__(
         self,
         github_token: str,
         num_retries: int = 3,
         retry_interval: int = 60,
+        validate_queries: bool = False,
     ) -> None:
+        """
+        :param validate_queries: validate queries against the schema before sending
+            them, the schema itself is only built once per process
+        """
         super().__init__()
 
         self._logger = logging.getLogger(__name__)
@@ -55,41 +163,85 @@ class GitHubGraphQLClient(object):
         self._num_retries = num_retries
 
         self._schema = None
-        try:
-            self._schema = self._load_graphql_schema(
-                CONFIG["gfibot"]["github_graphql_schema_path"]
-            )
-        except KeyError as e:
-            self._logger.error("Schema path not found in config: %s", e)
-        if not self._schema:
-            self._logger.info("Fallback to introspection")
+        if validate_queries:
+            try:
+                self._schema = self._get_graphql_schema(
+                    CONFIG["gfibot"]["github_graphql_schema_path"]
+                )
+            except KeyError as e:
+                self._logger.error("Schema path not found in config: %s", e)
+            if not self._schema:
+                self._logger.info("No schema available, queries are not validated")
 
+        # queries are validated by _parse_query, not by the client on every request,
+        #   and requests go through the keep-alive session shared with other clients
         self._client = Client(
             transport=RequestsHTTPTransport(
-                url="https://api.github.com/graphql",
+                url=f"{github_client.GITHUB_API_URL}/graphql",
                 headers={"Authorization": "Bearer {}".format(github_token)},
                 verify=True,
-                retries=num_retries,
             ),
-            fetch_schema_from_transport=(self._schema is None),
-            schema=self._schema,
+            fetch_schema_from_transport=False,
         )
+        self._session = self._client.connect_sync()
+        self._client.transport.session = github_client.get_session()
 
         self._retry_interval = retry_interval
         self._reset_at = time.time() + self._retry_interval
 
-    def get_one(self, query: str, variables=None, default=None) -> dict or None:
+        # shared by all fetchers of this client, since cost and timeouts are per token
+        self.page_size = AdaptivePageSize()
+
+    def get_one(
+        self,
+        query: Union[str, Callable[[], str]],
+        variables=None,
+        default=None,
+        partial: bool = False,
+    ) -> dict or None:
+        """
+        Run a query, retrying on rate limits and server errors
+        :param query: the query, or a function generating it with the current
+            page size, so that retries after a timeout ask for smaller pages
+        :param partial: return the data of a query that failed in some of its
+            fields (e.g., an aliased issue that is deleted), with those fields null
+        """
         retries = 1
         while retries <= self._num_retries:
+            page_size = self.page_size.size
             try:
-                result = self._client.execute(gql(query), variable_values=variables)
+                begin = time.time()
+                result = self._session.execute(
+                    self._parse_query(
+                        query() if callable(query) else query, self._schema
+                    ),
+                    variable_values=variables,
+                )
 
                 # update reset_at
-                reset_at: str or None = result.get("rateLimit", {}).get("resetAt")
+                rate_limit: dict = result.get("rateLimit", {})
+                self.page_size.record(
+                    page_size, rate_limit.get("cost"), time.time() - begin
+                )
+                self._logger.debug(
+                    "Query cost = %s, latency = %.2fs, page size = %d",
+                    rate_limit.get("cost"),
+                    time.time() - begin,
+                    page_size,
+                )
+                reset_at: str or None = rate_limit.get("resetAt")
                 if reset_at:
                     self._reset_at = datetime.strptime(
                         reset_at, "%Y-%m-%dT%H:%M:%SZ"
                     ).timestamp()
+                    if "remaining" in rate_limit:
+                        report_quota(
+                            self._token,
+                            "graphql",
+                            rate_limit["remaining"],
+                            rate_limit.get("limit"),
+                            parse_date(reset_at),
+                        )
                 else:
                     self._reset_at = time.time() + self._retry_interval
 
@@ -111,6 +263,11 @@ class GitHubGraphQLClient(object):
                     )
                     continue
 
+                # partial results, fields that failed are null
+                elif partial and e.data:
+                    self._logger.warning("GitHub API error in some fields: %s", e)
+                    return e.data
+
                 # unknown error
                 else:
                     self._logger.error(
@@ -127,12 +284,45 @@ class GitHubGraphQLClient(object):
                         e,
                     )
                     break
+                # timeouts (502, 504) and other server errors
                 else:
-                    self._logger.error("Unexpected HTTP %d error: %s", e.code, e)
+                    self._logger.error(
+                        "Unexpected HTTP %s error (%d/%d): %s",
+                        e.code,
+                        retries,
+                        self._num_retries,
+                        e,
+                    )
+                    self.page_size.shrink()
+                    retries += 1
+                    time.sleep(min(2**retries, self._retry_interval))
+
+            except requests.exceptions.Timeout as e:
+                self._logger.error(
+                    "Query timed out (%d/%d): %s", retries, self._num_retries, e
+                )
+                self.page_size.shrink()
+                retries += 1
+                time.sleep(min(2**retries, self._retry_interval))
 
         return default
 
 
+_clients: Dict[Tuple[str, str], GitHubGraphQLClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(token: str) -> GitHubGraphQLClient:
+    """Get the client shared by all fetchers of a token in this process"""
+    with _clients_lock:
+        key = (token, github_client.GITHUB_API_URL)
+        if key not in _clients:
+            _clients[key] = GitHubGraphQLClient(
+                token, validate_queries=VALIDATE_QUERIES
+            )
+        return _clients[key]
+
+
 class GraphQLQueryComponent(object):
     @staticmethod
     def _wrap_str(s: str or Dict) -> str:
@@ -196,6 +386,7 @@ class GraphQLQueryComponent(object):
         args: Dict[str, Any] = None,
         callback: Callable[[Dict[str, Any]], None] or None = None,
         *children: "GraphQLQueryComponent" or str,
+        alias: str or None = None,
     ):
         """
         Initializes a GraphQL query component
@@ -203,12 +394,16 @@ class GraphQLQueryComponent(object):
         :param args: The arguments of the query component
         :param callback: The callback function to be called on query results (optional)
         :param children: The children of the query component (can be strings or GraphQLQueryComponents)
+        :param alias: The alias of the query component, required if siblings share a name (optional)
 
         >>> q = GraphQLQueryComponent("query", {"first": 10}, None, "user", "repository")
         >>> q.gen_query()
         'query(first: 10) {user {repository}} '
+        >>> GraphQLQueryComponent("user", {"login": "a"}, None, "name", alias="u0").gen_query(False)
+        'u0: user(login: "a") {name}'
         """
         self.name = name
+        self.alias = alias
         self.args = args if args else {}
 
         self._callback = callback
@@ -217,7 +412,12 @@ class GraphQLQueryComponent(object):
 
     def __str__(self):
         """Pretty print attributes"""
-        return f"{self.__class__.__name__}({self.name}, {self.args})"
+        return f"{self.__class__.__name__}({self.key}, {self.args})"
+
+    @property
+    def key(self) -> str:
+        """The key of this component in query results"""
+        return self.alias if self.alias else self.name
 
     def _init_state(self) -> None:
         """Initializes state"""
@@ -253,11 +453,9 @@ class GraphQLQueryComponent(object):
                 # update EVERY child's state and run callback
                 if not c.finished:
                     try:
-                        c.update_state(res[c.name])
+                        c.update_state(res[c.key])
                     except KeyError as e:
-                        logging.error(
-                            f"{str(self)}: Expecting {c.name} in {res.keys()}"
-                        )
+                        logging.error(f"{str(self)}: Expecting {c.key} in {res.keys()}")
                         raise e
                 if not c.finished:
                     self.finished = False
@@ -277,6 +475,12 @@ class GraphQLQueryComponent(object):
             logging.error(f"Error executing callback: {str(self)}")
             raise e
 
+    def set_page_size(self, size: int) -> None:
+        """Sets the page size of every paged component in this query"""
+        for c in self.children:
+            if isinstance(c, GraphQLQueryComponent):
+                c.set_page_size(size)
+
     def gen_query(self, indent: bool = True) -> str:
         """
         Generates the query string
@@ -286,7 +490,7 @@ class GraphQLQueryComponent(object):
         if self.finished:
             return ""
 
-        q = self.name
+        q = f"{self.alias}: {self.name}" if self.alias else self.name
         if self.args:
             q += (
                 "("
@@ -320,6 +524,7 @@ class GraphQLQueryPagedComponent(GraphQLQueryComponent):
         args: Dict[str, Any] = None,
         callback: Callable[[Dict[str, Any]], None] or None = None,
         *children: "GraphQLQueryComponent" or str,
+        alias: str or None = None,
     ):
         """
         Initializes a GraphQL query component with pagination
@@ -327,14 +532,21 @@ class GraphQLQueryPagedComponent(GraphQLQueryComponent):
         :param args: The arguments of the query component
         :param callback: The callback function to be called on query results (optional)
         :param children: The children of the query component (can be strings or GraphQLQueryComponents)
+        :param alias: The alias of the query component (optional)
 
         >>> q = GraphQLQueryPagedComponent("query", {"first": 10}, None, "user", "repository")
         >>> q.gen_query()
         'query(first: 10) {user {repository} pageInfo { hasNextPage  endCursor}}'
         """
-        super().__init__(name, args, callback, *children)
+        super().__init__(name, args, callback, *children, alias=alias)
         self.children = (*self.children, "pageInfo {\n  hasNextPage\n  endCursor\n}")
 
+    def set_page_size(self, size: int) -> None:
+        """Sets the page size, which can change between pages"""
+        if "first" in self.args:
+            self.args["first"] = size
+        super().set_page_size(size)
+
     def _init_state(self) -> None:
         """Initializes state"""
         self.finished = False
@@ -359,6 +571,7 @@ class GraphQLQueryDateComponent(GraphQLQueryComponent):
         args: Dict[str, Any] = None,
         callback: Callable[[Dict[str, Any]], None] or None = None,
         *children: "GraphQLQueryComponent" or str,
+        alias: str or None = None,
     ):
         """
         Initializes a GraphQL query component with date range
@@ -366,6 +579,7 @@ class GraphQLQueryDateComponent(GraphQLQueryComponent):
         :param args: The arguments of the query component ('from' is required, 'to' and 'interval_days' are optional)
         :param callback: The callback function to be called on query results (optional)
         :param children: The children of the query component (can be strings or GraphQLQueryComponents)
+        :param alias: The alias of the query component (optional)
 
         >>> GraphQLQueryDateComponent("query", {"from": "2019-01-01", "to": "2022-01-01", "interval_days": 1}, None, "user", "repository").gen_query()
         'query(from: "2019-01-01T00:00:00Z", to: "2019-01-02T00:00:00Z") {user {repository} startedAt endedAt } '
@@ -374,7 +588,7 @@ class GraphQLQueryDateComponent(GraphQLQueryComponent):
         >>> GraphQLQueryDateComponent("query", {"from": "2019-01-01", "to": "2019-12-31", "interval_days": 400}, None, "user", "repository").gen_query()
         'query(from: "2019-01-01T00:00:00Z", to: "2019-12-31T00:00:00Z") {user {repository} startedAt endedAt } '
         """
-        super().__init__(name, args, callback, *children)
+        super().__init__(name, args, callback, *children, alias=alias)
         self.children = (*self.children, "startedAt", "endedAt")
 
         # read from args: 'from' 'to' 'interval'
@@ -433,6 +647,9 @@ class UserFetcher(object):
         login: str,
         since: datetime,
         callbacks: Dict[str, Callable[[Dict[str, Any]], None]] = {},
+        gh_gql: GitHubGraphQLClient or None = None,
+        until: datetime or None = None,
+        window_workers: int or None = None,
     ) -> None:
         """
         Initializes a UserFetcher
@@ -440,19 +657,33 @@ class UserFetcher(object):
         :param login: {str} github login
         :param since: {datetime} since when to fetch
         :param callbacks: {Dict[str, Callable[[Dict[str, Any]], None]]} callbacks to call on each response
+        :param gh_gql: {GitHubGraphQLClient} client to reuse (optional, shared client of token if None)
+        :param until: {datetime} until when to fetch contributions (optional, now if None)
+        :param window_workers: {int} number of contributionsCollection windows fetched
+            concurrently, callbacks still run in window order (optional, WINDOW_WORKERS if None)
 
         >>> uf = UserFetcher("token", "login", datetime.now(), {'issues': lambda x: print('issues', x)})
         >>> uf.fetch()
         'issues' {'totalCount': 558, 'nodes': [...]}
         """
 
-        self.gh_gql = GitHubGraphQLClient(token)
+        self.gh_gql = gh_gql if gh_gql is not None else get_client(token)
+        self._token = token
+        # paged components follow the adaptive page size of the client,
+        #   per_page only applies to connections that are not paged
         self.per_page = 100
         self.login = login
         self._callbacks = callbacks
+        self.window_workers = max(
+            1, window_workers if window_workers is not None else WINDOW_WORKERS
+        )
         # cast to utc
-        self._since_str = since.replace(tzinfo=datetime.utcnow().tzinfo).strftime(
-            "%Y-%m-%dT%H:%M:%SZ"
+        self._since = since.replace(tzinfo=datetime.utcnow().tzinfo)
+        self._since_str = self._since.strftime("%Y-%m-%dT%H:%M:%SZ")
+        self._until = (
+            until.replace(tzinfo=datetime.utcnow().tzinfo)
+            if until is not None
+            else None
         )
 
         self._logger = logging.getLogger(__name__)
@@ -460,60 +691,136 @@ class UserFetcher(object):
     def _handle_callback(self, name: str):
         return self._callbacks[name] if name in self._callbacks else None
 
+    def user_component(
+        self, alias: str or None = None, with_issues: bool = True
+    ) -> GraphQLQueryComponent:
+        """
+        Builds the query component for this user, with its own pagination state
+        :param alias: {str} alias of the user component, if queried along with other users
+        :param with_issues: {bool} whether to query issues besides contributions
+        """
+        contributions_args = {
+            "from": self._since_str,
+            "interval_days": CONTRIBUTION_WINDOW.days,
+        }
+        if self._until is not None:
+            contributions_args["to"] = self._until.strftime("%Y-%m-%dT%H:%M:%SZ")
+        issues = GraphQLQueryPagedComponent(
+            "issues",
+            {"first": self.per_page, "filterBy": {"since": self._since_str}},
+            self._handle_callback("issues"),
+            "totalCount",
+            "nodes {\n  number\n  state\n  repository {\n    nameWithOwner\n    stargazerCount\n  }\n  createdAt\n}",
+        )
+        return GraphQLQueryComponent(
+            "user",
+            {"login": self.login},
+            self._handle_callback("user"),
+            "login",
+            "name",
+            *([issues] if with_issues else []),
+            GraphQLQueryDateComponent(
+                "contributionsCollection",
+                contributions_args,
+                self._handle_callback("contributionsCollection"),
+                GraphQLQueryComponent(
+                    "commitContributionsByRepository",
+                    {},
+                    self._handle_callback("commitContributionsByRepository"),
+                    "contributions (first: %d, orderBy: {field: COMMIT_COUNT, direction: DESC}){\n  nodes {\n    commitCount\n    occurredAt\n  }\n}"
+                    % self.per_page,
+                    "repository {\n    nameWithOwner\n    stargazerCount\n  }",
+                ),
+                GraphQLQueryPagedComponent(
+                    "pullRequestReviewContributions",
+                    {"first": self.per_page},
+                    self._handle_callback("pullRequestReviewContributions"),
+                    "nodes {\n  repository {\n    nameWithOwner\n    stargazerCount\n  }\n  isRestricted\n  pullRequestReview {\n    createdAt\n    state\n   pullRequest{\n  number  \n}  \n }\n}",
+                ),
+                GraphQLQueryPagedComponent(
+                    "pullRequestContributions",
+                    {"first": self.per_page},
+                    self._handle_callback("pullRequestContributions"),
+                    "nodes {\n  pullRequest {\n  createdAt\n    number\n   state\n  repository {\n    nameWithOwner\n    stargazerCount\n  }\n  }\n}",
+                ),
+            ),
+            alias=alias,
+        )
+
+    def _gen_query(self, q: GraphQLQueryComponent) -> str:
+        """Generates the next query with the current adaptive page size"""
+        q.set_page_size(self.gh_gql.page_size.size)
+        s = q.gen_query(False)
+        self._logger.debug(f"Running query: {s}")
+        return s
+
+    def _windows(self) -> List[Tuple[datetime, datetime or None]]:
+        """Splits [since, until] into contributionsCollection windows, the last one ends at until"""
+        until = self._until if self._until is not None else datetime.utcnow()
+        windows = []
+        start = self._since
+        while start + CONTRIBUTION_WINDOW < until:
+            windows.append((start, start + CONTRIBUTION_WINDOW))
+            start += CONTRIBUTION_WINDOW
+        windows.append((start, self._until))
+        return windows
+
+    def _fetch_windows(self, windows: List[Tuple[datetime, datetime or None]]) -> None:
+        """
+        Fetches the windows concurrently, each with its own query chain (issues are
+          fetched along with the first one). Responses are recorded and replayed
+          to the callbacks in window order once all windows are done.
+        """
+        records: List[List[Tuple[str, Dict[str, Any]]]] = [[] for _ in windows]
+
+        def fetch_window(i: int) -> None:
+            since, until = windows[i]
+            fetcher = UserFetcher(
+                self._token,
+                self.login,
+                since,
+                {
+                    name: lambda res, name=name: records[i].append((name, res))
+                    for name in self._callbacks
+                },
+                gh_gql=self.gh_gql,
+                until=until,
+                window_workers=1,
+            )
+            fetcher._fetch(fetcher.user_component(with_issues=i == 0))
+
+        with ThreadPoolExecutor(
+            max_workers=min(self.window_workers, len(windows))
+        ) as executor:
+            list(executor.map(fetch_window, range(len(windows))))
+
+        for window in records:
+            for name, res in window:
+                self._callbacks[name](res)
+
     def fetch(self) -> None:
         """Runs the query"""
         self._logger.debug(f"Fetching metrics for {self.login} since {self._since_str}")
 
+        if self.window_workers > 1:
+            windows = self._windows()
+            if len(windows) > 1:
+                self._fetch_windows(windows)
+                return
+        self._fetch(self.user_component())
+
+    def _fetch(self, user: GraphQLQueryComponent) -> None:
+        """Runs the query chain of a user component until it is finished"""
         q = GraphQLQueryComponent(
             "query",
             {},
             self._handle_callback("query"),
             "rateLimit {\n  cost\n  limit\n  remaining\n  resetAt\n}",
-            GraphQLQueryComponent(
-                "user",
-                {"login": self.login},
-                self._handle_callback("user"),
-                "login",
-                "name",
-                GraphQLQueryPagedComponent(
-                    "issues",
-                    {"first": self.per_page, "filterBy": {"since": self._since_str}},
-                    self._handle_callback("issues"),
-                    "totalCount",
-                    "nodes {\n  number\n  state\n  repository {\n    nameWithOwner\n    stargazerCount\n  }\n  createdAt\n}",
-                ),
-                GraphQLQueryDateComponent(
-                    "contributionsCollection",
-                    {"from": self._since_str, "interval_days": 365},
-                    self._handle_callback("contributionsCollection"),
-                    GraphQLQueryComponent(
-                        "commitContributionsByRepository",
-                        {},
-                        self._handle_callback("commitContributionsByRepository"),
-                        "contributions (first: %d, orderBy: {field: COMMIT_COUNT, direction: DESC}){\n  nodes {\n    commitCount\n    occurredAt\n  }\n}"
-                        % self.per_page,
-                        "repository {\n    nameWithOwner\n    stargazerCount\n  }",
-                    ),
-                    GraphQLQueryPagedComponent(
-                        "pullRequestReviewContributions",
-                        {"first": self.per_page},
-                        self._handle_callback("pullRequestReviewContributions"),
-                        "nodes {\n  repository {\n    nameWithOwner\n    stargazerCount\n  }\n  isRestricted\n  pullRequestReview {\n    createdAt\n    state\n   pullRequest{\n  number  \n}  \n }\n}",
-                    ),
-                    GraphQLQueryPagedComponent(
-                        "pullRequestContributions",
-                        {"first": self.per_page},
-                        self._handle_callback("pullRequestContributions"),
-                        "nodes {\n  pullRequest {\n  createdAt\n    number\n   state\n  repository {\n    nameWithOwner\n    stargazerCount\n  }\n  }\n}",
-                    ),
-                ),
-            ),
+            user,
         )
 
         while not q.finished:
-            s = q.gen_query(False)
-            self._logger.debug(f"Running query: {s}")
-            r = self.gh_gql.get_one(q.gen_query(False))
+            r = self.gh_gql.get_one(lambda: self._gen_query(q))
             if r is None:
                 self._logger.error("Exception while running query")
                 raise Exception("Exception while running query")
@@ -524,3 +831,332 @@ class UserFetcher(object):
                 self._logger.error(f"Exception while updating state: {e}")
                 self._logger.error(f"Response: {r}")
                 raise e
+
+
+class MultiUserFetcher(object):
+    def __init__(
+        self,
+        token: str,
+        users: List[Tuple[str, datetime, Dict[str, Callable[[Dict[str, Any]], None]]]],
+        callbacks: Dict[str, Callable[[Dict[str, Any]], None]] = {},
+        batch_size: int = 10,
+    ) -> None:
+        """
+        Fetches many users with one query chain per batch, each user under its own alias.
+        Every alias keeps its own pagination and date range state,
+          so users that finished early are simply left out of later queries.
+        :param token: {str} GitHub token
+        :param users: {List[Tuple[str, datetime, Dict]]} login, since and callbacks of each user,
+            the callbacks are the same as UserFetcher except for 'query'
+        :param callbacks: {Dict[str, Callable[[Dict[str, Any]], None]]} callbacks on the whole query ('query')
+        :param batch_size: {int} number of users in one query
+
+        >>> muf = MultiUserFetcher("token", [("a", datetime.now(), {}), ("b", datetime.now(), {})])
+        >>> muf.fetch()
+        []
+        """
+        self.gh_gql = get_client(token)
+        self.batch_size = batch_size
+        self._fetchers = [
+            UserFetcher(token, login, since, user_callbacks, gh_gql=self.gh_gql)
+            for login, since, user_callbacks in users
+        ]
+        self._callbacks = callbacks
+
+        self._logger = logging.getLogger(__name__)
+
+    def _gen_query(self, q: GraphQLQueryComponent) -> str:
+        """Generates the next query with the current adaptive page size"""
+        q.set_page_size(self.gh_gql.page_size.size)
+        return q.gen_query(False)
+
+    def _fetch_batch(self, fetchers: List[UserFetcher]) -> bool:
+        q = GraphQLQueryComponent(
+            "query",
+            {},
+            self._callbacks.get("query"),
+            "rateLimit {\n  cost\n  limit\n  remaining\n  resetAt\n}",
+            *[f.user_component(alias=f"user{i}") for i, f in enumerate(fetchers)],
+        )
+        while not q.finished:
+            r = self.gh_gql.get_one(lambda: self._gen_query(q))
+            if r is None:
+                return False
+            self._logger.debug(f"Got response: rateLimit {r['rateLimit']}")
+            try:
+                q.update_state(r)
+            except Exception as e:
+                self._logger.error(f"Exception while updating state: {e}")
+                return False
+        return True
+
+    def fetch(self) -> List[str]:
+        """
+        Runs the queries.
+        If a batch fails (e.g., one of its users does not exist), the callbacks of its
+          users may have run on partial results, so callers should refetch them one by one.
+        :return: logins of users in failed batches
+        """
+        failed = []
+        for i in range(0, len(self._fetchers), self.batch_size):
+            batch = self._fetchers[i : i + self.batch_size]
+            self._logger.debug("Fetching metrics for %s", [f.login for f in batch])
+            if not self._fetch_batch(batch):
+                logins = [f.login for f in batch]
+                self._logger.error("Exception while fetching users %s", logins)
+                failed.extend(logins)
+        return failed
+
+
+class IssueTimelineFetcher(object):
+    # GraphQL timeline item types that are fetched with their actor and time,
+    #   along with additional fields (see IssueEvent) and their REST event names
+    TIMELINE_ITEMS = {
+        "IssueComment": ("commented", "createdAt\nauthor {\n  login\n}\nbody"),
+        "AssignedEvent": (
+            "assigned",
+            "assignee {\n  ... on Actor {\n    login\n  }\n}",
+        ),
+        "UnassignedEvent": (
+            "unassigned",
+            "assignee {\n  ... on Actor {\n    login\n  }\n}",
+        ),
+        "LabeledEvent": ("labeled", "label {\n  name\n}"),
+        "UnlabeledEvent": ("unlabeled", "label {\n  name\n}"),
+        "CrossReferencedEvent": (
+            "cross-referenced",
+            "source {\n  ... on Issue {\n    number\n  }\n  ... on PullRequest {\n    number\n  }\n}",
+        ),
+        "ReferencedEvent": ("referenced", "commit {\n  oid\n}"),
+        "RenamedTitleEvent": ("renamed", ""),
+        "ClosedEvent": ("closed", ""),
+        "ReopenedEvent": ("reopened", ""),
+        "MentionedEvent": ("mentioned", ""),
+        "SubscribedEvent": ("subscribed", ""),
+        "UnsubscribedEvent": ("unsubscribed", ""),
+        "MilestonedEvent": ("milestoned", ""),
+        "DemilestonedEvent": ("demilestoned", ""),
+        "LockedEvent": ("locked", ""),
+        "UnlockedEvent": ("unlocked", ""),
+        "PinnedEvent": ("pinned", ""),
+        "UnpinnedEvent": ("unpinned", ""),
+        "TransferredEvent": ("transferred", ""),
+        "ConnectedEvent": ("connected", ""),
+        "DisconnectedEvent": ("disconnected", ""),
+        "MarkedAsDuplicateEvent": ("marked_as_duplicate", ""),
+        "UnmarkedAsDuplicateEvent": ("unmarked_as_duplicate", ""),
+        "CommentDeletedEvent": ("comment_deleted", ""),
+        "ConvertedNoteToIssueEvent": ("converted_note_to_issue", ""),
+        "UserBlockedEvent": ("user_blocked", ""),
+    }
+
+    @staticmethod
+    def _rest_event_type(typename: str) -> str:
+        """Converts a GraphQL timeline item type to a REST timeline event name"""
+        if typename in IssueTimelineFetcher.TIMELINE_ITEMS:
+            return IssueTimelineFetcher.TIMELINE_ITEMS[typename][0]
+        name = typename[: -len("Event")] if typename.endswith("Event") else typename
+        return re.sub(r"(?<!^)(?=[A-Z])", "_", name).lower()
+
+    @staticmethod
+    def to_issue_event(item: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Converts a GraphQL timeline item to the IssueEvent dict returned by
+          RepoFetcher.get_issue_detail()
+        """
+        typename = item["__typename"]
+        event_type = IssueTimelineFetcher._rest_event_type(typename)
+        t = item.get("createdAt")
+        t = parse_date(t).astimezone(timezone.utc) if t is not None else None
+        actor = item.get("author") if typename == "IssueComment" else item.get("actor")
+        actor = actor["login"] if actor is not None else None
+
+        additional_props = {}
+        if event_type in ["assigned", "unassigned"]:
+            if item["assignee"] is not None and "login" in item["assignee"]:
+                additional_props["assignee"] = item["assignee"]["login"]
+        elif event_type in ["labeled", "unlabeled"]:
+            additional_props["label"] = item["label"]["name"]
+        elif event_type == "commented":
+            additional_props["comment"] = item["body"]
+            additional_props["commenter"] = actor
+        elif event_type == "cross-referenced":
+            additional_props["source"] = item["source"].get("number")
+        elif event_type == "referenced":
+            if item["commit"] is not None:
+                additional_props["commit"] = item["commit"]["oid"]
+        return {"type": event_type, "time": t, "actor": actor, **additional_props}
+
+    def __init__(
+        self,
+        token: str,
+        owner: str,
+        name: str,
+        batch_size: int = 50,
+        per_page: int = 100,
+    ) -> None:
+        """
+        Fetches issue timelines of a repository, many issues per GraphQL query
+        :param token: {str} GitHub token
+        :param owner: {str} repository owner
+        :param name: {str} repository name
+        :param batch_size: {int} number of issues (aliases) in one query
+        :param per_page: {int} number of timeline items per issue per query
+
+        >>> tf = IssueTimelineFetcher("token", "owner", "name")
+        >>> tf.fetch([1, 2])
+        {1: [{'type': 'labeled', 'time': ..., 'actor': ..., 'label': ...}, ...], 2: [...]}
+        """
+        self.gh_gql = get_client(token)
+        self.owner = owner
+        self.name = name
+        self.batch_size = batch_size
+        self.per_page = per_page
+        self.rate_consumed = 0
+
+        self._logger = logging.getLogger(__name__)
+
+    def _timeline_nodes(self) -> str:
+        fragments = []
+        for typename, (_, fields) in self.TIMELINE_ITEMS.items():
+            if typename == "IssueComment":
+                fragment_fields = fields
+            else:
+                fragment_fields = "createdAt\nactor {\n  login\n}\n" + fields
+            fragments.append(
+                "... on %s {\n%s\n}"
+                % (typename, GraphQLQueryComponent._add_indent(fragment_fields.strip()))
+            )
+        return "nodes {\n  __typename\n%s\n}" % GraphQLQueryComponent._add_indent(
+            "\n".join(fragments)
+        )
+
+    def _build_query(
+        self,
+        numbers: List[int],
+        results: Dict[int, List[Dict[str, Any]]],
+        cursors: Dict[int, str or None] = None,
+    ) -> GraphQLQueryComponent:
+        """
+        :param numbers: {List[int]} issue numbers
+        :param results: {Dict[int, List]} timeline events are appended to results[number]
+        :param cursors: {Dict[int, str]} timeline cursor of each issue (optional),
+            only items after the cursor are fetched and the cursor is advanced in place
+        """
+        if cursors is None:
+            cursors = {}
+
+        def on_timeline(number: int) -> Callable[[Dict[str, Any]], None]:
+            def callback(res: Dict[str, Any]) -> None:
+                # items without a fragment only have a type, with no time or actor
+                results[number].extend(
+                    self.to_issue_event(item)
+                    for item in res["nodes"]
+                    if item["__typename"] in self.TIMELINE_ITEMS
+                )
+                # endCursor is null if there are no new items
+                if res["pageInfo"]["endCursor"] is not None:
+                    cursors[number] = res["pageInfo"]["endCursor"]
+
+            return callback
+
+        def timeline_args(number: int) -> Dict[str, Any]:
+            if cursors.get(number) is None:
+                return {"first": self.per_page}
+            return {"first": self.per_page, "after": cursors[number]}
+
+        def on_query(res: Dict[str, Any]) -> None:
+            self.rate_consumed += res["rateLimit"]["cost"]
+
+        nodes = self._timeline_nodes()
+        return GraphQLQueryComponent(
+            "query",
+            {},
+            on_query,
+            "rateLimit {\n  cost\n  limit\n  remaining\n  resetAt\n}",
+            GraphQLQueryComponent(
+                "repository",
+                {"owner": self.owner, "name": self.name},
+                None,
+                *[
+                    GraphQLQueryComponent(
+                        "issue",
+                        {"number": number},
+                        None,
+                        GraphQLQueryPagedComponent(
+                            "timelineItems",
+                            timeline_args(number),
+                            on_timeline(number),
+                            nodes,
+                        ),
+                        alias=f"issue{number}",
+                    )
+                    for number in numbers
+                ],
+            ),
+        )
+
+    def fetch(
+        self, numbers: List[int], cursors: Dict[int, str or None] = None
+    ) -> Dict[int, List[Dict[str, Any]]]:
+        """
+        Fetches timelines for the given issue numbers.
+        Issues that fail in a batch (e.g., deleted or transferred) are dropped and
+          the rest of the batch is queried again. Failed issues, and all issues of
+          a batch that fails as a whole, are left out of the results so that
+          callers can fall back to REST.
+        :param cursors: {Dict[int, str]} timeline cursor of each issue (optional),
+            if given, only events after the cursors are fetched, and the cursors of
+            successfully fetched issues are advanced in place to their last event
+        :return: {issue number: list of IssueEvent dicts}
+        """
+        all_results = {}
+        for i in range(0, len(numbers), self.batch_size):
+            batch = numbers[i : i + self.batch_size]
+            results = {number: [] for number in batch}
+            batch_cursors = {n: cursors.get(n) for n in batch} if cursors else {}
+            q = self._build_query(batch, results, batch_cursors)
+            while not q.finished:
+                r = self.gh_gql.get_one(q.gen_query(False), partial=True)
+                if r is None or r.get("repository") is None:
+                    self._logger.error(
+                        "Failed to fetch timelines for %s/%s issues %s",
+                        self.owner,
+                        self.name,
+                        batch,
+                    )
+                    results = {}
+                    break
+                failed = [
+                    n
+                    for n in batch
+                    if f"issue{n}" in r["repository"]
+                    and r["repository"][f"issue{n}"] is None
+                ]
+                if len(failed) == 0:
+                    q.update_state(r)
+                    continue
+                # the query is started over without the failed issues
+                self._logger.warning(
+                    "Failed to fetch timelines for %s/%s issues %s",
+                    self.owner,
+                    self.name,
+                    failed,
+                )
+                if r.get("rateLimit"):
+                    self.rate_consumed += r["rateLimit"]["cost"]
+                batch = [n for n in batch if n not in failed]
+                results = {number: [] for number in batch}
+                if len(batch) == 0:
+                    break
+                batch_cursors = {n: cursors.get(n) for n in batch} if cursors else {}
+                q = self._build_query(batch, results, batch_cursors)
+            self._logger.debug(
+                "Fetched timelines for %d issues, cost = %d",
+                len(results),
+                self.rate_consumed,
+            )
+            all_results.update(results)
+            if cursors is not None and len(results) > 0:
+                cursors.update(batch_cursors)
+        return all_results
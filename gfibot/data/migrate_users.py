@@ -0,0 +1,81 @@
+import logging
+
+from typing import List, Dict, Any
+
+from gfibot.collections import *
+from gfibot.data.update import (
+    USER_CONTRIBUTION_KEYS,
+    _bulk_upsert,
+    _connect_mongodb,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# contribution lists that used to be embedded in User, and their kind
+EMBEDDED_CONTRIBUTIONS = {
+    "issues": "issue",
+    "pulls": "pull",
+    "pull_reviews": "review",
+    "commit_contributions": "commit",
+}
+# max number of users migrated between two progress logs
+MIGRATION_BATCH_SIZE = 100
+
+
+def _embedded_contributions(user: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    """Contributions embedded in a raw User document, by kind"""
+    contributions = {}
+    for field, kind in EMBEDDED_CONTRIBUTIONS.items():
+        contributions[kind] = [
+            {
+                "login": user["login"],
+                "kind": kind,
+                "owner": item["owner"],
+                "name": item["name"],
+                "repo_stars": item["repo_stars"],
+                "number": item.get("number"),
+                "state": item.get("state"),
+                "commit_count": item.get("commit_count"),
+                "created_at": item["created_at"],
+            }
+            for item in user.get(field, [])
+        ]
+    return contributions
+
+
+def migrate_user_contributions() -> int:
+    """
+    Move contributions embedded in User documents to UserContribution, and drop
+      the embedded lists along with their indexes.
+    Users are unset one by one after their contributions are written,
+      so the migration can be interrupted and run again.
+    :return: number of users migrated
+    """
+    collection = User._get_collection()
+    for index, info in collection.index_information().items():
+        if any(key.split(".")[0] in EMBEDDED_CONTRIBUTIONS for key, _ in info["key"]):
+            logger.info("Dropping index %s of User", index)
+            collection.drop_index(index)
+
+    query = {"$or": [{field: {"$exists": True}} for field in EMBEDDED_CONTRIBUTIONS]}
+    projection = ["login", *EMBEDDED_CONTRIBUTIONS.keys()]
+    migrated = 0
+    for user in collection.find(query, projection):
+        for kind, docs in _embedded_contributions(user).items():
+            _bulk_upsert(UserContribution, USER_CONTRIBUTION_KEYS[kind], docs)
+        collection.update_one(
+            {"_id": user["_id"]},
+            {"$unset": {field: "" for field in EMBEDDED_CONTRIBUTIONS}},
+        )
+        migrated += 1
+        if migrated % MIGRATION_BATCH_SIZE == 0:
+            logger.info("%d users migrated", migrated)
+
+    logger.info("Contributions of %d users moved to UserContribution", migrated)
+    return migrated
+
+
+if __name__ == "__main__":
+    _connect_mongodb()
+    migrate_user_contributions()
@@ -0,0 +1,426 @@
+"""
+Record GitHub API responses and replay them from a local stand-in server,
+  so that the fetch pipeline can be benchmarked without hitting GitHub.
+
+Record responses of a full update (needs a valid token in tokens.txt):
+    python -m gfibot.data.replay --repo octocat/hello-world --path .cache/replay/hello-world --record
+Benchmark update_repo against the recorded responses:
+    python -m gfibot.data.replay --repo octocat/hello-world --path .cache/replay/hello-world --latency 0.05
+"""
+
+import re
+import json
+import time
+import hashlib
+import logging
+import argparse
+import threading
+import mongoengine
+
+from typing import Any, Dict, List, Optional, Tuple
+from pathlib import Path
+from functools import wraps
+from collections import Counter
+from urllib.parse import urlparse, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pymongo import monitoring
+from requests import PreparedRequest, Response
+from requests.adapters import HTTPAdapter
+
+from gfibot import CONFIG, TOKENS, github_client
+
+logger = logging.getLogger(__name__)
+
+RESPONSES_FILE = "responses.jsonl"
+
+# stands for the API root in recorded bodies and headers, replaced when served
+BASE_URL_PLACEHOLDER = "{base_url}"
+
+# response headers worth recording, rate limit headers are made up by the server
+RECORDED_HEADERS = ["content-type", "link", "etag", "last-modified"]
+
+# timestamps in queries depend on when they are sent, e.g., contribution windows
+_TIME_PATTERN = re.compile(
+    r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:?\d{2})?"
+)
+
+
+def request_key(method: str, url: str, body: Any = None) -> str:
+    """
+    Identifies a request by its method, path, query and body, ignoring host and
+      timestamps. Recorded responses of a key are replayed in the recorded order.
+    """
+    parsed = urlparse(url)
+    query = "&".join(
+        f"{k}={_TIME_PATTERN.sub('<time>', v)}"
+        for k, v in sorted(parse_qsl(parsed.query, keep_blank_values=True))
+    )
+    key = f"{method} {parsed.path}?{query}"
+    if body:
+        if isinstance(body, bytes):
+            body = body.decode("utf-8", errors="replace")
+        try:
+            body = json.dumps(json.loads(body), sort_keys=True)
+        except ValueError:
+            pass
+        body = _TIME_PATTERN.sub("<time>", body)
+        key += " " + hashlib.sha1(body.encode("utf-8")).hexdigest()
+    return key
+
+
+class Recorder(object):
+    """Records responses of GitHub API requests sent through requests"""
+
+    def __init__(self, path: str, api_url: Optional[str] = None):
+        """
+        :param path: directory to write recorded responses to
+        :param api_url: root of the recorded API (defaults to github_api_url in config)
+        """
+        self.path = Path(path)
+        api_url = api_url if api_url else github_client.GITHUB_API_URL
+        self.api_url = api_url.rstrip("/")
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._send = None
+
+    def __enter__(self) -> "Recorder":
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path / RESPONSES_FILE, "a", encoding="utf-8")
+        self._send = HTTPAdapter.send
+        recorder = self
+
+        def send(adapter: HTTPAdapter, request: PreparedRequest, **kwargs):
+            response = recorder._send(adapter, request, **kwargs)
+            recorder.record(request, response)
+            return response
+
+        HTTPAdapter.send = send
+        return self
+
+    def __exit__(self, *args) -> None:
+        HTTPAdapter.send = self._send
+        self._file.close()
+
+    def record(self, request: PreparedRequest, response: Response) -> None:
+        if not request.url.startswith(self.api_url) or response.status_code == 304:
+            return
+        headers = {
+            k.lower(): v.replace(self.api_url, BASE_URL_PLACEHOLDER)
+            for k, v in response.headers.items()
+            if k.lower() in RECORDED_HEADERS
+        }
+        entry = {
+            "key": request_key(
+                request.method, request.url[len(self.api_url) :], request.body
+            ),
+            "status": response.status_code,
+            "headers": headers,
+            "body": response.content.decode("utf-8", errors="replace").replace(
+                self.api_url, BASE_URL_PLACEHOLDER
+            ),
+        }
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            self.recorded += 1
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _replay(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length > 0 else None
+        status, headers, data = self.server.replay.respond(
+            self.command, self.path, self.headers, body
+        )
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _replay
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class ReplayServer(object):
+    """
+    A local stand-in for the GitHub API serving recorded responses,
+      with per-token rate limit headers and a configurable latency
+    """
+
+    def __init__(
+        self,
+        path: str,
+        latency: float = 0.0,
+        rate_limit: int = 5000,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        """
+        :param path: directory of recorded responses
+        :param latency: seconds to wait before each response
+        :param rate_limit: requests allowed per token and resource in an hour,
+            requests beyond it get a rate limit error like GitHub does
+        :param host, port: address to listen on, port 0 picks a free port
+        """
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.requests = Counter()  # requests served by resource (core / graphql)
+        self.missing = Counter()  # requests without recorded responses by key
+
+        self._responses: Dict[str, List[Dict[str, Any]]] = {}
+        with open(Path(path) / RESPONSES_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                self._responses.setdefault(entry["key"], []).append(entry)
+        self._served = Counter()
+        self._remaining: Dict[Tuple[str, str], int] = {}
+        self._reset_at = int(time.time()) + 3600
+        self._lock = threading.Lock()
+
+        self._server = ThreadingHTTPServer((host, port), _ReplayHandler)
+        self._server.daemon_threads = True
+        self._server.replay = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info("Replaying %d requests at %s", len(self._responses), self.url)
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self) -> "ReplayServer":
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def respond(
+        self, method: str, path: str, headers: Any, body: Optional[bytes]
+    ) -> Tuple[int, Dict[str, str], bytes]:
+        """:return: status, headers and body of the response to a request"""
+        time.sleep(self.latency)
+        resource = "graphql" if path.startswith("/graphql") else "core"
+        key = request_key(method, path, body)
+        with self._lock:
+            self.requests[resource] += 1
+            quota = (headers.get("Authorization", ""), resource)
+            remaining = self._remaining.get(quota, self.rate_limit)
+            self._remaining[quota] = max(0, remaining - 1)
+            entry = None
+            if key in self._responses:
+                entries = self._responses[key]
+                entry = entries[min(self._served[key], len(entries) - 1)]
+                self._served[key] += 1
+            else:
+                self.missing[key] += 1
+
+        rate_headers = {
+            "X-RateLimit-Limit": str(self.rate_limit),
+            "X-RateLimit-Remaining": str(max(0, remaining - 1)),
+            "X-RateLimit-Reset": str(self._reset_at),
+            "X-RateLimit-Used": str(self.rate_limit - max(0, remaining - 1)),
+            "X-RateLimit-Resource": resource,
+        }
+        if remaining <= 0:
+            message = {"message": "API rate limit exceeded (replay server)"}
+            return 403, rate_headers, json.dumps(message).encode("utf-8")
+        if entry is None:
+            logger.warning("No recorded response for %s", key)
+            return 404, rate_headers, json.dumps({"message": "Not Found"}).encode()
+
+        response_headers = {
+            k: v.replace(BASE_URL_PLACEHOLDER, self.url)
+            for k, v in entry["headers"].items()
+        }
+        etag = response_headers.get("etag")
+        if etag is not None and headers.get("If-None-Match") == etag:
+            return 304, {**rate_headers, "etag": etag}, b""
+        data = entry["body"].replace(BASE_URL_PLACEHOLDER, self.url).encode("utf-8")
+        return entry["status"], {**response_headers, **rate_headers}, data
+
+
+class _WriteCounter(monitoring.CommandListener):
+    """Counts MongoDB write commands and the documents they write"""
+
+    WRITE_COMMANDS = {"insert": "documents", "update": "updates", "delete": "deletes"}
+
+    def __init__(self):
+        self.commands = 0
+        self.documents = 0
+        self._lock = threading.Lock()
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        if event.command_name in self.WRITE_COMMANDS:
+            n = len(event.command.get(self.WRITE_COMMANDS[event.command_name], []))
+        elif event.command_name == "findAndModify":
+            n = 1
+        else:
+            return
+        with self._lock:
+            self.commands += 1
+            self.documents += n
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        pass
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        pass
+
+
+# functions called by update_repo and the phases they stand for
+PHASES = {
+    "_update_repo_info": "repo_info",
+    "_update_stars": "stars",
+    "_update_commits": "commits",
+    "_update_issues": "issues",
+    "_update_resolved_issues": "resolved_issues",
+    "_update_open_issues": "open_issues",
+    "update_users": "users",
+    "_update_repo_stats": "repo_stats",
+}
+
+
+def benchmark(
+    owner: str, name: str, path: str, latency: float = 0.0, rate_limit: int = 5000
+) -> Dict[str, Dict[str, float]]:
+    """
+    Run update_repo end to end against recorded responses on an empty database
+      (the configured database name suffixed with -benchmark)
+    :return: {phase: {"requests", "seconds", "write_commands", "written_documents"}}
+    """
+    import gfibot.data.update as update
+
+    writes = _WriteCounter()
+    monitoring.register(writes)  # must be registered before connecting
+    mongoengine.disconnect_all()
+    mongoengine.connect(
+        CONFIG["mongodb"]["db"] + "-benchmark",
+        host=CONFIG["mongodb"]["url"],
+        tz_aware=True,
+        uuidRepresentation="standard",
+    )
+    db = mongoengine.get_db()
+    db.client.drop_database(db.name)
+
+    stats: Dict[str, Dict[str, float]] = {}
+    server = ReplayServer(path, latency, rate_limit)
+
+    def measure(func, phase: str):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            requests, commands, documents = (
+                sum(server.requests.values()),
+                writes.commands,
+                writes.documents,
+            )
+            begin = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats[phase] = {
+                    "requests": sum(server.requests.values()) - requests,
+                    "seconds": time.time() - begin,
+                    "write_commands": writes.commands - commands,
+                    "written_documents": writes.documents - documents,
+                }
+
+        return wrapper
+
+    originals = {f: getattr(update, f) for f in PHASES}
+    api_url = github_client.GITHUB_API_URL
+    with server:
+        # REST, GraphQL and pooled requests all take the API root from github_client
+        github_client.GITHUB_API_URL = server.url
+        for f, phase in PHASES.items():
+            setattr(update, f, measure(originals[f], phase))
+        try:
+            begin = time.time()
+            update.update_repo("replay-token", owner, name)
+            total = time.time() - begin
+        finally:
+            github_client.GITHUB_API_URL = api_url
+            for f, func in originals.items():
+                setattr(update, f, func)
+
+    stats["total"] = {
+        "requests": sum(server.requests.values()),
+        "seconds": total,
+        "write_commands": writes.commands,
+        "written_documents": writes.documents,
+    }
+    if len(server.missing) > 0:
+        logger.warning(
+            "%d requests had no recorded response, e.g., %s",
+            sum(server.missing.values()),
+            list(server.missing)[:3],
+        )
+    return stats
+
+
+def record(owner: str, name: str, path: str) -> int:
+    """
+    Record responses of a full update_repo run against GitHub, starting from
+      an empty database so that the benchmark sends the same requests
+    :return: number of recorded responses
+    """
+    from gfibot.data.update import update_repo
+
+    mongoengine.connect(
+        CONFIG["mongodb"]["db"] + "-benchmark",
+        host=CONFIG["mongodb"]["url"],
+        tz_aware=True,
+        uuidRepresentation="standard",
+    )
+    db = mongoengine.get_db()
+    db.client.drop_database(db.name)
+    with Recorder(path) as recorder:
+        update_repo(TOKENS[0], owner, name)
+    return recorder.recorded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("GFI-Bot Fetch Benchmark")
+    parser.add_argument("--repo", type=str, required=True, help="owner/name")
+    parser.add_argument("--path", type=str, required=True, help="recording directory")
+    parser.add_argument(
+        "--record", action="store_true", default=False, help="record from GitHub"
+    )
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds/request")
+    parser.add_argument("--rate_limit", type=int, default=5000, help="requests/hour")
+    args = parser.parse_args()
+
+    owner, name = args.repo.split("/")
+    if args.record:
+        n = record(owner, name, args.path)
+        logger.info("Recorded %d responses to %s", n, args.path)
+    else:
+        results = benchmark(owner, name, args.path, args.latency, args.rate_limit)
+        logger.info(
+            "%-16s %9s %9s %9s %9s", "phase", "requests", "seconds", "writes", "docs"
+        )
+        for phase, s in results.items():
+            logger.info(
+                "%-16s %9d %9.2f %9d %9d",
+                phase,
+                s["requests"],
+                s["seconds"],
+                s["write_commands"],
+                s["written_documents"],
+            )
@@ -1,18 +1,56 @@
+import re
+import json
 import time
+import base64
 import logging
+import threading
 
 from typing import *
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from calendar import monthrange
+from urllib.parse import urlencode
 from dateutil.parser import parse as parse_date
 from github import Github
-from github import RateLimitExceededException, UnknownObjectException
+from github import GithubException, RateLimitExceededException, UnknownObjectException
 from github.GithubObject import NotSet
+from github.PaginatedList import PaginatedList
+from github.Repository import Repository
+
+from gfibot import CONFIG, github_client
+from gfibot.collections import HttpCache
+from gfibot.token_broker import report_quota
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:  # orjson is optional, the standard library is only slower
+    _loads = json.loads
 
 
 T = TypeVar("T")
 logger = logging.getLogger(__name__)
 
+# how many pages of a list endpoint are fetched concurrently under one token
+try:
+    PAGE_WORKERS = CONFIG["gfibot"]["page_workers"]
+except KeyError:
+    PAGE_WORKERS = 1
+
+# fetch stars, commits and issues as raw JSON instead of PyGithub objects
+try:
+    RAW_PAGES = CONFIG["gfibot"]["raw_pages"]
+except KeyError:
+    RAW_PAGES = True
+
+# longest wait for a rate limit reset before a raw page request gives up
+RATE_LIMIT_WAIT = 3600
+
+_LAST_PAGE = re.compile(r'<[^>]*[?&]page=(\d+)[^>]*>;\s*rel="last"')
+
 
 def get_page_num(per_page: int, total_count: int) -> int:
     """Calculate total number of pages given page size and total number of items"""
@@ -22,6 +60,19 @@ def get_page_num(per_page: int, total_count: int) -> int:
     return total_count // per_page + 1
 
 
+def get_last_page(link: Optional[str]) -> Optional[int]:
+    """Get the (1-based) last page in a Link header, None if there is none"""
+    match = _LAST_PAGE.search(link) if link else None
+    return int(match.group(1)) if match else None
+
+
+def parse_github_date(date: Optional[str]) -> Optional[datetime]:
+    """Parse a timestamp in GitHub API responses, e.g., 2022-01-01T00:00:00Z"""
+    if date is None:
+        return None
+    return datetime.fromisoformat(date.replace("Z", "+00:00")).astimezone(timezone.utc)
+
+
 def get_month_interval(date: datetime) -> Tuple[datetime, datetime]:
     if date.tzinfo is None:
         logger.warning("date is not timezone aware: {}".format(date))
@@ -66,74 +117,405 @@ def request_github(
 class RepoFetcher(object):
     """Fetches repository data from GitHub"""
 
-    def __init__(self, token: str, owner: str, name: str):
-        self.gh = Github(token)
+    def __init__(
+        self,
+        token: str,
+        owner: str,
+        name: str,
+        n_workers: int = None,
+        use_cache: bool = True,
+        raw: bool = None,
+    ):
+        """
+        :param token: GitHub access token
+        :param owner: repository owner
+        :param name: repository name
+        :param n_workers: max number of pages fetched concurrently for list endpoints,
+            pages are always returned in order (defaults to PAGE_WORKERS)
+        :param use_cache: revalidate repository stats, issue timelines and pull request
+            details against HttpCache instead of downloading them again
+        :param raw: fetch stars, commits and issues as raw JSON mapped straight into
+            dicts, instead of PyGithub objects (defaults to RAW_PAGES)
+        """
+        self.token = token
+        self.n_workers = max(1, n_workers if n_workers is not None else PAGE_WORKERS)
+        self.use_cache = use_cache
+        self.raw = raw if raw is not None else RAW_PAGES
+        self.gh = Github(
+            token,
+            base_url=github_client.GITHUB_API_URL,
+            retry=github_client.connection_retry(),
+        )
         self.gh.per_page = 100  # minimize rate limit consumption
         self.repo = request_github(self.gh, lambda: self.gh.get_repo(f"{owner}/{name}"))
         self.owner = self.repo.owner.login
         self.name = self.repo.name
+        self._api_path = f"/repos/{self.owner}/{self.name}"
         self.rate_remaining, self.rate_limit = request_github(
             self.gh, lambda: self.gh.rate_limiting
         )
         self.rate_consumed = 0
 
+        # PyGithub connections are not thread safe, so each worker gets its own client
+        self._local = threading.local()
+        self._worker_ghs: List[Github] = []
+        self._worker_lock = threading.Lock()
+        # (remaining, limit, reset time) in the latest raw page response
+        self._raw_rate: Optional[Tuple[int, int, int]] = None
+
     @property
     def rate(self) -> Tuple[int, int, int]:
         return (self.rate_remaining, self.rate_limit, self.rate_consumed)
 
+    def _get_rate_limiting(self) -> Tuple[int, int, int]:
+        """
+        Rate limit and reset time of the token as seen in the latest response of any client.
+        Remaining quota only decreases within a rate limit window, so the latest
+          response is the one with the latest reset time and the fewest requests left.
+        """
+        with self._worker_lock:
+            ghs = [self.gh] + self._worker_ghs
+            raw_rate = self._raw_rate
+        known = [
+            (*gh.rate_limiting, gh.rate_limiting_resettime)
+            for gh in ghs
+            if gh.rate_limiting[0] >= 0
+        ]
+        if raw_rate is not None:
+            known.append(raw_rate)
+        if len(known) == 0:
+            return (*self.gh.rate_limiting, self.gh.rate_limiting_resettime)
+        reset_time = max(r[2] for r in known)
+        return min((r for r in known if r[2] == reset_time), key=lambda r: r[0])
+
     def _update_rate_stats(self) -> None:
         prev = self.rate_remaining
-        self.rate_remaining, self.rate_limit = request_github(
-            self.gh, lambda: self.gh.rate_limiting
+        self.rate_remaining, self.rate_limit, reset_time = request_github(
+            self.gh, self._get_rate_limiting
+        )
+        report_quota(
+            self.token,
+            "rest",
+            self.rate_remaining,
+            self.rate_limit,
+            datetime.fromtimestamp(reset_time, timezone.utc),
         )
         if prev >= self.rate_remaining:
             self.rate_consumed += prev - self.rate_remaining
         else:
             self.rate_consumed += prev + self.rate_limit - self.rate_remaining
 
+    def _get_worker_repo(self) -> Tuple[Github, Repository]:
+        """Get a GitHub client and repository owned by the current worker thread"""
+        if getattr(self._local, "gh", None) is None:
+            gh = Github(
+                self.token,
+                base_url=github_client.GITHUB_API_URL,
+                retry=github_client.connection_retry(),
+            )
+            gh.per_page = self.gh.per_page
+            self._local.gh = gh
+            self._local.repo = gh.get_repo(f"{self.owner}/{self.name}", lazy=True)
+            with self._worker_lock:
+                self._worker_ghs.append(gh)
+        return self._local.gh, self._local.repo
+
+    def _get_pages(
+        self,
+        get_list: Callable[[Repository], PaginatedList],
+        pages: Iterable[int],
+    ) -> Iterator[list]:
+        """
+        Yields the given pages of a paginated list in order.
+        Up to n_workers pages are requested concurrently, ahead of the consumer.
+        :param get_list: builds the paginated list from a repository object
+        :param pages: page indexes to fetch
+        """
+        if self.n_workers <= 1:
+            items = get_list(self.repo)
+            return self._map_pages(
+                lambda p: request_github(self.gh, items.get_page, (p,), []), pages
+            )
+
+        def fetch_page(p: int) -> list:
+            gh, repo = self._get_worker_repo()
+            return request_github(gh, get_list(repo).get_page, (p,), [])
+
+        return self._map_pages(fetch_page, pages)
+
+    def _map_pages(
+        self, fetch_page: Callable[[int], list], pages: Iterable[int]
+    ) -> Iterator[list]:
+        """
+        Yields fetch_page(p) for the given pages in order.
+        Up to n_workers pages are requested concurrently, ahead of the consumer.
+        """
+        if self.n_workers <= 1:
+            for p in pages:
+                yield fetch_page(p)
+            return
+
+        executor = ThreadPoolExecutor(max_workers=self.n_workers)
+        futures = deque()
+        try:
+            for p in pages:
+                futures.append(executor.submit(fetch_page, p))
+                if len(futures) >= self.n_workers:
+                    yield futures.popleft().result()
+            while len(futures) > 0:
+                yield futures.popleft().result()
+        finally:
+            # the consumer may stop early, do not fetch pages nobody will read
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _request_json(
+        self, path: str, params: Dict[str, Any] = None, headers: Dict[str, str] = None
+    ) -> Any:
+        """
+        GET a GitHub API path and decode the JSON response.
+        If a response for the same URL is cached, it is revalidated with
+          If-None-Match / If-Modified-Since, and a 304 response (which does not count
+          against the rate limit) is served from the cache.
+        Raises the same exceptions as PyGithub, so wrap calls in request_github().
+        """
+        params = params if params else {}
+        headers = dict(headers) if headers else {}
+        url = (
+            path if len(params) == 0 else f"{path}?{urlencode(sorted(params.items()))}"
+        )
+
+        cached = HttpCache.objects(url=url).first() if self.use_cache else None
+        if cached is not None:
+            if cached.etag is not None:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified is not None:
+                headers["If-Modified-Since"] = cached.last_modified
+
+        resp_headers, data = self.repo._requester.requestJsonAndCheck(
+            "GET", path, parameters=params, headers=headers
+        )
+        if data is None and cached is not None:  # 304 Not Modified
+            logger.debug("%s not modified", url)
+            cached.update(updated_at=datetime.now(timezone.utc))
+            return json.loads(cached.data)
+
+        if self.use_cache and (
+            "etag" in resp_headers or "last-modified" in resp_headers
+        ):
+            HttpCache.objects(url=url).upsert_one(
+                etag=resp_headers.get("etag"),
+                last_modified=resp_headers.get("last-modified"),
+                data=json.dumps(data),
+                updated_at=datetime.now(timezone.utc),
+            )
+        return data
+
+    def _request_all_pages(
+        self, path: str, params: Dict[str, Any] = None, headers: Dict[str, str] = None
+    ) -> Optional[list]:
+        """
+        GET all pages of a list endpoint, each page is cached separately.
+        Returns None if the first page cannot be fetched.
+        """
+        results = []
+        p = 1
+        while True:
+            page_params = {**(params if params else {}), "page": p}
+            page_params["per_page"] = self.gh.per_page
+            page = request_github(
+                self.gh, self._request_json, (path, page_params, headers)
+            )
+            if page is None:
+                return None if p == 1 else results
+            results.extend(page)
+            if len(page) < self.gh.per_page:
+                return results
+            p += 1
+
     def get_stats(self) -> dict[str, Any]:
-        results = request_github(
+        languages = request_github(
+            self.gh, self._request_json, (f"{self._api_path}/languages",), {}
+        )
+        topics = request_github(
             self.gh,
-            lambda: {
-                "owner": self.repo.owner.login,
-                "name": self.repo.name,
-                "language": self.repo.language,
-                "languages": self.repo.get_languages(),
-                "repo_created_at": self.repo.created_at.astimezone(timezone.utc),
-                "description": self.repo.description,
-                "topics": self.repo.get_topics(),
-                "readme": self.repo.get_readme().decoded_content.decode(
-                    "utf-8", "ignore"
-                ),
-            },
+            self._request_json,
+            (
+                f"{self._api_path}/topics",
+                None,
+                {"Accept": "application/vnd.github.mercy-preview+json"},
+            ),
+            {},
+        )
+        readme = request_github(
+            self.gh, self._request_json, (f"{self._api_path}/readme",)
         )
+        if readme is not None and readme.get("encoding") == "base64":
+            readme = base64.b64decode(readme["content"]).decode("utf-8", "ignore")
+        elif readme is not None:
+            readme = readme.get("content")
+        results = {
+            "owner": self.repo.owner.login,
+            "name": self.repo.name,
+            "language": self.repo.language,
+            "languages": languages,
+            "repo_created_at": self.repo.created_at.astimezone(timezone.utc),
+            "description": self.repo.description,
+            "topics": topics.get("names", []),
+            "readme": readme,
+        }
         self._update_rate_stats()
         return results
 
-    def get_stars(self, since: datetime) -> List[dict[str, Any]]:
-        results = []
-        stars = request_github(
-            self.gh, lambda: self.repo.get_stargazers_with_dates(), default=[]
-        ).reversed
-        page_num = request_github(
-            self.gh, lambda: get_page_num(self.gh.per_page, stars.totalCount), default=0
+    def _request_page(
+        self,
+        path: str,
+        params: Dict[str, Any],
+        page: int,
+        headers: Dict[str, str] = None,
+    ) -> Tuple[list, int]:
+        """
+        GET a page of a list endpoint as raw JSON, skipping PyGithub objects.
+        The number of pages is read from the Link header, so no request is spent
+          on totalCount. Raises the same exceptions as PyGithub, so wrap calls
+          in request_github().
+        :param page: page index (0-based, like PaginatedList.get_page)
+        :return: items in the page, and the number of pages in the list
+        """
+        r = github_client.get(
+            self._api_path + path,
+            self.token,
+            params={**params, "per_page": self.gh.per_page, "page": page + 1},
+            headers=headers,
+            max_wait=RATE_LIMIT_WAIT,
+            track_quota=False,  # reported by _update_rate_stats()
+        )
+        if "X-RateLimit-Remaining" in r.headers:
+            rate = (
+                int(r.headers["X-RateLimit-Remaining"]),
+                int(r.headers["X-RateLimit-Limit"]),
+                int(r.headers["X-RateLimit-Reset"]),
+            )
+            with self._worker_lock:
+                # concurrent pages may complete out of order, keep the latest quota
+                if self._raw_rate is None or (rate[2], -rate[0]) > (
+                    self._raw_rate[2],
+                    -self._raw_rate[0],
+                ):
+                    self._raw_rate = rate
+        if r.status_code == 404:
+            raise UnknownObjectException(r.status_code, r.text, r.headers)
+        if r.status_code in (403, 429) and "rate limit" in r.text.lower():
+            raise RateLimitExceededException(r.status_code, r.text, r.headers)
+        if r.status_code >= 400:
+            raise GithubException(r.status_code, r.text, r.headers)
+
+        items = _loads(r.content)
+        last_page = get_last_page(r.headers.get("Link"))
+        if last_page is not None:
+            return items, last_page
+        # no rel="last" on the last page, or on an empty page past the end
+        return items, page + 1 if len(items) > 0 else page
+
+    def _get_raw_pages(
+        self,
+        path: str,
+        params: Dict[str, Any],
+        select_pages: Callable[[int], Sequence[int]],
+        probe_page: int = 0,
+        headers: Dict[str, str] = None,
+    ) -> Tuple[int, Sequence[int], Iterator[list]]:
+        """
+        Fetch one page of a list endpoint to learn the number of pages,
+          then yield the selected pages in order, reusing the probed page.
+        :param select_pages: maps the number of pages to the page indexes to fetch
+        :param probe_page: page index fetched first
+        :return: number of pages, selected page indexes, and an iterator of pages
+        """
+        probe, page_num = request_github(
+            self.gh, self._request_page, (path, params, probe_page, headers), ([], 0)
         )
-        for p in range(0, page_num):
-            logger.debug("star page %d/%d, rate %s", p, page_num, self.gh.rate_limiting)
-            for star in request_github(self.gh, stars.get_page, (p,), []):
-                starred_at = star.starred_at.astimezone(timezone.utc)
-                results.append(
-                    {
-                        "owner": self.owner,
-                        "name": self.name,
-                        "user": star.user.login,
-                        "starred_at": starred_at,
-                    }
-                )
-                if starred_at < since:
-                    return results
+        pages = select_pages(page_num)
+
+        def fetch_page(p: int) -> list:
+            if p == probe_page:
+                return probe
+            return request_github(
+                self.gh, self._request_page, (path, params, p, headers), ([], 0)
+            )[0]
+
+        return page_num, pages, self._map_pages(fetch_page, pages)
+
+    def iter_stars(
+        self, since: datetime, start_page: Optional[int] = None
+    ) -> Iterator[Tuple[int, List[Dict[str, Any]]]]:
+        """
+        Yields (page index, stars) from the newest page backwards,
+          until a star older than since is reached
+        :param start_page: resume from this page instead of the newest one
+        """
+
+        # Stargazers are listed from the oldest, so walk pages backwards
+        #   and stop as soon as we see a star older than since
+        def select_pages(page_num: int) -> List[int]:
+            last_page = (
+                page_num if start_page is None else min(page_num, start_page + 1)
+            )
+            return list(reversed(range(0, last_page)))
+
+        if self.raw:
+            page_num, pages, star_pages = self._get_raw_pages(
+                "/stargazers",
+                {},
+                select_pages,
+                headers={"Accept": "application/vnd.github.v3.star+json"},
+            )
+            get_star = lambda star: (
+                star["user"]["login"],
+                parse_github_date(star["starred_at"]),
+            )
+        else:
+            stars = request_github(
+                self.gh, lambda: self.repo.get_stargazers_with_dates(), default=[]
+            )
+            page_num = request_github(
+                self.gh,
+                lambda: get_page_num(self.gh.per_page, stars.totalCount),
+                default=0,
+            )
+            pages = select_pages(page_num)
+            star_pages = self._get_pages(
+                lambda repo: repo.get_stargazers_with_dates(), pages
+            )
+            get_star = lambda star: (
+                star.user.login,
+                star.starred_at.astimezone(timezone.utc),
+            )
+
+        with closing(star_pages):
+            for p, page in zip(pages, star_pages):
+                logger.debug("star page %d/%d, rate %s", p, page_num, self.rate)
+                results = []
+                reached_since = False
+                for star in reversed(page):
+                    user, starred_at = get_star(star)
+                    results.append(
+                        {
+                            "owner": self.owner,
+                            "name": self.name,
+                            "user": user,
+                            "starred_at": starred_at,
+                        }
+                    )
+                    if starred_at < since:
+                        reached_since = True
+                        break
+                yield p, results
+                if reached_since:
+                    break
         self._update_rate_stats()
-        return results
+
+    def get_stars(self, since: datetime) -> List[dict[str, Any]]:
+        return [star for _, page in self.iter_stars(since) for star in page]
 
     def get_commits_in_month(self, date: datetime) -> dict[str, Any]:
         since, until = get_month_interval(date)
@@ -145,138 +527,222 @@ class RepoFetcher(object):
         self._update_rate_stats()
         return results
 
-    def get_commits(self, since: datetime) -> List[dict[str, Any]]:
-        results = []
-        commits = request_github(
-            self.gh, lambda: self.repo.get_commits(since=since), default=[]
-        )
-        page_num = request_github(
-            self.gh,
-            lambda: get_page_num(self.gh.per_page, commits.totalCount),
-            default=0,
-        )
-        for p in range(0, page_num):
-            logger.debug(
-                "commit page %d/%d, rate %s", p, page_num, self.gh.rate_limiting
+    def _commit_to_dict(self, commit: Any) -> Dict[str, Any]:
+        try:
+            author = commit.author.login
+        except:
+            author = None
+        try:
+            committer = commit.committer.login
+        except:
+            committer = None
+        return {
+            "owner": self.owner,
+            "name": self.name,
+            "sha": commit.sha,
+            "author": author,
+            "authored_at": commit.commit.author.date.astimezone(timezone.utc),
+            "committer": committer,
+            "committed_at": commit.commit.committer.date.astimezone(timezone.utc),
+            "message": commit.commit.message,
+        }
+
+    def _raw_commit_to_dict(self, commit: Dict[str, Any]) -> Dict[str, Any]:
+        # author and committer are null if the email is not linked to a GitHub user
+        author, committer = commit.get("author"), commit.get("committer")
+        return {
+            "owner": self.owner,
+            "name": self.name,
+            "sha": commit["sha"],
+            "author": author["login"] if author else None,
+            "authored_at": parse_github_date(commit["commit"]["author"]["date"]),
+            "committer": committer["login"] if committer else None,
+            "committed_at": parse_github_date(commit["commit"]["committer"]["date"]),
+            "message": commit["commit"]["message"],
+        }
+
+    def iter_commits(
+        self, since: datetime, start_page: int = 0
+    ) -> Iterator[Tuple[int, List[Dict[str, Any]]]]:
+        """
+        Yields (page index, commits) of commits since the given time
+        :param start_page: resume from this page instead of the first one
+        """
+        if self.raw:
+            page_num, pages, commit_pages = self._get_raw_pages(
+                "/commits",
+                {
+                    "since": since.astimezone(timezone.utc).strftime(
+                        "%Y-%m-%dT%H:%M:%SZ"
+                    )
+                },
+                lambda page_num: range(start_page, page_num),
+                probe_page=start_page,
+            )
+            to_dict = self._raw_commit_to_dict
+        else:
+            commits = request_github(
+                self.gh, lambda: self.repo.get_commits(since=since), default=[]
+            )
+            page_num = request_github(
+                self.gh,
+                lambda: get_page_num(self.gh.per_page, commits.totalCount),
+                default=0,
             )
-            for commit in request_github(self.gh, commits.get_page, (p,), []):
-                try:
-                    author = commit.author.login
-                except:
-                    author = None
-                try:
-                    committer = commit.committer.login
-                except:
-                    committer = None
-                results.append(
-                    {
-                        "owner": self.owner,
-                        "name": self.name,
-                        "sha": commit.sha,
-                        "author": author,
-                        "authored_at": commit.commit.author.date.astimezone(
-                            timezone.utc
-                        ),
-                        "committer": committer,
-                        "committed_at": commit.commit.committer.date.astimezone(
-                            timezone.utc
-                        ),
-                        "message": commit.commit.message,
-                    }
-                )
+            pages = range(start_page, page_num)
+            commit_pages = self._get_pages(
+                lambda repo: repo.get_commits(since=since), pages
+            )
+            to_dict = self._commit_to_dict
+
+        with closing(commit_pages):
+            for p, page in zip(pages, commit_pages):
+                logger.debug("commit page %d/%d, rate %s", p, page_num, self.rate)
+                yield p, [to_dict(commit) for commit in page]
         self._update_rate_stats()
-        return results
 
-    def get_issues(self, since: datetime) -> List[dict[str, Any]]:
-        results = []
-        issues = request_github(
-            self.gh,
-            lambda: self.repo.get_issues(since=since, direction="asc", state="all"),
-            default=[],
-        )
-        page_num = request_github(
-            self.gh,
-            lambda: get_page_num(self.gh.per_page, issues.totalCount),
-            default=0,
-        )
-        for p in range(0, page_num):
-            logger.debug(
-                "issue page %d/%d, rate %s", p, page_num, self.gh.rate_limiting
+    def get_commits(self, since: datetime) -> List[dict[str, Any]]:
+        return [commit for _, page in self.iter_commits(since) for commit in page]
+
+    def _issue_to_dict(self, issue: Any) -> Dict[str, Any]:
+        if issue.state == "closed" and issue.closed_at is not None:
+            closed_at = issue.closed_at.astimezone(timezone.utc)
+        else:
+            closed_at = None
+        is_pull = issue._pull_request != NotSet  # avoid rate limit
+        if is_pull:
+            merged_at = issue.pull_request.raw_data["merged_at"]
+            if merged_at is not None:
+                merged_at = parse_date(merged_at).astimezone(timezone.utc)
+        else:
+            merged_at = None
+        return {
+            "owner": self.owner,
+            "name": self.name,
+            "number": issue.number,
+            "user": issue.user.login,
+            "state": issue.state,
+            "created_at": issue.created_at.astimezone(timezone.utc),
+            "closed_at": closed_at,
+            "title": issue.title,
+            "body": issue.body,
+            "labels": [i.name for i in issue.labels],
+            "is_pull": is_pull,
+            "merged_at": merged_at,
+            "updated_at": issue.updated_at.astimezone(timezone.utc),
+        }
+
+    def _raw_issue_to_dict(self, issue: Dict[str, Any]) -> Dict[str, Any]:
+        if issue["state"] == "closed":
+            closed_at = parse_github_date(issue.get("closed_at"))
+        else:
+            closed_at = None
+        is_pull = "pull_request" in issue
+        if is_pull:
+            merged_at = parse_github_date(issue["pull_request"].get("merged_at"))
+        else:
+            merged_at = None
+        return {
+            "owner": self.owner,
+            "name": self.name,
+            "number": issue["number"],
+            "user": issue["user"]["login"],
+            "state": issue["state"],
+            "created_at": parse_github_date(issue["created_at"]),
+            "closed_at": closed_at,
+            "title": issue["title"],
+            "body": issue["body"],
+            "labels": [label["name"] for label in issue["labels"]],
+            "is_pull": is_pull,
+            "merged_at": merged_at,
+            "updated_at": parse_github_date(issue["updated_at"]),
+        }
+
+    def iter_issues(
+        self, since: datetime, start_page: int = 0
+    ) -> Iterator[Tuple[int, List[Dict[str, Any]]]]:
+        """
+        Yields (page index, issues) of issues and PRs updated since the given time
+        :param start_page: resume from this page instead of the first one
+        """
+        if self.raw:
+            params = {
+                "since": since.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "direction": "asc",
+                "state": "all",
+            }
+            page_num, pages, issue_pages = self._get_raw_pages(
+                "/issues",
+                params,
+                lambda page_num: range(start_page, page_num),
+                probe_page=start_page,
             )
-            for issue in request_github(self.gh, issues.get_page, (p,), []):
-                if issue.state == "closed" and issue.closed_at is not None:
-                    closed_at = issue.closed_at.astimezone(timezone.utc)
-                else:
-                    closed_at = None
-                is_pull = issue._pull_request != NotSet  # avoid rate limit
-                if is_pull:
-                    merged_at = issue.pull_request.raw_data["merged_at"]
-                    if merged_at is not None:
-                        merged_at = parse_date(merged_at).astimezone(timezone.utc)
-                else:
-                    merged_at = None
-                results.append(
-                    {
-                        "owner": self.owner,
-                        "name": self.name,
-                        "number": issue.number,
-                        "user": issue.user.login,
-                        "state": issue.state,
-                        "created_at": issue.created_at.astimezone(timezone.utc),
-                        "closed_at": closed_at,
-                        "title": issue.title,
-                        "body": issue.body,
-                        "labels": [i.name for i in issue.labels],
-                        "is_pull": is_pull,
-                        "merged_at": merged_at,
-                    }
-                )
+            to_dict = self._raw_issue_to_dict
+        else:
+            issues = request_github(
+                self.gh,
+                lambda: self.repo.get_issues(since=since, direction="asc", state="all"),
+                default=[],
+            )
+            page_num = request_github(
+                self.gh,
+                lambda: get_page_num(self.gh.per_page, issues.totalCount),
+                default=0,
+            )
+            pages = range(start_page, page_num)
+            issue_pages = self._get_pages(
+                lambda repo: repo.get_issues(since=since, direction="asc", state="all"),
+                pages,
+            )
+            to_dict = self._issue_to_dict
+
+        with closing(issue_pages):
+            for p, page in zip(pages, issue_pages):
+                logger.debug("issue page %d/%d, rate %s", p, page_num, self.rate)
+                yield p, [to_dict(issue) for issue in page]
         self._update_rate_stats()
-        return results
+
+    def get_issues(self, since: datetime) -> List[dict[str, Any]]:
+        return [issue for _, page in self.iter_issues(since) for issue in page]
 
     def get_issue_detail(self, number: int) -> Dict[str, Any]:
-        issue = request_github(self.gh, self.repo.get_issue, (number,))
-        if issue is None:
+        timeline_events = self._request_all_pages(
+            f"{self._api_path}/issues/{number}/timeline",
+            headers={"Accept": "application/vnd.github.mockingbird-preview"},
+        )
+        if timeline_events is None:
             raise ValueError(f"issue #{number} not found")
         events = []
-        timeline_events = request_github(self.gh, issue.get_timeline, default=[])
-        page_num = request_github(
-            self.gh,
-            lambda: get_page_num(self.gh.per_page, timeline_events.totalCount),
-            default=0,
-        )
-        for p in range(0, page_num):
-            for event in request_github(self.gh, timeline_events.get_page, (p,), []):
-                event = event.raw_data
-                additional_props = {}
-                if event["event"] in ["assigned", "unassigned"]:
-                    if event["assignee"] is not None:
-                        additional_props["assignee"] = event["assignee"]["login"]
-                elif event["event"] in ["labeled", "unlabeled"]:
-                    additional_props["label"] = event["label"]["name"]
-                elif event["event"] == "commented":
-                    additional_props["comment"] = event["body"]
-                    additional_props["commenter"] = event["user"]["login"]
-                elif event["event"] == "cross-referenced":
-                    additional_props["source"] = event["source"]["issue"]["number"]
-                elif event["event"] == "referenced":
-                    additional_props["commit"] = event["commit_id"]
-                if "created_at" in event and event["created_at"] is not None:
-                    t = parse_date(event["created_at"]).astimezone(timezone.utc)
-                else:
-                    t = None
-                if "actor" in event and event["actor"] is not None:
-                    actor = event["actor"]["login"]
-                else:
-                    actor = None
-                events.append(
-                    {
-                        "type": event["event"],
-                        "time": t,
-                        "actor": actor,
-                        **additional_props,
-                    }
-                )
+        for event in timeline_events:
+            additional_props = {}
+            if event["event"] in ["assigned", "unassigned"]:
+                if event["assignee"] is not None:
+                    additional_props["assignee"] = event["assignee"]["login"]
+            elif event["event"] in ["labeled", "unlabeled"]:
+                additional_props["label"] = event["label"]["name"]
+            elif event["event"] == "commented":
+                additional_props["comment"] = event["body"]
+                additional_props["commenter"] = event["user"]["login"]
+            elif event["event"] == "cross-referenced":
+                additional_props["source"] = event["source"]["issue"]["number"]
+            elif event["event"] == "referenced":
+                additional_props["commit"] = event["commit_id"]
+            if "created_at" in event and event["created_at"] is not None:
+                t = parse_date(event["created_at"]).astimezone(timezone.utc)
+            else:
+                t = None
+            if "actor" in event and event["actor"] is not None:
+                actor = event["actor"]["login"]
+            else:
+                actor = None
+            events.append(
+                {
+                    "type": event["event"],
+                    "time": t,
+                    "actor": actor,
+                    **additional_props,
+                }
+            )
         self._update_rate_stats()
         return {
             "owner": self.owner,
@@ -286,19 +752,19 @@ class RepoFetcher(object):
         }
 
     def get_pull_detail(self, number: int) -> Dict[str, Any]:
-        pull = request_github(self.gh, self.repo.get_pull, (number,))
+        pull = request_github(
+            self.gh, self._request_json, (f"{self._api_path}/pulls/{number}",)
+        )
         if pull is None:
             raise ValueError(f"pull request #{number} not found")
+        commits = self._request_all_pages(f"{self._api_path}/pulls/{number}/commits")
+        comments = self._request_all_pages(f"{self._api_path}/issues/{number}/comments")
         results = {
             "owner": self.owner,
             "name": self.name,
             "number": number,
-            "commits": request_github(
-                self.gh, lambda: [c.sha for c in pull.get_commits()], []
-            ),
-            "comments": request_github(
-                self.gh, lambda: [c.body for c in pull.get_issue_comments()], []
-            ),
+            "commits": [c["sha"] for c in commits] if commits else [],
+            "comments": [c["body"] for c in comments] if comments else [],
         }
         self._update_rate_stats()
         return results
@@ -1,24 +1,56 @@
 import os
 import re
+import uuid
+import queue
 import logging
 import argparse
+import threading
+import subprocess
 import mongoengine
-import numpy as np
 import multiprocessing as mp
 
-from typing import List, Dict, Set, Any, Optional
+from typing import List, Dict, Set, Any, Optional, Tuple, Type, Iterator, TypeVar
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_left, bisect_right
 from collections import Counter, defaultdict
 from datetime import datetime, timedelta, timezone
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
 from gfibot import CONFIG, TOKENS
 from gfibot.check_tokens import check_tokens
+from gfibot.token_broker import TokenBroker
 from gfibot.collections import *
-from gfibot.data.graphql import UserFetcher
+from gfibot.data.graphql import UserFetcher, MultiUserFetcher, IssueTimelineFetcher
 from gfibot.data.rest import RepoFetcher, logger as rest_logger
+from gfibot.data import git_mirror
 
 
+T = TypeVar("T")
 logger = logging.getLogger(__name__)
 
+# max number of operations sent to MongoDB in one bulk write
+BULK_WRITE_SIZE = 1000
+# max number of fetched pages waiting to be written
+PIPELINE_DEPTH = 4
+# max number of users fetched in one GraphQL query
+USER_BATCH_SIZE = 10
+# max number of users claimed from the user refresh queue at once,
+#   small enough for concurrent workers to share a short queue
+USER_QUEUE_CLAIM_SIZE = 20
+# claimed users not finished after this time are claimed again
+USER_QUEUE_CLAIM_TIMEOUT = timedelta(hours=1)
+try:
+    # users updated within this time are not enqueued for refresh
+    USER_REFRESH_TTL = timedelta(hours=CONFIG["gfibot"]["user_refresh_ttl"])
+except KeyError:
+    USER_REFRESH_TTL = timedelta(hours=24)
+try:
+    # max number of user queries running concurrently under one token
+    USER_WORKERS_PER_TOKEN = CONFIG["gfibot"]["user_workers_per_token"]
+except KeyError:
+    USER_WORKERS_PER_TOKEN = 1
+
 
 def _count_by_month(dates: List[datetime]) -> List[Repo.MonthCount]:
     counts = Counter(map(lambda d: (d.year, d.month), dates))
@@ -45,6 +77,47 @@ def _match_issue_numbers(text: str) -> List[int]:
     return numbers
 
 
+def _bulk_upsert(
+    cls: Type[Document],
+    keys: List[str],
+    docs: List[Dict[str, Any]],
+    overwrite: bool = True,
+) -> Tuple[int, int]:
+    """
+    Upsert documents with unordered bulk writes of at most BULK_WRITE_SIZE operations
+    :param cls: the collection to write to
+    :param keys: fields that uniquely identify a document
+    :param docs: documents to upsert, later ones win if keys are duplicated
+    :param overwrite: whether to update existing documents, or only insert new ones
+    :return: number of inserted and modified documents
+    """
+    unique_docs = {tuple(doc[k] for k in keys): doc for doc in docs}
+    collection = cls._get_collection()
+    update = "$set" if overwrite else "$setOnInsert"
+    ops = []
+    for doc in unique_docs.values():
+        son = cls(**doc).to_mongo().to_dict()
+        son.pop("_id", None)
+        ops.append(UpdateOne({k: son[k] for k in keys}, {update: son}, upsert=True))
+
+    inserted, modified = 0, 0
+    for i in range(0, len(ops), BULK_WRITE_SIZE):
+        try:
+            result = collection.bulk_write(ops[i : i + BULK_WRITE_SIZE], ordered=False)
+            inserted += result.upserted_count
+            modified += result.modified_count
+        except BulkWriteError as e:
+            logger.error(
+                "%d errors in bulk write to %s: %s",
+                len(e.details["writeErrors"]),
+                cls.__name__,
+                e.details["writeErrors"][:3],
+            )
+            inserted += e.details["nUpserted"]
+            modified += e.details["nModified"]
+    return inserted, modified
+
+
 def _update_repo_info(fetcher: RepoFetcher) -> Repo:
     logger.info("Updating repo: %s/%s", fetcher.owner, fetcher.name)
     repo = Repo.objects(owner=fetcher.owner, name=fetcher.name)
@@ -67,71 +140,290 @@ def _update_repo_info(fetcher: RepoFetcher) -> Repo:
     return repo
 
 
-def _update_stars(fetcher: RepoFetcher, since: datetime) -> List[Dict[str, Any]]:
-    stars = fetcher.get_stars(since)
+def _prefetch(items: Iterator[T], depth: int = PIPELINE_DEPTH) -> Iterator[T]:
+    """
+    Iterate items in a producer thread, keeping at most depth items in a queue,
+      so that later pages are downloaded while earlier ones are being written.
+    Exceptions of the producer are raised to the consumer.
+    """
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce() -> None:
+        try:
+            for item in items:
+                if not put((item, None)):
+                    break
+            else:
+                put((done, None))
+        except Exception as ex:
+            put((None, ex))
+        finally:
+            if hasattr(items, "close"):
+                items.close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, ex = q.get()
+            if ex is not None:
+                raise ex
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+def _write_pages(
+    cls: Type[Document],
+    keys: List[str],
+    pages: Iterator[Tuple[int, List[Dict[str, Any]]]],
+    checkpoint: Optional[GitHubFetchCheckpoint] = None,
+    checkpoint_field: Optional[str] = None,
+    step: int = 1,
+    fields: Optional[List[str]] = None,
+) -> Tuple[List[Dict[str, Any]], int, int]:
+    """
+    Upsert pages while later pages are still being fetched, recording the next page
+      in the checkpoint after each page is written
+    :param step: the direction pages are fetched in, 1 or -1
+    :param fields: fields of the written documents to return, None returns all
+    :return: written documents, number of inserted and modified documents
+    """
+    docs, inserted, modified = [], 0, 0
+    for p, page in _prefetch(pages):
+        i, m = _bulk_upsert(cls, keys, page)
+        if fields is None:
+            docs.extend(page)
+        else:
+            docs.extend({f: doc[f] for f in fields} for doc in page)
+        inserted, modified = inserted + i, modified + m
+        if checkpoint is not None:
+            setattr(checkpoint, checkpoint_field, p + step)
+            checkpoint.updated_at = datetime.now(timezone.utc)
+            checkpoint.save()
+    return docs, inserted, modified
+
+
+def _update_stars(
+    fetcher: RepoFetcher,
+    since: datetime,
+    log: Optional[GitHubFetchLog] = None,
+    checkpoint: Optional[GitHubFetchCheckpoint] = None,
+) -> List[Dict[str, Any]]:
+    stars, inserted, modified = _write_pages(
+        RepoStar,
+        ["owner", "name", "user"],
+        fetcher.iter_stars(since, checkpoint.stars_page if checkpoint else None),
+        checkpoint,
+        "stars_page",
+        -1,
+        ["user"],
+    )
     logger.info("%d stars updated, rate = %s", len(stars), fetcher.rate)
-    for star in stars:
-        RepoStar.objects(
-            owner=fetcher.owner, name=fetcher.name, user=star["user"]
-        ).upsert_one(**star)
+    logger.info("%d stars inserted, %d modified", inserted, modified)
+    if log is not None:
+        log.inserted_stars, log.modified_stars = inserted, modified
     return stars
 
 
-def _update_commits(fetcher: RepoFetcher, since: datetime) -> List[Dict[str, Any]]:
-    commits = fetcher.get_commits(since)
+def _update_commits(
+    fetcher: RepoFetcher,
+    since: datetime,
+    log: Optional[GitHubFetchLog] = None,
+    checkpoint: Optional[GitHubFetchCheckpoint] = None,
+) -> List[Dict[str, Any]]:
+    def with_references(pages):
+        for p, page in pages:
+            for commit in page:
+                commit["referenced_issues"] = _match_issue_numbers(commit["message"])
+            yield p, page
+
+    def write_pages(pages, checkpoint):
+        return _write_pages(
+            RepoCommit,
+            ["owner", "name", "sha"],
+            with_references(pages),
+            checkpoint,
+            "commits_page",
+            fields=["sha", "author", "committer"],
+        )
+
+    written = None
+    if git_mirror.GIT_MIRROR_ROOT is not None:
+        mirror = git_mirror.GitMirror(fetcher.owner, fetcher.name)
+        try:
+            mirror.sync()
+            # git log fails while its pages are consumed, reading the mirror
+            #   again is cheap, so its progress is not checkpointed
+            written = write_pages(mirror.iter_commits(since, fetcher.token), None)
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.error(
+                "Git mirror of %s/%s failed, fetching commits through REST: %s",
+                fetcher.owner,
+                fetcher.name,
+                e,
+            )
+    if written is None:
+        written = write_pages(
+            fetcher.iter_commits(since, checkpoint.commits_page if checkpoint else 0),
+            checkpoint,
+        )
+    commits, inserted, modified = written
     logger.info(
         "%d commits updated, rate = %s",
         len(commits),
         fetcher.rate,
     )
-    for commit in commits:
-        RepoCommit.objects(
-            owner=fetcher.owner, name=fetcher.name, sha=commit["sha"]
-        ).upsert_one(**commit)
+    logger.info("%d commits inserted, %d modified", inserted, modified)
+    if log is not None:
+        log.inserted_commits, log.modified_commits = inserted, modified
     return commits
 
 
-def _update_issues(fetcher: RepoFetcher, since: datetime) -> List[Dict[str, Any]]:
-    issues = fetcher.get_issues(since)
+def _backfill_referenced_issues(owner: str, name: str) -> int:
+    """Extract referenced issues for commits stored before they were indexed"""
+    ops = [
+        UpdateOne(
+            {"_id": c["_id"]},
+            {"$set": {"referenced_issues": _match_issue_numbers(c["message"])}},
+        )
+        for c in RepoCommit.objects(owner=owner, name=name, referenced_issues=None)
+        .only("message")
+        .as_pymongo()
+    ]
+    collection = RepoCommit._get_collection()
+    for i in range(0, len(ops), BULK_WRITE_SIZE):
+        collection.bulk_write(ops[i : i + BULK_WRITE_SIZE], ordered=False)
+    if len(ops) > 0:
+        logger.info("Referenced issues backfilled for %d commits", len(ops))
+    return len(ops)
+
+
+def _update_issues(
+    fetcher: RepoFetcher,
+    since: datetime,
+    log: Optional[GitHubFetchLog] = None,
+    checkpoint: Optional[GitHubFetchCheckpoint] = None,
+) -> List[Dict[str, Any]]:
+    issues, inserted, modified = _write_pages(
+        RepoIssue,
+        ["owner", "name", "number"],
+        fetcher.iter_issues(since, checkpoint.issues_page if checkpoint else 0),
+        checkpoint,
+        "issues_page",
+        fields=["number", "user", "state", "is_pull"],
+    )
     logger.info(
         "%d issues updated, rate = %s",
         len(issues),
         fetcher.rate,
     )
-    for issue in issues:
-        RepoIssue.objects(
-            owner=fetcher.owner, name=fetcher.name, number=issue["number"]
-        ).upsert_one(**issue)
+    logger.info("%d issues inserted, %d modified", inserted, modified)
+    if log is not None:
+        log.inserted_issues, log.modified_issues = inserted, modified
     return issues
 
 
+def _aggregate_by_month(queryset: QuerySet, field: str) -> List[Repo.MonthCount]:
+    """Count documents by the month of a date field with a MongoDB aggregation"""
+    date = "$" + field
+    pipeline = [
+        {
+            "$group": {
+                "_id": {"year": {"$year": date}, "month": {"$month": date}},
+                "count": {"$sum": 1},
+            }
+        },
+        {"$sort": {"_id.year": 1, "_id.month": 1}},
+    ]
+    return [
+        Repo.MonthCount(
+            month=datetime(r["_id"]["year"], r["_id"]["month"], 1, tzinfo=timezone.utc),
+            count=r["count"],
+        )
+        for r in queryset.aggregate(pipeline)
+    ]
+
+
+def _aggregate_median_close_time(queryset: QuerySet) -> Optional[float]:
+    """Median seconds from creation to close of closed issues, sorted in MongoDB"""
+    n = queryset.count()
+    if n == 0:
+        return None
+    pipeline = [
+        {"$project": {"t": {"$subtract": ["$closed_at", "$created_at"]}}},
+        {"$sort": {"t": 1}},
+        {"$skip": (n - 1) // 2},
+        {"$limit": 2 - n % 2},
+    ]
+    middle = [r["t"] for r in queryset.aggregate(pipeline)]
+    return sum(middle) / len(middle) / 1000  # milliseconds to seconds
+
+
 def _update_repo_stats(repo: Repo):
     owner, name = repo.owner, repo.name
-    all_issues: List[RepoIssue] = list(RepoIssue.objects(owner=owner, name=name))
 
     # Median issue close time
-    closed_t = [
-        (i.closed_at - i.created_at).total_seconds()
-        for i in all_issues
-        if i.state == "closed" and not i.is_pull and i.closed_at is not None
-    ]
-    repo.median_issue_close_time = np.median(closed_t) if len(closed_t) > 0 else None
+    repo.median_issue_close_time = _aggregate_median_close_time(
+        RepoIssue.objects(
+            owner=owner, name=name, state="closed", is_pull=False, closed_at__ne=None
+        )
+    )
 
     # Monthly data
-    repo.monthly_stars = _count_by_month(
-        RepoStar.objects(owner=owner, name=name).scalar("starred_at")
+    repo.monthly_stars = _aggregate_by_month(
+        RepoStar.objects(owner=owner, name=name), "starred_at"
     )
-    repo.monthly_commits = _count_by_month(
-        RepoCommit.objects(owner=owner, name=name).scalar("committed_at")
+    repo.monthly_commits = _aggregate_by_month(
+        RepoCommit.objects(owner=owner, name=name), "committed_at"
     )
-    repo.monthly_issues = _count_by_month(
-        [i.created_at for i in all_issues if not i.is_pull]
+    repo.monthly_issues = _aggregate_by_month(
+        RepoIssue.objects(owner=owner, name=name, is_pull=False), "created_at"
     )
-    repo.monthly_pulls = _count_by_month(
-        [i.created_at for i in all_issues if i.is_pull]
+    repo.monthly_pulls = _aggregate_by_month(
+        RepoIssue.objects(owner=owner, name=name, is_pull=True), "created_at"
     )
 
 
+def _get_pull_detail(fetcher: RepoFetcher, pr: RepoIssue) -> Dict[str, Any]:
+    """Get PR commits and comments, refetched only if the PR is updated since cached"""
+    cached: RepoPullDetail = RepoPullDetail.objects(
+        owner=fetcher.owner, name=fetcher.name, number=pr.number
+    ).first()
+    # PRs stored before updated_at was recorded are refreshed by get_issues once
+    #   they change, so their cached details are still valid
+    if cached is not None and (
+        pr.updated_at is None
+        or (cached.updated_at is not None and cached.updated_at >= pr.updated_at)
+    ):
+        return {"commits": cached.commits, "comments": cached.comments}
+
+    details = fetcher.get_pull_detail(pr.number)
+    RepoPullDetail.objects(
+        owner=fetcher.owner, name=fetcher.name, number=pr.number
+    ).update_one(
+        upsert=True,
+        set__commits=details["commits"],
+        set__comments=details["comments"],
+        set__updated_at=pr.updated_at,
+    )
+    return details
+
+
 def _locate_resolved_issues(
     fetcher: RepoFetcher, since: datetime
 ) -> List[Dict[str, Any]]:
@@ -141,13 +433,37 @@ def _locate_resolved_issues(
             owner=fetcher.owner, name=fetcher.name, is_pull=False, closed_at__gte=since
         )
     }
-    all_commits: List[RepoCommit] = sorted(
-        RepoCommit.objects(owner=fetcher.owner, name=fetcher.name),
-        key=lambda c: c.authored_at,
+    merged_prs: List[RepoIssue] = sorted(
+        RepoIssue.objects(
+            owner=fetcher.owner, name=fetcher.name, is_pull=True, merged_at__ne=None
+        ).only("number", "user", "title", "body", "merged_at", "updated_at"),
+        key=lambda pr: pr.merged_at,
     )
     closed_nums = set(map(lambda i: i.number, all_issues.values()))
     logger.info("%d newly closed issues since %s", len(all_issues), since)
 
+    # Only commits referencing the closed issues and PRs merged around their
+    #   closing time are candidates, so only their authors' commits are loaded
+    _backfill_referenced_issues(fetcher.owner, fetcher.name)
+    ref_commits: List[RepoCommit] = sorted(
+        RepoCommit.objects(
+            owner=fetcher.owner,
+            name=fetcher.name,
+            referenced_issues__in=list(closed_nums),
+        ).only("sha", "author", "authored_at", "referenced_issues"),
+        key=lambda c: c.authored_at,
+    )
+    merged_times = [pr.merged_at for pr in merged_prs]
+    candidate_prs: Dict[int, List[RepoIssue]] = {}
+    for issue in all_issues.values():
+        t1 = issue.closed_at - timedelta(minutes=1)
+        t2 = issue.closed_at + timedelta(minutes=1)
+        candidate_prs[issue.number] = merged_prs[
+            bisect_right(merged_times, t1) : bisect_left(merged_times, t2)
+        ]
+    authors = set(c.author for c in ref_commits if c.author is not None)
+    authors.update(pr.user for prs in candidate_prs.values() for pr in prs)
+
     resolved = defaultdict(
         lambda: {
             "owner": fetcher.owner,
@@ -162,22 +478,29 @@ def _locate_resolved_issues(
         }
     )
 
+    # Sorted commit times of each author, the number of commits an author made
+    #   before time t is then bisect_left(author2times[author], t)
+    author2times: Dict[str, List[datetime]] = defaultdict(list)
+    sha2commit: Dict[str, RepoCommit] = {}
+    for c in sorted(
+        RepoCommit.objects(
+            owner=fetcher.owner, name=fetcher.name, author__in=list(authors)
+        ).only("sha", "author", "authored_at"),
+        key=lambda c: c.authored_at,
+    ):
+        author2times[c.author].append(c.authored_at)
+        sha2commit[c.sha] = c
+
     # Note that, we first get possible issue resolver *using commits*,
     #   then we get possible resolver using PRs.
     # In this way, resolver obtained through PRs has higher priority.
     # Also, all commits and issues are sorted by date, so resolver from later commits
     #   and later PRs have higher priority.
-    author2commits = defaultdict(list)
-    for c in all_commits:
-        author2commits[c.author].append(c)
-    for c in all_commits:
+    for c in ref_commits:
         if c.author is None:
             continue
-        commits_before = set()
-        for c2 in author2commits[c.author]:
-            if c2.authored_at < c.authored_at:
-                commits_before.add(c2.sha)
-        for num in _match_issue_numbers(c.message):
+        commits_before = bisect_left(author2times[c.author], c.authored_at)
+        for num in c.referenced_issues:
             if num not in closed_nums:
                 continue
             logger.debug(
@@ -185,26 +508,16 @@ def _locate_resolved_issues(
                 num,
                 c.sha,
                 c.author,
-                len(commits_before),
+                commits_before,
             )
             resolved[num]["number"] = num
             resolved[num]["resolver"] = c.author
             resolved[num]["resolved_in"] = c.sha
-            resolved[num]["resolver_commit_num"] = len(commits_before)
+            resolved[num]["resolver_commit_num"] = commits_before
     logger.info("%d issues found to be resolved by commits", len(resolved))
 
     for issue in all_issues.values():
-        t1 = issue.closed_at - timedelta(minutes=1)
-        t2 = issue.closed_at + timedelta(minutes=1)
-        prs: List[RepoIssue] = list(
-            RepoIssue.objects(
-                owner=fetcher.owner,
-                name=fetcher.name,
-                is_pull=True,
-                merged_at__gt=t1,
-                merged_at__lt=t2,
-            )
-        )
+        prs = candidate_prs[issue.number]
         if len(prs) > 0:
             logger.debug(
                 "Candidate PRs %s for issue %d, rate = %s",
@@ -213,28 +526,28 @@ def _locate_resolved_issues(
                 fetcher.rate,
             )
         for pr in prs:
-            pr_details = fetcher.get_pull_detail(pr.number)
+            pr_details = _get_pull_detail(fetcher, pr)
             text = [pr.title, pr.body, *pr_details["comments"]]
             text = "\n".join([t for t in text if t is not None])
-            commits_before = set()
-            for c in author2commits[pr.user]:
-                if (
-                    c.authored_at < pr.merged_at - timedelta(days=1)
-                    and c.sha not in pr_details["commits"]
-                ):
-                    commits_before.add(c.sha)
+            # prior commits of the PR author, excluding commits of this PR
+            until = pr.merged_at - timedelta(days=1)
+            commits_before = bisect_left(author2times[pr.user], until)
+            for sha in set(pr_details["commits"]):
+                c = sha2commit.get(sha)
+                if c is not None and c.author == pr.user and c.authored_at < until:
+                    commits_before -= 1
             if issue.number in _match_issue_numbers(text):
                 logger.debug(
                     "Issue #%d resolved in #%d by %s (%d prior commits)",
                     issue.number,
                     pr.number,
                     pr.user,
-                    len(commits_before),
+                    commits_before,
                 )
                 resolved[issue.number]["number"] = issue.number
                 resolved[issue.number]["resolver"] = pr.user
                 resolved[issue.number]["resolved_in"] = pr.number
-                resolved[issue.number]["resolver_commit_num"] = len(commits_before)
+                resolved[issue.number]["resolver_commit_num"] = commits_before
     logger.info("%d issues found to be resolved by commits/PRs", len(resolved))
 
     for num in resolved.keys():
@@ -243,18 +556,52 @@ def _locate_resolved_issues(
     return list(resolved.values())
 
 
+def _fetch_issue_events(
+    fetcher: RepoFetcher,
+    numbers: List[int],
+    cursors: Optional[Dict[int, Optional[str]]] = None,
+    log: Optional[GitHubFetchLog] = None,
+) -> Dict[int, List[Dict[str, Any]]]:
+    """
+    Fetch timelines of many issues with batched GraphQL queries.
+    Issues whose batch failed are fetched one by one through REST.
+    If cursors are given, only events after each issue's cursor are fetched
+      through GraphQL, and cursors are advanced in place. Issues fetched through
+      REST get their full timeline and their cursors are reset to None.
+    """
+    if len(numbers) == 0:
+        return {}
+    timeline_fetcher = IssueTimelineFetcher(fetcher.token, fetcher.owner, fetcher.name)
+    events = timeline_fetcher.fetch(numbers, cursors)
+    if log is not None:
+        log.rate_graphql = (log.rate_graphql or 0) + timeline_fetcher.rate_consumed
+    logger.info(
+        "Fetched timelines for %d/%d issues through GraphQL, cost = %d",
+        len(events),
+        len(numbers),
+        timeline_fetcher.rate_consumed,
+    )
+    for number in numbers:
+        if number not in events:
+            logger.debug(
+                "Fetching details for issue #%d, rate = %s", number, fetcher.rate
+            )
+            events[number] = fetcher.get_issue_detail(number)["events"]
+            if cursors is not None:
+                cursors[number] = None
+    return events
+
+
 def _update_resolved_issues(
-    fetcher: RepoFetcher, since: datetime
+    fetcher: RepoFetcher, since: datetime, log: Optional[GitHubFetchLog] = None
 ) -> List[Dict[str, Any]]:
     """Fetch data for issues that will be used for RecGFI training."""
     resolved_issues = _locate_resolved_issues(fetcher, since)
+    all_events = _fetch_issue_events(
+        fetcher, [i["number"] for i in resolved_issues], log=log
+    )
     for resolved_issue in resolved_issues:
-        logger.debug(
-            "Fetching details for resolved issue #%d, rate = %s",
-            resolved_issue["number"],
-            fetcher.rate,
-        )
-        for event in fetcher.get_issue_detail(resolved_issue["number"])["events"]:
+        for event in all_events[resolved_issue["number"]]:
             resolved_issue["events"].append(IssueEvent(**event))
     for resolved_issue in resolved_issues:
         ResolvedIssue.objects(
@@ -263,7 +610,12 @@ def _update_resolved_issues(
     return resolved_issues
 
 
-def _update_open_issues(fetcher: RepoFetcher, nums: List[int], since: datetime):
+def _update_open_issues(
+    fetcher: RepoFetcher,
+    nums: List[int],
+    since: datetime,
+    log: Optional[GitHubFetchLog] = None,
+):
     """Fetch data for all new open issues"""
     query = Q(name=fetcher.name, owner=fetcher.owner)
     repo_open_issues = RepoIssue.objects(
@@ -271,11 +623,26 @@ def _update_open_issues(fetcher: RepoFetcher, nums: List[int], since: datetime):
     )
     logger.info("%d open issues updated since %s", repo_open_issues.count(), since)
 
+    repo_open_issues = list(repo_open_issues)
+    existing: Dict[int, OpenIssue] = {
+        i.number: i
+        for i in OpenIssue.objects(
+            query & Q(number__in=[i.number for i in repo_open_issues])
+        )
+    }
+    # only fetch events after the last seen timeline item of known issues
+    prev_cursors = {
+        i.number: existing[i.number].timeline_cursor if i.number in existing else None
+        for i in repo_open_issues
+    }
+    cursors = dict(prev_cursors)
+    all_events = _fetch_issue_events(
+        fetcher, [i.number for i in repo_open_issues], cursors, log
+    )
     open_issues = []
-    for issue in list(repo_open_issues):
-        existing = OpenIssue.objects(query & Q(number=issue.number))
-        if existing.count() > 0:
-            open_issue = existing.first()
+    for issue in repo_open_issues:
+        if issue.number in existing:
+            open_issue = existing[issue.number]
             open_issue.updated_at = datetime.utcnow()
         else:
             open_issue = OpenIssue(
@@ -286,14 +653,12 @@ def _update_open_issues(fetcher: RepoFetcher, nums: List[int], since: datetime):
                 updated_at=datetime.utcnow(),
             )
 
-        logger.debug(
-            "Fetching details for open issue #%d, rate = %s",
-            issue.number,
-            fetcher.rate,
-        )
-        open_issue.events = [
-            IssueEvent(**e) for e in fetcher.get_issue_detail(issue.number)["events"]
-        ]
+        events = [IssueEvent(**e) for e in all_events[issue.number]]
+        if prev_cursors[issue.number] is not None and cursors.get(issue.number):
+            open_issue.events = open_issue.events + events
+        else:
+            open_issue.events = events
+        open_issue.timeline_cursor = cursors.get(issue.number)
         open_issue.save()
         open_issues.append(open_issue)
 
@@ -342,13 +707,37 @@ def _find_users(
     return all_users
 
 
-def _update_user_issues(user: User, res: Dict[str, Any]) -> None:
-    """Update issues for a user."""
-    user.issues = [
-        User.Issue(
-            owner=issue["repository"]["nameWithOwner"].split("/")[0],
-            name=issue["repository"]["nameWithOwner"].split("/")[1],
-            repo_stars=issue["repository"]["stargazerCount"],
+# fields that identify a contribution of each kind in UserContribution
+USER_CONTRIBUTION_KEYS = {
+    "issue": ["login", "kind", "owner", "name", "number"],
+    "pull": ["login", "kind", "owner", "name", "number"],
+    "review": ["login", "kind", "owner", "name", "number", "created_at"],
+    "commit": ["login", "kind", "owner", "name", "created_at"],
+}
+
+
+def _user_contribution(
+    login: str, kind: str, name_with_owner: str, repo_stars: int, **kwargs
+) -> Dict[str, Any]:
+    owner, name = name_with_owner.split("/")
+    return {
+        "login": login,
+        "kind": kind,
+        "owner": owner,
+        "name": name,
+        "repo_stars": repo_stars,
+        **kwargs,
+    }
+
+
+def _user_issues(login: str, res: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Issue contributions in a page of user issues"""
+    return [
+        _user_contribution(
+            login,
+            "issue",
+            issue["repository"]["nameWithOwner"],
+            issue["repository"]["stargazerCount"],
             state=issue["state"],
             number=issue["number"],
             created_at=issue["createdAt"],
@@ -357,56 +746,63 @@ def _update_user_issues(user: User, res: Dict[str, Any]) -> None:
     ]
 
 
-def _update_user_pulls(user: User, res: Dict[str, Any]) -> None:
-    """Update pull request contributions for a user."""
-    user.pulls = [
-        User.Pull(
-            owner=pr["pullRequest"]["repository"]["nameWithOwner"].split("/")[0],
-            name=pr["pullRequest"]["repository"]["nameWithOwner"].split("/")[1],
-            repo_stars=pr["pullRequest"]["repository"]["stargazerCount"],
+def _user_pulls(login: str, res: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Pull request contributions in a page of pullRequestContributions"""
+    return [
+        _user_contribution(
+            login,
+            "pull",
+            pr["pullRequest"]["repository"]["nameWithOwner"],
+            pr["pullRequest"]["repository"]["stargazerCount"],
             state=pr["pullRequest"]["state"],
-            created_at=pr["pullRequest"]["createdAt"],
             number=pr["pullRequest"]["number"],
+            created_at=pr["pullRequest"]["createdAt"],
         )
         for pr in res["nodes"]
     ]
 
 
-def _update_user_commits(user: User, res: Dict[str, Any]) -> None:
-    """Update commits for a user."""
-    user.commits = []
-    for commit_contrib in res:
-        owner = commit_contrib["repository"]["nameWithOwner"].split("/")[0]
-        name = commit_contrib["repository"]["nameWithOwner"].split("/")[1]
-        repo_stars = commit_contrib["repository"]["stargazerCount"]
-
-        for contrib in commit_contrib["contributions"]["nodes"]:
-            user.commit_contributions.append(
-                User.CommitContribution(
-                    owner=owner,
-                    name=name,
-                    repo_stars=repo_stars,
-                    commit_count=contrib["commitCount"],
-                    created_at=contrib["occurredAt"],
-                )
-            )
+def _user_commits(login: str, res: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Daily commit counts in commitContributionsByRepository"""
+    return [
+        _user_contribution(
+            login,
+            "commit",
+            commit_contrib["repository"]["nameWithOwner"],
+            commit_contrib["repository"]["stargazerCount"],
+            commit_count=contrib["commitCount"],
+            created_at=contrib["occurredAt"],
+        )
+        for commit_contrib in res
+        for contrib in commit_contrib["contributions"]["nodes"]
+    ]
 
 
-def _update_user_reviews(user: User, res: Dict[str, Any]) -> None:
-    """Update reviews for a user."""
-    user.pull_reviews = [
-        User.Review(
-            owner=review["repository"]["nameWithOwner"].split("/")[0],
-            name=review["repository"]["nameWithOwner"].split("/")[1],
-            repo_stars=review["repository"]["stargazerCount"],
-            created_at=review["pullRequestReview"]["createdAt"],
+def _user_reviews(login: str, res: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Review contributions in a page of pullRequestReviewContributions"""
+    return [
+        _user_contribution(
+            login,
+            "review",
+            review["repository"]["nameWithOwner"],
+            review["repository"]["stargazerCount"],
             state=review["pullRequestReview"]["state"],
             number=review["pullRequestReview"]["pullRequest"]["number"],
+            created_at=review["pullRequestReview"]["createdAt"],
         )
         for review in res["nodes"]
     ]
 
 
+def _save_user_contributions(contributions: List[Dict[str, Any]]) -> None:
+    """Upsert contributions into UserContribution, refetched ones are overwritten"""
+    by_kind = defaultdict(list)
+    for contrib in contributions:
+        by_kind[contrib["kind"]].append(contrib)
+    for kind, docs in by_kind.items():
+        _bulk_upsert(UserContribution, USER_CONTRIBUTION_KEYS[kind], docs)
+
+
 def _update_user_meta(user: User, res: Dict[str, Any]) -> None:
     """Update meta data for a user."""
     user.name = res["name"]
@@ -418,8 +814,8 @@ def _update_user_query(rate_state: dict, res: Dict[str, Any]) -> None:
     rate_state["cost"] += res["rateLimit"]["cost"]
 
 
-def update_user(token: str, login: str) -> int:
-    """Fetch data for a user"""
+def _prepare_user(login: str) -> Tuple[User, datetime]:
+    """Load or create a user and decide since when to fetch its data"""
     # does the user exist?
     user = User.objects(login=login).first()
     time_now = datetime.utcnow()
@@ -437,6 +833,40 @@ def update_user(token: str, login: str) -> int:
         logger.info("Running in CI environment, overriding 'since' date")
         since = time_now - timedelta(days=7)
 
+    return user, since
+
+
+def _user_callbacks(user: User, contributions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    UserFetcher callbacks that write query results to a user and collect its
+      contributions, which are saved along with the user
+    """
+    login = user.login
+    return {
+        "user": lambda res: _update_user_meta(user, res),
+        "issues": lambda res: contributions.extend(_user_issues(login, res)),
+        "pullRequestContributions": lambda res: contributions.extend(
+            _user_pulls(login, res)
+        ),
+        "commitContributionsByRepository": lambda res: contributions.extend(
+            _user_commits(login, res)
+        ),
+        "pullRequestReviewContributions": lambda res: contributions.extend(
+            _user_reviews(login, res)
+        ),
+    }
+
+
+def _save_user(user: User, contributions: List[Dict[str, Any]]) -> None:
+    # contributions first, so _updated_at only moves on once they are saved
+    _save_user_contributions(contributions)
+    user.save()
+
+
+def update_user(token: str, login: str) -> int:
+    """Fetch data for a user"""
+    user, since = _prepare_user(login)
+    contributions = []
     rate_state = {"cost": 0}
 
     fetcher = UserFetcher(
@@ -445,20 +875,12 @@ def update_user(token: str, login: str) -> int:
         since=since,
         callbacks={
             "query": lambda res: _update_user_query(rate_state, res),
-            "user": lambda res: _update_user_meta(user, res),
-            "issues": lambda res: _update_user_issues(user, res),
-            "pullRequestContributions": lambda res: _update_user_pulls(user, res),
-            "commitContributionsByRepository": lambda res: _update_user_commits(
-                user, res
-            ),
-            "pullRequestReviewContributions": lambda res: _update_user_reviews(
-                user, res
-            ),
+            **_user_callbacks(user, contributions),
         },
     )
     try:
         fetcher.fetch()
-        user.save()
+        _save_user(user, contributions)
         logger.info(
             "User %s updated from %s to %s, ratelimit cost=%d remaining=%d",
             login,
@@ -474,6 +896,50 @@ def update_user(token: str, login: str) -> int:
     return rate_state["cost"]
 
 
+def update_users(token: str, logins: List[str]) -> int:
+    """
+    Fetch data for many users, USER_BATCH_SIZE users per GraphQL query.
+    Users in batches that failed are updated one by one with update_user().
+    :return: rate limit cost
+    """
+    users = {login: _prepare_user(login) for login in logins}
+    contributions = {login: [] for login in logins}
+    rate_state = {"cost": 0, "remaining": None}
+
+    fetcher = MultiUserFetcher(
+        token=token,
+        users=[
+            (login, since, _user_callbacks(user, contributions[login]))
+            for login, (user, since) in users.items()
+        ],
+        callbacks={"query": lambda res: _update_user_query(rate_state, res)},
+        batch_size=USER_BATCH_SIZE,
+    )
+    failed = set(fetcher.fetch())
+    for login, (user, since) in users.items():
+        if login in failed:
+            continue
+        _save_user(user, contributions[login])
+        logger.debug(
+            "User %s updated from %s to %s",
+            login,
+            since.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            user._updated_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        )
+    logger.info(
+        "%d users updated in batches, ratelimit cost=%d remaining=%s",
+        len(users) - len(failed),
+        rate_state["cost"],
+        rate_state["remaining"],
+    )
+
+    # callbacks may have run on partial results, which are dropped,
+    #   so start over from the database
+    for login in failed:
+        rate_state["cost"] += update_user(token, login)
+    return rate_state["cost"]
+
+
 # def update_gfi_repo_add_query(owner: str, name: str) -> None:
 #     """TODO: Remove this function after we have a better logging system"""
 #     GfiQueries.objects(Q(owner=owner) & Q(name=name)).update_one(
@@ -484,8 +950,126 @@ def update_user(token: str, login: str) -> int:
 #     )
 
 
+def enqueue_users(logins: List[str]) -> int:
+    """
+    Add users to the global user refresh queue, skipping users updated within
+      USER_REFRESH_TTL and users that are already enqueued
+    :return: number of users not fresh enough, whether already enqueued or not
+    """
+    fresh = set(
+        u["login"]
+        for u in User.objects(
+            login__in=logins, _updated_at__gte=datetime.utcnow() - USER_REFRESH_TTL
+        )
+        .only("login")
+        .as_pymongo()
+    )
+    stale = sorted(set(logins) - fresh)
+    time_now = datetime.now(timezone.utc)
+    ops = [
+        UpdateOne(
+            {"login": login},
+            {"$setOnInsert": {"requested_at": time_now}},
+            upsert=True,
+        )
+        for login in stale
+    ]
+    collection = UserRefreshRequest._get_collection()
+    for i in range(0, len(ops), BULK_WRITE_SIZE):
+        collection.bulk_write(ops[i : i + BULK_WRITE_SIZE], ordered=False)
+    logger.info("%d users enqueued for refresh, %d are fresh", len(stale), len(fresh))
+    return len(stale)
+
+
+def _claim_users(
+    limit: int = USER_QUEUE_CLAIM_SIZE, logins: Optional[List[str]] = None
+) -> Tuple[Optional[str], List[str]]:
+    """
+    Claim the oldest unclaimed (or stale) users in the refresh queue
+    :param logins: only claim these users if given
+    :return: the claim identifier and the claimed logins, no logins if nothing is left
+    """
+    time_now = datetime.now(timezone.utc)
+    claimable = Q(claimed_at=None) | Q(
+        claimed_at__lt=time_now - USER_QUEUE_CLAIM_TIMEOUT
+    )
+    if logins is not None:
+        claimable = claimable & Q(login__in=logins)
+    while True:
+        ids = [
+            r["_id"]
+            for r in UserRefreshRequest.objects(claimable)
+            .order_by("requested_at")
+            .only("id")
+            .limit(limit)
+            .as_pymongo()
+        ]
+        if len(ids) == 0:
+            return None, []
+        claim = uuid.uuid4().hex
+        # the claimable condition is repeated so that concurrent workers never share
+        #   a user, a worker that lost all users to another one simply tries again
+        UserRefreshRequest.objects(Q(id__in=ids) & claimable).update(
+            set__claim=claim, set__claimed_at=time_now
+        )
+        claimed = [
+            r["login"]
+            for r in UserRefreshRequest.objects(claim=claim).only("login").as_pymongo()
+        ]
+        if len(claimed) > 0:
+            return claim, claimed
+
+
+def _drain_user_queue_worker(
+    token: str, logins: Optional[List[str]] = None
+) -> Tuple[int, int]:
+    """
+    Fetch claimed users with one token until the queue is empty
+    :return: rate limit cost and number of users fetched
+    """
+    broker = TokenBroker([token])
+    cost, count = 0, 0
+    while True:
+        claim, claimed = _claim_users(logins=logins)
+        if len(claimed) == 0:
+            return cost, count
+        # wait for the rate limit to reset if the token is exhausted
+        cost += update_users(broker.acquire("graphql"), claimed)
+        UserRefreshRequest.objects(claim=claim).delete()
+        count += len(claimed)
+
+
+def drain_user_queue(
+    tokens: List[str], logins: Optional[List[str]] = None
+) -> Tuple[int, int]:
+    """
+    Fetch users in the global user refresh queue, with USER_WORKERS_PER_TOKEN
+      threads per token each fetching USER_QUEUE_CLAIM_SIZE users at a time
+    :param logins: only fetch these users if given, otherwise the whole queue
+    :return: rate limit cost summed over all workers, and number of users fetched
+    """
+    workers = [token for token in tokens for _ in range(USER_WORKERS_PER_TOKEN)]
+    with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+        results = list(
+            executor.map(_drain_user_queue_worker, workers, [logins] * len(workers))
+        )
+    cost, count = sum(c for c, _ in results), sum(n for _, n in results)
+    logger.info(
+        "%d users refreshed from the queue with %d workers, ratelimit cost=%d",
+        count,
+        len(workers),
+        cost,
+    )
+    return cost, count
+
+
 def update_repo(
-    token: str, owner: str, name: str, user_github_login: Optional[str] = None
+    token: str,
+    owner: str,
+    name: str,
+    user_github_login: Optional[str] = None,
+    drain_users: bool = True,
+    user_tokens: Optional[List[str]] = None,
 ) -> None:
     """Update all information of a repository for RecGFI training
 
@@ -496,6 +1080,15 @@ def update_repo(
         user_github_login (Optional[str], optional):
             If this function is called from backend, indicate which user intiated this update.
             Defaults to None.
+        drain_users (bool, optional):
+            If True, users of this repository are enqueued for refresh and then
+            fetched from the queue, leaving users of other repositories in it.
+            If False, users are only enqueued and the caller drains the whole queue
+            with drain_user_queue() after updating many repositories.
+            Defaults to True.
+        user_tokens (Optional[List[str]], optional):
+            Tokens that users are fetched with concurrently when drain_users is True.
+            Defaults to None, which uses token only.
     """
     if update_in_progress(owner, name, GitHubFetchLog):
         logger.info("%s/%s is already being updated, skipping", owner, name)
@@ -507,6 +1100,7 @@ def update_repo(
         pid=os.getpid(),
         update_begin=datetime.now(timezone.utc),
         user_github_login=user_github_login,
+        rate_graphql=0,
     )
     log.save()
 
@@ -515,16 +1109,49 @@ def update_repo(
     logger.info("Fetching repo %s/%s", owner, name)
     repo = _update_repo_info(fetcher)
 
-    if repo.updated_at is None:
-        since = repo.repo_created_at
+    checkpoint = GitHubFetchCheckpoint.objects(owner=owner, name=name).first()
+    resumed = checkpoint is not None
+    if resumed:
+        logger.info(
+            "Resuming interrupted update of %s/%s, completed phases: %s",
+            owner,
+            name,
+            checkpoint.completed,
+        )
     else:
-        since = repo.updated_at
-    repo.updated_at = datetime.now(timezone.utc)
+        checkpoint = GitHubFetchCheckpoint(
+            owner=owner,
+            name=name,
+            since=repo.updated_at if repo.updated_at else repo.repo_created_at,
+            watermark=datetime.now(timezone.utc),
+            updated_at=datetime.now(timezone.utc),
+        )
+        checkpoint.save()
+    since = checkpoint.since
+
+    def complete(phase: str) -> None:
+        checkpoint.completed.append(phase)
+        checkpoint.updated_at = datetime.now(timezone.utc)
+        checkpoint.save()
 
     logger.info("Update stars, commits, and issues since %s", since)
-    stars = _update_stars(fetcher, since)
-    commits = _update_commits(fetcher, since)
-    issues = _update_issues(fetcher, since)
+    stars, commits, issues = [], [], []
+    if "stars" not in checkpoint.completed:
+        stars = _update_stars(fetcher, since, log, checkpoint)
+        complete("stars")
+    if "commits" not in checkpoint.completed:
+        commits = _update_commits(fetcher, since, log, checkpoint)
+        complete("commits")
+    if "issues" not in checkpoint.completed:
+        issues = _update_issues(fetcher, since, log, checkpoint)
+        complete("issues")
+    if resumed:
+        # issues fetched before the interruption are only in the database
+        issues = list(
+            RepoIssue.objects(owner=owner, name=name, updated_at__gte=since)
+            .only("number", "user", "state", "is_pull")
+            .as_pymongo()
+        )
 
     log.updated_stars = len(stars)
     log.updated_issues = len(issues)
@@ -533,9 +1160,17 @@ def update_repo(
     log.rate_repo_stat = fetcher.rate_consumed
     log.save()
 
-    resolved_issues = _update_resolved_issues(fetcher, since)
+    if "resolved_issues" not in checkpoint.completed:
+        resolved_issues = _update_resolved_issues(fetcher, since, log)
+        complete("resolved_issues")
+    else:
+        resolved_issues = list(
+            ResolvedIssue.objects(owner=owner, name=name, resolved_at__gte=since).only(
+                "number"
+            )
+        )
     log.updated_resolved_issues = len(resolved_issues)
-    log.rate = fetcher.rate_consumed
+    log.rate = fetcher.rate_consumed + log.rate_graphql
     log.rate_resolved_issue = fetcher.rate_consumed - log.rate_repo_stat
     log.save()
 
@@ -544,9 +1179,17 @@ def update_repo(
     open_issue_nums = [
         i["number"] for i in issues if i["state"] == "open" and not i["is_pull"]
     ]
-    open_issues = _update_open_issues(fetcher, open_issue_nums, since)
+    if "open_issues" not in checkpoint.completed:
+        open_issues = _update_open_issues(fetcher, open_issue_nums, since, log)
+        complete("open_issues")
+    else:
+        open_issues = list(
+            OpenIssue.objects(owner=owner, name=name, number__in=open_issue_nums).only(
+                "number"
+            )
+        )
     log.updated_open_issues = len(open_issues)
-    log.rate = fetcher.rate_consumed
+    log.rate = fetcher.rate_consumed + log.rate_graphql
     log.rate_open_issue = (
         fetcher.rate_consumed - log.rate_repo_stat - log.rate_resolved_issue
     )
@@ -554,23 +1197,30 @@ def update_repo(
 
     # update_gfi_repo_add_query(owner, name)
 
+    # users are refreshed incrementally since their own updated_at,
+    #   so this phase is simply rerun after an interruption
     all_users = _find_users(owner, name, commits, issues, open_issues, resolved_issues)
-    log.rate_user = 0
-    for user in all_users:
-        if user is None or type(user) != str:
-            continue
-        log.rate_user += update_user(token, user)
-    log.updated_users = len(all_users)
+    all_users = [user for user in all_users if user is not None and type(user) == str]
+    enqueue_users(all_users)
+    if drain_users:
+        log.rate_user, log.updated_users = drain_user_queue(
+            user_tokens or [token], all_users
+        )
+    else:
+        log.rate_user, log.updated_users = 0, 0
     log.rate = log.rate + log.rate_user
     log.update_end = datetime.now(timezone.utc)
     log.save()
 
+    # everything changed after the update began is fetched in the next update
+    repo.updated_at = checkpoint.watermark
     _update_repo_stats(repo)
     repo.save()
+    checkpoint.delete()
     logger.info("Finished updating for %s/%s since %s", owner, name, since)
 
 
-def update_under_one_token(token: str, repos: List[str]) -> None:
+def _connect_mongodb() -> None:
     # Reconnect in a new process
     mongoengine.connect(
         CONFIG["mongodb"]["db"],
@@ -579,10 +1229,16 @@ def update_under_one_token(token: str, repos: List[str]) -> None:
         uuidRepresentation="standard",
     )
 
-    logging.info("token = %s, repos = %s", token[0:6], repos)
-    for repo in repos:
-        owner, name = repo.split("/")
-        update_repo(token, owner, name)
+
+def update_with_token_broker(tokens: List[str], repo: str) -> None:
+    """
+    Update a repository with the token that has the most quota left right now,
+      leaving its users in the refresh queue
+    """
+    token = TokenBroker(tokens).acquire("rest")
+    logging.info("token = %s, repo = %s", token[0:6], repo)
+    owner, name = repo.split("/")
+    update_repo(token, owner, name, drain_users=False)
 
 
 def main():
@@ -605,11 +1261,20 @@ def main():
 
     logger.info("Data update started at {}".format(datetime.now()))
 
-    params = defaultdict(list)
-    for i, project in enumerate(repos):
-        params[valid_tokens[i % len(valid_tokens)]].append(project)
-    with mp.Pool(min(args.nprocess, len(valid_tokens))) as pool:
-        pool.starmap(update_under_one_token, params.items())
+    # tokens are handed out per repository when its update starts,
+    #   so an exhausted token no longer holds back a fixed batch of repositories
+    with mp.Pool(
+        min(args.nprocess, len(valid_tokens)), initializer=_connect_mongodb
+    ) as pool:
+        pool.starmap(
+            update_with_token_broker,
+            [(valid_tokens, repo) for repo in repos],
+            chunksize=1,
+        )
+
+    # users shared by many repositories are fetched only once
+    _connect_mongodb()
+    drain_user_queue(valid_tokens)
 
     logger.info("Data update finished at {}".format(datetime.now()))
 
@@ -0,0 +1,173 @@
+import os
+import time
+import logging
+import threading
+import requests
+
+from typing import Optional
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from gfibot import CONFIG
+from gfibot.token_broker import report_quota
+
+
+logger = logging.getLogger(__name__)
+
+# root of the GitHub API, can point to a replay server (see gfibot.data.replay)
+try:
+    GITHUB_API_URL = CONFIG["gfibot"]["github_api_url"]
+except KeyError:
+    GITHUB_API_URL = "https://api.github.com"
+
+# max number of keep-alive connections per host in the shared session
+POOL_SIZE = 32
+# seconds to wait for GitHub to answer a request
+TIMEOUT = 30
+# max number of retries after rate limits and server errors
+MAX_RETRIES = 3
+# GitHub asks to wait at least a minute after a secondary rate limit
+SECONDARY_RATE_LIMIT_WAIT = 60
+
+# X-RateLimit-Resource of the quotas tracked by the token broker
+_RESOURCES = {"core": "rest", "graphql": "graphql"}
+
+_session: Optional[requests.Session] = None
+_session_pid: Optional[int] = None
+_session_lock = threading.Lock()
+
+
+def _mask_token(token: str) -> str:
+    return "*" * (len(token) - 5) + token[-5:]
+
+
+def connection_retry() -> Retry:
+    """
+    Retry policy for connection errors and overloaded servers, shared by the pooled
+      session and PyGithub. Rate limits are handled by request().
+    """
+    return Retry(
+        total=MAX_RETRIES,
+        read=0,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=["GET", "HEAD", "OPTIONS"],
+        backoff_factor=1,
+        # urllib3 would sleep as long as Retry-After asks, even for an hour
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    )
+
+
+def get_session() -> requests.Session:
+    """Get the keep-alive session shared by all threads of this process"""
+    global _session, _session_pid
+    with _session_lock:
+        # connections must not be shared with a forked parent process
+        if _session is None or _session_pid != os.getpid():
+            _session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=POOL_SIZE,
+                pool_maxsize=POOL_SIZE,
+                max_retries=connection_retry(),
+            )
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+            _session_pid = os.getpid()
+        return _session
+
+
+def _report_quota(token: str, response: requests.Response) -> None:
+    headers = response.headers
+    api = _RESOURCES.get(headers.get("X-RateLimit-Resource", "core"))
+    if api is None or "X-RateLimit-Remaining" not in headers:
+        return
+    report_quota(
+        token,
+        api,
+        int(headers["X-RateLimit-Remaining"]),
+        int(headers["X-RateLimit-Limit"]),
+        datetime.fromtimestamp(int(headers["X-RateLimit-Reset"]), timezone.utc),
+    )
+
+
+def _retry_wait(
+    response: requests.Response, attempt: int, idempotent: bool
+) -> Optional[float]:
+    """
+    Seconds to wait before retrying a response, None if it should not be retried.
+    Rate limited requests were not processed, so they are always safe to retry.
+    """
+    headers = response.headers
+    if response.status_code in (403, 429):
+        if "Retry-After" in headers:
+            return float(headers["Retry-After"])
+        if headers.get("X-RateLimit-Remaining") == "0":
+            reset = int(headers.get("X-RateLimit-Reset", time.time()))
+            return max(reset - time.time(), 0) + 1
+        if "secondary rate limit" in response.text.lower():
+            return SECONDARY_RATE_LIMIT_WAIT * 2**attempt
+        return None
+    if response.status_code in (502, 503, 504) and idempotent:
+        return 2**attempt
+    return None
+
+
+def request(
+    method: str,
+    url: str,
+    token: Optional[str] = None,
+    max_retries: int = MAX_RETRIES,
+    max_wait: float = SECONDARY_RATE_LIMIT_WAIT,
+    track_quota: bool = True,
+    **kwargs,
+) -> requests.Response:
+    """
+    Send a request to GitHub through the shared session, waiting and retrying as
+      asked by Retry-After, exhausted rate limits, secondary rate limits and 5xx errors
+    :param url: a full URL, or a path under GITHUB_API_URL (starting with /)
+    :param token: GitHub token to authenticate with (optional)
+    :param max_retries: max number of retries
+    :param max_wait: longest wait in seconds before a retry, responses that ask for
+        longer waits are returned to the caller, so web requests never block for long
+    :param track_quota: report the quota in response headers to the token broker
+    :param kwargs: passed to requests.Session.request
+    :return: the last response
+    """
+    if url.startswith("/"):
+        url = GITHUB_API_URL + url
+    headers = dict(kwargs.pop("headers", {}))
+    if token is not None:
+        headers["Authorization"] = "token " + token
+    kwargs.setdefault("timeout", TIMEOUT)
+    # GraphQL queries are posted but have no side effects
+    idempotent = method in ("GET", "HEAD") or url.endswith("/graphql")
+
+    attempt = 0
+    while True:
+        response = get_session().request(method, url, headers=headers, **kwargs)
+        if token is not None and track_quota:
+            _report_quota(token, response)
+        wait = _retry_wait(response, attempt, idempotent)
+        if wait is None or attempt >= max_retries or wait > max_wait:
+            return response
+        attempt += 1
+        logger.info(
+            "HTTP %d from %s %s (token %s), retry %d/%d in %.0f seconds",
+            response.status_code,
+            method,
+            url,
+            _mask_token(token) if token is not None else None,
+            attempt,
+            max_retries,
+            wait,
+        )
+        time.sleep(wait)
+
+
+def get(url: str, token: Optional[str] = None, **kwargs) -> requests.Response:
+    return request("GET", url, token, **kwargs)
+
+
+def post(url: str, token: Optional[str] = None, **kwargs) -> requests.Response:
+    return request("POST", url, token, **kwargs)
@@ -0,0 +1,125 @@
+import time
+import logging
+
+from typing import List, Optional, Tuple
+from datetime import datetime, timezone
+
+from gfibot.collections import TokenQuota
+
+
+logger = logging.getLogger(__name__)
+
+# assumed quota of a token that has never been reported, so unused tokens are tried first
+DEFAULT_LIMIT = 5000
+
+
+def _mask_token(token: str) -> str:
+    return "*" * (len(token) - 5) + token[-5:]
+
+
+def _utc(date: datetime) -> datetime:
+    if date.tzinfo is None:
+        return date.replace(tzinfo=timezone.utc)
+    return date.astimezone(timezone.utc)
+
+
+def report_quota(
+    token: str,
+    api: str,
+    remaining: int,
+    limit: Optional[int],
+    reset_at: datetime,
+) -> None:
+    """
+    Record the quota of a token as seen in the latest GitHub response.
+    Quota reports are best effort and never interrupt the caller.
+    :param token: GitHub token
+    :param api: rest or graphql
+    :param remaining: requests remaining in the current window
+    :param limit: requests allowed in a window (keep the known limit if None)
+    :param reset_at: when the current window resets
+    """
+    try:
+        if limit is None:
+            quota = TokenQuota.objects(token=token, api=api).only("limit").first()
+            limit = quota.limit if quota is not None else DEFAULT_LIMIT
+        TokenQuota.objects(token=token, api=api).update_one(
+            upsert=True,
+            set__remaining=remaining,
+            set__limit=limit,
+            set__reset_at=_utc(reset_at),
+            set__updated_at=datetime.now(timezone.utc),
+        )
+    except Exception as ex:
+        logger.warning(
+            "Failed to report quota of %s: %s: %s", _mask_token(token), type(ex), ex
+        )
+
+
+class TokenBroker(object):
+    """
+    Hands out the token with the most remaining quota.
+    Quotas are kept in MongoDB, so brokers in different processes see the same state.
+    """
+
+    def __init__(self, tokens: List[str]):
+        """
+        :param tokens: GitHub tokens to choose from
+        """
+        if len(tokens) == 0:
+            raise ValueError("No tokens available")
+        self.tokens = list(tokens)
+
+    def headroom(self, api: str = "rest") -> List[Tuple[str, int, Optional[datetime]]]:
+        """
+        :param api: rest or graphql
+        :return: (token, usable quota, reset time) of each token, expired windows
+            count as fully refilled
+        """
+        now = datetime.now(timezone.utc)
+        quotas = {
+            q.token: q for q in TokenQuota.objects(token__in=self.tokens, api=api)
+        }
+        result = []
+        for token in self.tokens:
+            quota = quotas.get(token)
+            if quota is None:
+                result.append((token, DEFAULT_LIMIT, None))
+            elif _utc(quota.reset_at) <= now:
+                result.append((token, quota.limit, None))
+            else:
+                result.append((token, quota.remaining, _utc(quota.reset_at)))
+        return result
+
+    def acquire(self, api: str = "rest", min_remaining: int = 1, cost: int = 1) -> str:
+        """
+        Get the token with the most headroom, waiting for the earliest reset
+          if no token has at least min_remaining requests left.
+        :param api: rest or graphql
+        :param min_remaining: minimum remaining quota for a token to be usable
+        :param cost: quota reserved for the caller until its next report,
+            which keeps concurrent callers from piling onto the same token
+        :return: GitHub token
+        """
+        while True:
+            headroom = self.headroom(api)
+            token, remaining, reset_at = max(headroom, key=lambda h: h[1])
+            if remaining >= min_remaining:
+                if reset_at is not None and cost > 0:
+                    TokenQuota.objects(token=token, api=api).update_one(
+                        dec__remaining=cost
+                    )
+                logger.debug(
+                    "Acquired %s token %s (%d left)", api, _mask_token(token), remaining
+                )
+                return token
+            reset_at = min(
+                (h[2] for h in headroom if h[2] is not None),
+                default=datetime.now(timezone.utc),
+            )
+            sleep_time = (reset_at - datetime.now(timezone.utc)).total_seconds() + 10
+            sleep_time = max(1.0, sleep_time)
+            logger.info(
+                "All %s tokens exhausted, wait for %.0f seconds...", api, sleep_time
+            )
+            time.sleep(sleep_time)
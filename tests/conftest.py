@@ -72,18 +72,26 @@ def mock_mongodb():
     collections = [
         Repo,
         RepoIssue,
+        RepoPullDetail,
         RepoCommit,
         RepoStar,
         OpenIssue,
         ResolvedIssue,
         Dataset,
         User,
+        UserContribution,
         GfiUsers,
         GithubTokens,
         GfiQueries,
         GfiEmail,
         TrainingSummary,
         Prediction,
+        HttpCache,
+        GitEmailLogin,
+        TokenQuota,
+        TokenStatus,
+        GitHubFetchCheckpoint,
+        UserRefreshRequest,
     ]
     for cls in collections:
         cls.drop_collection()
@@ -300,31 +308,26 @@ def mock_mongodb():
             _updated_at=datetime.utcnow(),
             name="a1",
             login="a1",
-            issues=[
-                User.Issue(
-                    owner="owner",
-                    name="name",
-                    repo_stars=1,
-                    state="closed",
-                    number=1,
-                    created_at=datetime(2022, 1, 1, tzinfo=timezone.utc),
-                )
-            ],
-            pulls=[],
-            pull_reviews=[],
-            commit_contributions=[],
         ),
         User(
             _created_at=datetime.utcnow(),
             _updated_at=datetime.utcnow(),
             name="a2",
             login="a2",
-            issues=[],
-            pulls=[],
-            pull_reviews=[],
-            commit_contributions=[],
         ),
     ]
+    user_contributions = [
+        UserContribution(
+            login="a1",
+            kind="issue",
+            owner="owner",
+            name="name",
+            repo_stars=1,
+            state="closed",
+            number=1,
+            created_at=datetime(2022, 1, 1, tzinfo=timezone.utc),
+        )
+    ]
     datasets = [
         Dataset(
             owner="owner",
@@ -594,6 +597,8 @@ def mock_mongodb():
         get_dataset(open_issue, open_issue.updated_at)
     for user in users:
         user.save()
+    for user_contribution in user_contributions:
+        user_contribution.save()
     for dataset in datasets:
         dataset.save()
     for github_token in github_tokens:
@@ -0,0 +1,161 @@
+import gzip
+import json
+
+from datetime import datetime, timezone
+from gfibot.collections import *
+from gfibot.data.gharchive import import_archives, list_archive_files
+
+
+def test_import_archives(mock_mongodb, tmp_path):
+    def event(type, payload, t, repo="O/N", actor="a"):
+        return {
+            "type": type,
+            "actor": {"login": actor},
+            "repo": {"id": 1, "name": repo, "url": ""},
+            "payload": payload,
+            "created_at": t,
+        }
+
+    def issue(number, state, t, **kwargs):
+        return {
+            "number": number,
+            "user": {"login": "a"},
+            "state": state,
+            "created_at": "2022-01-01T09:00:00Z",
+            "closed_at": t if state == "closed" else None,
+            "updated_at": t,
+            "title": "t",
+            "body": "b",
+            "labels": [],
+            **kwargs,
+        }
+
+    t9, t10 = "2022-01-01T09:30:00Z", "2022-01-01T10:30:00Z"
+    hour9 = [
+        event("WatchEvent", {"action": "started"}, t9, actor="u1"),
+        event("WatchEvent", {"action": "started"}, t9, repo="x/y", actor="u2"),
+        event(
+            "IssuesEvent",
+            {"action": "labeled", "issue": issue(1, "open", t9)}
+            | {"label": {"name": "good first issue"}},
+            t9,
+        ),
+        event("IssuesEvent", {"action": "opened", "issue": issue(2, "open", t9)}, t9),
+        event(
+            "PushEvent",
+            {
+                "ref": "refs/heads/main",
+                "commits": [
+                    {
+                        "sha": "s1",
+                        "author": {"email": "1+b@users.noreply.github.com"},
+                        "message": "fix #2",
+                        "distinct": True,
+                    },
+                    {
+                        "sha": "s0",
+                        "author": {"email": "a@example.com"},
+                        "message": "exact",
+                        "distinct": True,
+                    },
+                ],
+            },
+            t9,
+        ),
+    ]
+    hour10 = [
+        event(
+            "IssueCommentEvent",
+            {
+                "action": "created",
+                "issue": issue(1, "open", t10),
+                "comment": {"user": {"login": "c"}, "body": "hi", "created_at": t10},
+            },
+            t10,
+        ),
+        event(
+            "IssuesEvent", {"action": "closed", "issue": issue(2, "closed", t10)}, t10
+        ),
+        event(
+            "PullRequestEvent",
+            {
+                "action": "closed",
+                "pull_request": issue(3, "closed", t10, merged_at=t10),
+            },
+            t10,
+        ),
+    ]
+    with open(tmp_path / "2022-01-01-9.json", "w") as f:
+        f.write("\n".join(json.dumps(e) for e in hour9))
+    with gzip.open(tmp_path / "2022-01-01-10.json.gz", "wt") as f:
+        f.write("\n".join(json.dumps(e) for e in hour10))
+    (tmp_path / "README").write_text("not an archive")
+    assert [f.split("/")[-1] for f in list_archive_files([str(tmp_path)])] == [
+        "2022-01-01-9.json",
+        "2022-01-01-10.json.gz",
+    ]
+
+    exact = datetime(2021, 12, 31, tzinfo=timezone.utc)
+    RepoCommit(
+        owner="o",
+        name="n",
+        sha="s0",
+        author="a",
+        authored_at=exact,
+        committer="a",
+        committed_at=exact,
+        message="exact",
+    ).save()
+
+    end = import_archives([str(tmp_path)], [("o", "n"), ("owner", "name")], n_workers=2)
+    assert end == datetime(2022, 1, 1, 11, tzinfo=timezone.utc)
+    # the next update of o/n resumes after the fetch phases, covering the archives,
+    #   while the fixture repo is already updated past them
+    checkpoint = GitHubFetchCheckpoint.objects(owner="o", name="n").first()
+    assert checkpoint.since == datetime(2022, 1, 1, 9, tzinfo=timezone.utc)
+    assert checkpoint.watermark == end
+    assert checkpoint.completed == ["stars", "commits", "issues"]
+    assert GitHubFetchCheckpoint.objects(owner="owner", name="name").count() == 0
+    assert Repo.objects(owner="o", name="n").count() == 0
+    assert [s.user for s in RepoStar.objects(owner="o", name="n")] == ["u1"]
+    # the fixture repository has issues with the same numbers
+    issues = RepoIssue.objects(owner="o", name="n")
+    assert issues.filter(number=2).first().state == "closed"
+    assert issues.filter(number=3).first().is_pull
+    assert issues.filter(number=3).first().merged_at is not None
+    commit = RepoCommit.objects(sha="s1").first()
+    assert commit.author == "b" and commit.committer == "a"
+    assert commit.referenced_issues == [2]
+    assert RepoCommit.objects(sha="s0").count() == 1
+    assert RepoCommit.objects(sha="s0").first().committed_at == exact
+
+    # only issues that are still open get their archived timeline
+    assert OpenIssue.objects(owner="o", name="n").count() == 1
+    events = OpenIssue.objects(owner="o", name="n", number=1).first().events
+    assert [e.type for e in events] == ["labeled", "commented"]
+    assert events[0].label == "good first issue" and events[1].commenter == "c"
+
+    # an unfinished update is left to resume from its own checkpoint
+    import_archives([str(tmp_path)], [("o", "n")], n_workers=1)
+    assert GitHubFetchCheckpoint.objects(owner="o", name="n").count() == 1
+    checkpoint.delete()
+
+    # archives that begin after the last update leave a gap, so o/n is skipped
+    (tmp_path / "2022-01-01-9.json").unlink()
+    Repo(
+        created_at=datetime(2022, 1, 1, tzinfo=timezone.utc),
+        updated_at=datetime(2022, 1, 1, tzinfo=timezone.utc),
+        repo_created_at=datetime(2021, 1, 1, tzinfo=timezone.utc),
+        owner="o",
+        name="n",
+    ).save()
+    import_archives([str(tmp_path)], [("o", "n")], n_workers=1)
+    assert GitHubFetchCheckpoint.objects(owner="o", name="n").count() == 0
+
+    Repo.objects(owner="o", name="n").update_one(
+        set__updated_at=datetime(2022, 1, 1, 10, 30, tzinfo=timezone.utc)
+    )
+    import_archives([str(tmp_path)], [("o", "n")], n_workers=1)
+    checkpoint = GitHubFetchCheckpoint.objects(owner="o", name="n").first()
+    assert checkpoint.since == datetime(2022, 1, 1, 10, 30, tzinfo=timezone.utc)
+    assert checkpoint.watermark == end
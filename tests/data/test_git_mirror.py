@@ -0,0 +1,58 @@
+import os
+import subprocess
+
+from datetime import datetime, timezone
+from gfibot.collections import *
+from gfibot.data.git_mirror import GitMirror
+
+
+def test_git_mirror(mock_mongodb, tmp_path):
+    upstream = str(tmp_path / "upstream")
+    subprocess.run(["git", "init", "-q", "-b", "main", upstream], check=True)
+
+    def commit(message: str, author_email: str, committer_email: str, date: str):
+        env = {
+            **os.environ,
+            "GIT_AUTHOR_NAME": "a",
+            "GIT_AUTHOR_EMAIL": author_email,
+            "GIT_AUTHOR_DATE": date,
+            "GIT_COMMITTER_NAME": "c",
+            "GIT_COMMITTER_EMAIL": committer_email,
+            "GIT_COMMITTER_DATE": date,
+        }
+        subprocess.run(
+            ["git", "-C", upstream, "commit", "-q", "--allow-empty", "-m", message],
+            check=True,
+            env=env,
+        )
+
+    GitEmailLogin(
+        email="a@example.com", login="alice", resolved_at=datetime.now(timezone.utc)
+    ).save()
+    commit("old", "a@example.com", "a@example.com", "2019-01-01T00:00:00+00:00")
+    commit(
+        "fix #1\n\nbody",
+        "123+bob@users.noreply.github.com",
+        "noreply@github.com",
+        "2021-01-01T08:00:00+08:00",
+    )
+
+    mirror = GitMirror(
+        "o", "n", root=str(tmp_path / "mirrors"), url="file://" + upstream
+    )
+    mirror.sync()
+    since = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    pages = list(mirror.iter_commits(since))
+    assert [p for p, _ in pages] == [0] and len(pages[0][1]) == 1
+    c = pages[0][1][0]
+    assert c["author"] == "bob" and c["committer"] == "web-flow"
+    assert c["message"] == "fix #1\n\nbody"
+    assert c["committed_at"] == datetime(2021, 1, 1, tzinfo=timezone.utc)
+    RepoCommit(**c).validate()
+
+    # new commits are fetched incrementally, unseen emails stay unresolved
+    commit("new", "x@example.com", "a@example.com", "2022-01-01T00:00:00+00:00")
+    mirror.sync()
+    commits = [c for _, page in mirror.iter_commits(since) for c in page]
+    assert [c["message"] for c in commits] == ["new", "fix #1\n\nbody"]
+    assert commits[0]["author"] is None and commits[0]["committer"] == "alice"
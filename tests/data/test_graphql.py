@@ -3,6 +3,8 @@ from gfibot.data.graphql import *
 from pprint import pprint
 from datetime import datetime, timedelta, timezone
 from gfibot import TOKENS
+from graphql import DocumentNode, GraphQLError
+from gql.transport.exceptions import TransportServerError
 
 
 def _pprint_node(node: GraphQLQueryComponent, indent=0):
@@ -167,3 +169,304 @@ def test_user_fetcher():
         },
     )
     uf.fetch()
+
+
+def test_issue_timeline_query():
+    from graphql import parse
+
+    tf = IssueTimelineFetcher.__new__(IssueTimelineFetcher)
+    tf.owner, tf.name, tf.per_page, tf.rate_consumed = "owner", "name", 100, 0
+    results = {1: [], 2: []}
+    q = tf._build_query([1, 2], results)
+    parse(q.gen_query(False))
+    assert "issue1: issue(number: 1)" in q.gen_query(False)
+
+    def page(has_next, nodes):
+        return {
+            "timelineItems": {
+                "nodes": nodes,
+                "pageInfo": {"hasNextPage": has_next, "endCursor": "abc"},
+            }
+        }
+
+    mock_r = {
+        "rateLimit": {"cost": 1, "limit": 5000, "remaining": 4999, "resetAt": ""},
+        "repository": {
+            "issue1": page(
+                False,
+                [
+                    {
+                        "__typename": "IssueComment",
+                        "createdAt": "2022-01-01T00:00:00Z",
+                        "author": {"login": "a"},
+                        "body": "hello",
+                    },
+                    {
+                        "__typename": "LabeledEvent",
+                        "createdAt": "2022-01-02T00:00:00Z",
+                        "actor": {"login": "b"},
+                        "label": {"name": "bug"},
+                    },
+                ],
+            ),
+            "issue2": page(
+                True,
+                [
+                    {
+                        "__typename": "CrossReferencedEvent",
+                        "createdAt": "2022-01-01T00:00:00Z",
+                        "actor": None,
+                        "source": {"number": 3},
+                    },
+                    {"__typename": "AddedToProjectEvent"},
+                ],
+            ),
+        },
+    }
+    q.update_state(mock_r)
+    assert tf.rate_consumed == 1
+    assert results[1][0]["type"] == "commented"
+    assert results[1][0]["commenter"] == "a" and results[1][0]["comment"] == "hello"
+    assert results[1][1]["type"] == "labeled" and results[1][1]["label"] == "bug"
+    assert results[2][0]["type"] == "cross-referenced"
+    assert results[2][0]["source"] == 3 and results[2][0]["actor"] is None
+    # items without a fragment are dropped instead of becoming empty events
+    assert len(results[2]) == 1
+
+    # only the unfinished issue is queried again, from where it stopped
+    s = q.gen_query(False)
+    parse(s)
+    assert "issue1:" not in s and 'after: "abc"' in s
+
+
+def test_multi_user_fetcher():
+    from graphql import parse
+
+    def user_res(login, has_next_issues):
+        contributions = {"nodes": [], "pageInfo": {"hasNextPage": False}}
+        return {
+            "login": login,
+            "name": login,
+            "issues": {
+                "totalCount": 1,
+                "nodes": [{"number": 1}],
+                "pageInfo": {"hasNextPage": has_next_issues, "endCursor": "c"},
+            },
+            "contributionsCollection": {
+                "startedAt": "2022-01-01T00:00:00Z",
+                "endedAt": "2099-01-01T00:00:00Z",
+                "commitContributionsByRepository": [],
+                "pullRequestReviewContributions": contributions,
+                "pullRequestContributions": contributions,
+            },
+        }
+
+    rate_limit = {"cost": 1, "remaining": 4999, "resetAt": "2022-04-28T11:08:39Z"}
+    responses = [
+        {
+            "rateLimit": rate_limit,
+            "user0": user_res("a", False),
+            "user1": user_res("b", True),
+        },
+        {"rateLimit": rate_limit, "user1": {"issues": user_res("b", False)["issues"]}},
+    ]
+
+    class FakeClient(object):
+        def __init__(self):
+            self.queries = []
+            self.page_size = AdaptivePageSize()
+
+        def get_one(self, query):
+            query = query() if callable(query) else query
+            parse(query)
+            self.queries.append(query)
+            return responses[len(self.queries) - 1]
+
+    issues = {"a": [], "b": []}
+    muf = MultiUserFetcher.__new__(MultiUserFetcher)
+    muf.gh_gql = FakeClient()
+    muf.batch_size = 10
+    muf._callbacks = {}
+    muf._logger = logging.getLogger(__name__)
+    muf._fetchers = [
+        UserFetcher(
+            None,
+            login,
+            datetime(2022, 1, 1),
+            {"issues": lambda res, login=login: issues[login].extend(res["nodes"])},
+            gh_gql=muf.gh_gql,
+        )
+        for login in ["a", "b"]
+    ]
+    assert muf.fetch() == []
+    assert len(muf.gh_gql.queries) == 2
+    assert 'user0: user(login: "a")' in muf.gh_gql.queries[0]
+    assert "user0:" not in muf.gh_gql.queries[1]
+    assert 'after: "c"' in muf.gh_gql.queries[1]
+    assert len(issues["a"]) == 1 and len(issues["b"]) == 2
+
+
+def test_user_fetcher_windows():
+    import re
+    import time
+    import random
+    from graphql import parse
+
+    class FakeClient(object):
+        def __init__(self):
+            self.queries = []
+            self.page_size = AdaptivePageSize()
+
+        def get_one(self, query):
+            query = query() if callable(query) else query
+            parse(query)
+            self.queries.append(query)
+            time.sleep(random.random() * 0.01)
+            started = re.search(r'contributionsCollection\(from: "([^"]+)"', query)[1]
+            ended = re.search(r'contributionsCollection\([^)]*to: "([^"]+)"', query)
+            user = {
+                "login": "a",
+                "name": "a",
+                "contributionsCollection": {
+                    "startedAt": started,
+                    "endedAt": ended[1] if ended else "2099-01-01T00:00:00Z",
+                    "commitContributionsByRepository": [],
+                    "pullRequestReviewContributions": {
+                        "nodes": [],
+                        "pageInfo": {"hasNextPage": False},
+                    },
+                    "pullRequestContributions": {
+                        "nodes": [{"startedAt": started}],
+                        "pageInfo": {"hasNextPage": False},
+                    },
+                },
+            }
+            if "issues(" in query:
+                user["issues"] = {
+                    "totalCount": 0,
+                    "nodes": [],
+                    "pageInfo": {"hasNextPage": False},
+                }
+            return {"rateLimit": {"cost": 1}, "user": user}
+
+    windows, issues = [], []
+    uf = UserFetcher(
+        None,
+        "a",
+        datetime(2010, 1, 1),
+        {
+            "issues": issues.append,
+            "pullRequestContributions": lambda res: windows.append(
+                res["nodes"][0]["startedAt"]
+            ),
+        },
+        gh_gql=FakeClient(),
+        until=datetime(2015, 1, 1),
+        window_workers=4,
+    )
+    uf.fetch()
+    # one query per window, results are merged in order and issues are fetched once
+    assert len(uf.gh_gql.queries) == 6 and len(issues) == 1
+    assert windows == sorted(windows) and windows[0] == "2010-01-01T00:00:00Z"
+    assert len(set(windows)) == 6
+
+
+def test_issue_timeline_cursors():
+    from graphql import parse
+
+    def timeline(nodes, cursor):
+        return {
+            "timelineItems": {
+                "nodes": nodes,
+                "pageInfo": {"hasNextPage": False, "endCursor": cursor},
+            }
+        }
+
+    closed = {"__typename": "ClosedEvent", "createdAt": "2022-01-01T00:00:00Z"}
+    rate_limit = {"cost": 1, "remaining": 4999, "resetAt": "2022-04-28T11:08:39Z"}
+
+    class FakeClient(object):
+        def __init__(self):
+            self.queries = []
+
+        def get_one(self, query, partial=False):
+            parse(query)
+            self.queries.append(query)
+            if "issue3:" in query:
+                # a deleted issue is null in partial results
+                assert partial
+                return {"rateLimit": rate_limit, "repository": {"issue3": None}}
+            return {
+                "rateLimit": rate_limit,
+                "repository": {
+                    "issue1": timeline([closed], "new"),
+                    "issue2": timeline([], None),
+                },
+            }
+
+    tf = IssueTimelineFetcher.__new__(IssueTimelineFetcher)
+    tf.owner, tf.name, tf.per_page, tf.batch_size = "owner", "name", 100, 50
+    tf.rate_consumed, tf._logger = 0, logging.getLogger(__name__)
+    tf.gh_gql = FakeClient()
+
+    cursors = {1: "old1", 2: "old2"}
+    results = tf.fetch([1, 2], cursors)
+    assert 'after: "old1"' in tf.gh_gql.queries[0]
+    assert len(results[1]) == 1 and results[2] == []
+    # issues without new items keep their cursor
+    assert cursors == {1: "new", 2: "old2"}
+
+    # only the failed issue is left to REST, the rest of its batch is queried again
+    tf.gh_gql.queries = []
+    results = tf.fetch([1, 2, 3])
+    assert sorted(results) == [1, 2] and len(results[1]) == 1
+    assert len(tf.gh_gql.queries) == 2 and "issue3:" not in tf.gh_gql.queries[1]
+    assert tf.rate_consumed == 3
+
+
+def test_query_validation(tmp_path):
+    schema_path = tmp_path / "schema.graphql"
+    schema_path.write_text("type Query { viewer: User }\ntype User { login: String }")
+    schema = GitHubGraphQLClient._get_graphql_schema(str(schema_path))
+    assert GitHubGraphQLClient._get_graphql_schema(str(schema_path)) is schema
+
+    query = "query { viewer { login } }"
+    assert isinstance(GitHubGraphQLClient._parse_query(query, schema), DocumentNode)
+    try:
+        GitHubGraphQLClient._parse_query("query { viewer { name } }", schema)
+        assert False
+    except GraphQLError:
+        pass
+    # validation can be skipped for generated queries
+    GitHubGraphQLClient._parse_query("query { viewer { name } }", None)
+
+    assert get_client("token-a") is get_client("token-a")
+    assert get_client("token-a") is not get_client("token-b")
+
+
+def test_adaptive_page_size():
+    client = GitHubGraphQLClient("token", retry_interval=0, validate_queries=False)
+    sizes, responses = [], [TransportServerError("timeout", 502), {"a": 1}]
+
+    class FakeSession:
+        def execute(self, document, variable_values=None):
+            res = responses.pop(0)
+            if isinstance(res, Exception):
+                raise res
+            return {"rateLimit": {"cost": 1}, **res}
+
+    def gen_query():
+        sizes.append(client.page_size.size)
+        return "query { a }"
+
+    client._session = FakeSession()
+    # a timed out query is retried with smaller pages, cheap queries grow them back
+    assert client.get_one(gen_query)["a"] == 1
+    assert sizes == [100, 50]
+    assert client.page_size.size > 50
+    assert client.page_size.history[-1][:2] == (50, 1)
+
+    # server errors are retried a limited number of times
+    responses.extend([TransportServerError("timeout", 502)] * 3)
+    assert client.get_one("query { a }") is None
+    assert len(responses) == 0
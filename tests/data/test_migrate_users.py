@@ -0,0 +1,39 @@
+import gfibot.data.dataset as d
+
+from datetime import datetime, timezone
+from gfibot.collections import *
+from gfibot.data.migrate_users import migrate_user_contributions
+
+
+def test_migrate_user_contributions(mock_mongodb):
+    created_at = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    repo = {"owner": "o", "name": "n", "repo_stars": 10}
+    User._get_collection().insert_one(
+        {
+            "login": "old",
+            "_created_at": created_at,
+            "_updated_at": created_at,
+            "issues": [
+                {**repo, "state": "OPEN", "number": 1, "created_at": created_at}
+            ],
+            "pulls": [
+                {**repo, "state": "MERGED", "number": 2, "created_at": created_at}
+            ],
+            "pull_reviews": [],
+            "commit_contributions": [
+                {**repo, "commit_count": 3, "created_at": created_at}
+            ],
+        }
+    )
+
+    assert migrate_user_contributions() == 1
+    assert migrate_user_contributions() == 0
+    assert UserContribution.objects(login="old").count() == 3
+    assert "issues" not in User._get_collection().find_one({"login": "old"})
+
+    feat = d._get_user_data("o", "n", "old", datetime.now(timezone.utc))
+    assert feat.n_commits_all == 3 and feat.n_issues_all == 1
+    assert feat.n_pulls_all == 1 and feat.n_reviews_all == 0
+    assert feat.max_stars_pull == 10 and feat.n_repos == 1
+    feat = d._get_user_data("o", "n", "old", datetime(2020, 1, 1, tzinfo=timezone.utc))
+    assert feat.n_issues_all == 0 and feat.n_repos == 0
@@ -0,0 +1,79 @@
+import json
+import requests
+
+from gfibot.data.replay import *
+
+
+def test_request_key():
+    assert request_key("GET", "/repos/o/n?page=2&per_page=100") == request_key(
+        "GET", "https://api.github.com/repos/o/n?per_page=100&page=2"
+    )
+    assert request_key(
+        "GET", "/repos/o/n/commits?since=2022-01-01T00%3A00%3A00Z"
+    ) == request_key("GET", "/repos/o/n/commits?since=2022-05-01T12%3A00%3A00Z")
+    q1 = json.dumps({"query": 'user { c(from: "2022-01-01T00:00:00Z") }'})
+    q2 = json.dumps({"query": 'user { c(from: "2022-02-01T00:00:00Z") }'})
+    q3 = json.dumps({"query": 'user { d(from: "2022-02-01T00:00:00Z") }'})
+    assert request_key("POST", "/graphql", q1) == request_key("POST", "/graphql", q2)
+    assert request_key("POST", "/graphql", q1) != request_key("POST", "/graphql", q3)
+
+
+def test_replay_server(tmp_path):
+    entries = [
+        {
+            "key": request_key("GET", "/repos/o/n"),
+            "status": 200,
+            "headers": {"content-type": "application/json", "etag": '"abc"'},
+            "body": json.dumps({"url": "{base_url}/repos/o/n", "stars": 1}),
+        },
+        {
+            "key": request_key("GET", "/repos/o/n"),
+            "status": 200,
+            "headers": {"content-type": "application/json"},
+            "body": json.dumps({"url": "{base_url}/repos/o/n", "stars": 2}),
+        },
+    ]
+    entries.insert(1, dict(entries[0]))  # unchanged when fetched the second time
+    with open(tmp_path / RESPONSES_FILE, "w") as f:
+        f.write("\n".join(json.dumps(e) for e in entries))
+
+    with ReplayServer(str(tmp_path), rate_limit=5) as server:
+        headers = {"Authorization": "token a"}
+        r = requests.get(server.url + "/repos/o/n", headers=headers)
+        assert r.json() == {"url": server.url + "/repos/o/n", "stars": 1}
+        assert r.headers["X-RateLimit-Remaining"] == "4"
+        r = requests.get(
+            server.url + "/repos/o/n", headers={**headers, "If-None-Match": '"abc"'}
+        )
+        assert r.status_code == 304  # conditional requests are honored
+        # responses of the same request are replayed in order, repeating the last
+        assert (
+            requests.get(server.url + "/repos/o/n", headers=headers).json()["stars"]
+            == 2
+        )
+        assert (
+            requests.get(server.url + "/repos/o/n", headers=headers).json()["stars"]
+            == 2
+        )
+        assert requests.get(server.url + "/missing", headers=headers).status_code == 404
+        assert (
+            requests.get(server.url + "/repos/o/n", headers=headers).status_code == 403
+        )
+        # quota is tracked per token
+        r = requests.get(
+            server.url + "/repos/o/n", headers={"Authorization": "token b"}
+        )
+        assert r.status_code == 200
+        assert server.requests["core"] == 7 and len(server.missing) == 1
+
+        # record responses from the replay server itself
+        with Recorder(str(tmp_path / "recorded"), api_url=server.url) as recorder:
+            requests.get(
+                server.url + "/repos/o/n", headers={"Authorization": "token c"}
+            )
+        assert recorder.recorded == 1
+    with open(tmp_path / "recorded" / RESPONSES_FILE) as f:
+        recorded = json.loads(f.readline())
+    assert recorded["key"] == entries[0]["key"]
+    assert json.loads(recorded["body"])["url"] == "{base_url}/repos/o/n"
+    assert "x-ratelimit-limit" not in recorded["headers"]
@@ -59,3 +59,89 @@ def test_repo_fetcher(mock_mongodb):
     issue = fetcher.get_issue_detail(32)
     pprint(issue)
     assert isinstance(issue["events"], list)
+
+
+def test_get_pages_in_order():
+    import time
+    import random
+
+    class FakeList(object):
+        def get_page(self, p):
+            time.sleep(random.random() * 0.01)
+            return [p]
+
+    fetcher = rest.RepoFetcher.__new__(rest.RepoFetcher)
+    fetcher.n_workers = 4
+    fetcher._get_worker_repo = lambda: (None, None)
+    pages = fetcher._get_pages(lambda repo: FakeList(), range(0, 20))
+    assert [page[0] for page in pages] == list(range(0, 20))
+
+    # stopping early should not hang or fetch everything
+    pages = fetcher._get_pages(lambda repo: FakeList(), reversed(range(0, 100)))
+    assert next(pages) == [99]
+    pages.close()
+
+
+def test_request_json_cache(mock_mongodb):
+    class FakeRequester(object):
+        def __init__(self):
+            self.requests = []
+
+        def requestJsonAndCheck(self, verb, url, parameters=None, headers=None):
+            self.requests.append(headers)
+            if headers.get("If-None-Match") == '"v1"':
+                return {}, None  # 304 Not Modified
+            return {"etag": '"v1"'}, {"Python": 100}
+
+    class FakeRepo(object):
+        _requester = FakeRequester()
+
+    fetcher = rest.RepoFetcher.__new__(rest.RepoFetcher)
+    fetcher.use_cache = True
+    fetcher.repo = FakeRepo()
+
+    assert fetcher._request_json("/repos/o/n/languages") == {"Python": 100}
+    assert "If-None-Match" not in fetcher.repo._requester.requests[0]
+    assert fetcher._request_json("/repos/o/n/languages") == {"Python": 100}
+    assert fetcher.repo._requester.requests[1]["If-None-Match"] == '"v1"'
+    assert HttpCache.objects(url="/repos/o/n/languages").count() == 1
+
+
+def test_raw_pages():
+    link = '<https://api.github.com/x?per_page=100&page=2>; rel="next", <https://api.github.com/x?per_page=100&page=7>; rel="last"'
+    assert rest.get_last_page(link) == 7
+    assert rest.get_last_page('<https://api.github.com/x?page=1>; rel="prev"') is None
+
+    issue = {
+        "number": 1,
+        "user": {"login": "a"},
+        "state": "closed",
+        "created_at": "2022-01-01T00:00:00Z",
+        "closed_at": "2022-01-02T00:00:00Z",
+        "updated_at": "2022-01-02T00:00:00Z",
+        "title": "t",
+        "body": None,
+        "labels": [{"name": "good first issue"}],
+        "pull_request": {"merged_at": "2022-01-02T00:00:00Z"},
+    }
+    requested = []
+
+    def request_page(path, params, page, headers=None):
+        requested.append(page)
+        return [dict(issue, number=page)], 3
+
+    fetcher = rest.RepoFetcher.__new__(rest.RepoFetcher)
+    fetcher.raw, fetcher.n_workers, fetcher.gh = True, 2, None
+    fetcher.owner, fetcher.name = "o", "n"
+    fetcher.rate_remaining, fetcher.rate_limit, fetcher.rate_consumed = 0, 0, 0
+    fetcher._request_page = request_page
+    fetcher._update_rate_stats = lambda: None
+
+    pages = list(fetcher.iter_issues(datetime(2022, 1, 1, tzinfo=timezone.utc), 1))
+    assert [p for p, _ in pages] == [1, 2]
+    assert sorted(requested) == [1, 2]  # the probed page is not fetched again
+    page = pages[0][1]
+    assert page[0]["number"] == 1 and page[0]["is_pull"]
+    assert page[0]["labels"] == ["good first issue"]
+    assert page[0]["merged_at"] == datetime(2022, 1, 2, tzinfo=timezone.utc)
+    RepoIssue(**page[0]).validate()
@@ -2,9 +2,10 @@ import gfibot
 import gfibot.data.update as upd
 import gfibot.data.rest as rest
 import logging
+import subprocess
 
 from pprint import pprint
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from gfibot.collections import *
 
 
@@ -25,6 +26,36 @@ def test_match_issue_numbers():
     assert upd._match_issue_numbers("Resolve #2 resolves #1 resolved #3") == [2, 1, 3]
 
 
+def test_prefetch():
+    assert list(upd._prefetch(iter(range(100)), depth=2)) == list(range(100))
+
+    def failing():
+        yield 1
+        raise RuntimeError("fetch failed")
+
+    it = upd._prefetch(failing())
+    assert next(it) == 1
+    try:
+        next(it)
+        assert False
+    except RuntimeError as ex:
+        assert str(ex) == "fetch failed"
+
+    closed = []
+
+    def pages():
+        try:
+            for i in range(100):
+                yield i
+        finally:
+            closed.append(True)
+
+    it = upd._prefetch(pages(), depth=1)
+    assert next(it) == 0
+    it.close()
+    assert closed == [True]
+
+
 def test_locate_resolved_issues(mock_mongodb):
     # Sadly, this test requires interaction with GitHub API,
     #     so mocking data is not entirely possible
@@ -109,3 +140,351 @@ def test_update_user(mock_mongodb):
     token = gfibot.TOKENS[0] if len(gfibot.TOKENS) > 0 else None
     upd.update_user(token, "xmcp")
     assert User.objects(login="xmcp").first().login == "xmcp"
+
+
+def test_bulk_upsert(mock_mongodb):
+    # a repository without fixture data, so counts are exact
+    stars = [
+        {
+            "owner": "o",
+            "name": "n",
+            "user": f"user{i}",
+            "starred_at": datetime(2022, 1, 1, tzinfo=timezone.utc),
+        }
+        for i in range(0, 5)
+    ]
+    assert upd._bulk_upsert(RepoStar, ["owner", "name", "user"], stars) == (5, 0)
+    assert RepoStar.objects(owner="o", name="n").count() == 5
+
+    stars[0]["starred_at"] = datetime(2022, 2, 1, tzinfo=timezone.utc)
+    stars.append(dict(stars[1]))  # duplicated keys are written once
+    assert upd._bulk_upsert(RepoStar, ["owner", "name", "user"], stars) == (0, 1)
+    assert RepoStar.objects(owner="o", name="n").count() == 5
+    star = RepoStar.objects(owner="o", name="n", user="user0").first()
+    assert star.starred_at.month == 2
+
+
+def test_locate_resolved_issues_offline(mock_mongodb):
+    # issue numbers of the fixture repository would collide with the ones below
+    owner, name = "o", "n"
+
+    class FakeFetcher:
+        def __init__(self):
+            self.owner, self.name, self.rate = owner, name, (0, 0, 0)
+
+        def get_pull_detail(self, number: int):
+            return {"commits": ["c3"], "comments": ["Fixes #2"]}
+
+    def day(d: int) -> datetime:
+        return datetime(2022, 1, d, tzinfo=timezone.utc)
+
+    for num, is_pull, closed_at in [(1, False, 5), (2, False, 10), (3, True, 10)]:
+        RepoIssue(
+            owner=owner,
+            name=name,
+            number=num,
+            user="a1",
+            state="closed",
+            created_at=day(1),
+            closed_at=day(closed_at),
+            title="",
+            body="",
+            labels=[],
+            is_pull=is_pull,
+            merged_at=day(closed_at) if is_pull else None,
+        ).save()
+    for sha, author, d, msg in [
+        ("c1", "a1", 2, "init"),
+        ("c2", "a1", 3, "fix #1"),
+        ("c3", "a1", 4, "wip"),
+        ("c4", "a2", 4, "docs"),
+    ]:
+        RepoCommit(
+            owner=owner,
+            name=name,
+            sha=sha,
+            author=author,
+            authored_at=day(d),
+            committer=author,
+            committed_at=day(d),
+            message=msg,
+        ).save()
+
+    resolved = upd._locate_resolved_issues(FakeFetcher(), day(1))
+    resolved = {r["number"]: r for r in resolved}
+    # referenced issues are backfilled for commits stored without them
+    commit = RepoCommit.objects(owner=owner, name=name, sha="c2").first()
+    assert commit.referenced_issues == [1]
+    assert upd._backfill_referenced_issues(owner, name) == 0
+    assert resolved[1]["resolved_in"] == "c2"
+    assert resolved[1]["resolver_commit_num"] == 1
+    # c3 belongs to the PR, so only c1 and c2 count as prior commits
+    assert resolved[2]["resolved_in"] == 3
+    assert resolved[2]["resolver_commit_num"] == 2
+
+
+def test_update_commits_mirror_fallback(mock_mongodb, tmp_path):
+    class FakeFetcher:
+        owner, name, token, rate = "o", "n", None, (0, 0, 0)
+
+        def iter_commits(self, since, start_page=0):
+            yield 0, [
+                {
+                    "owner": "o",
+                    "name": "n",
+                    "sha": "c1",
+                    "author": "a1",
+                    "authored_at": since,
+                    "committer": "a1",
+                    "committed_at": since,
+                    "message": "fix #1",
+                }
+            ]
+
+    # an empty mirror syncs, but git log fails once its pages are read
+    subprocess.run(
+        ["git", "init", "-q", "--bare", str(tmp_path / "o" / "n.git")], check=True
+    )
+    root, sync = upd.git_mirror.GIT_MIRROR_ROOT, upd.git_mirror.GitMirror.sync
+    upd.git_mirror.GIT_MIRROR_ROOT = str(tmp_path)
+    upd.git_mirror.GitMirror.sync = lambda self: None
+    try:
+        since = datetime(2022, 1, 1, tzinfo=timezone.utc)
+        commits = upd._update_commits(FakeFetcher(), since)
+    finally:
+        upd.git_mirror.GIT_MIRROR_ROOT, upd.git_mirror.GitMirror.sync = root, sync
+    assert [c["sha"] for c in commits] == ["c1"]
+    assert RepoCommit.objects(owner="o", name="n").first().referenced_issues == [1]
+
+
+def test_get_pull_detail_cache(mock_mongodb):
+    class FakeFetcher:
+        owner, name, calls = "owner", "name", 0
+
+        def get_pull_detail(self, number: int):
+            self.calls += 1
+            return {"commits": ["c1"], "comments": [f"Fixes #{self.calls}"]}
+
+    fetcher = FakeFetcher()
+    pr = RepoIssue(
+        owner="owner",
+        name="name",
+        number=3,
+        user="a1",
+        state="closed",
+        created_at=datetime(2022, 1, 1, tzinfo=timezone.utc),
+        closed_at=datetime(2022, 1, 2, tzinfo=timezone.utc),
+        updated_at=datetime(2022, 1, 2, tzinfo=timezone.utc),
+        title="",
+        labels=[],
+        is_pull=True,
+    )
+    assert upd._get_pull_detail(fetcher, pr)["comments"] == ["Fixes #1"]
+    assert upd._get_pull_detail(fetcher, pr)["comments"] == ["Fixes #1"]
+    assert fetcher.calls == 1
+
+    pr.updated_at = datetime(2022, 1, 3, tzinfo=timezone.utc)
+    assert upd._get_pull_detail(fetcher, pr)["comments"] == ["Fixes #2"]
+    assert fetcher.calls == 2
+
+
+def test_fetch_issue_events_cost(mock_mongodb):
+    class FakeTimelineFetcher:
+        def __init__(self, token, owner, name):
+            self.rate_consumed = 0
+
+        def fetch(self, numbers, cursors=None):
+            self.rate_consumed = 7
+            return {1: [{"type": "closed"}]}
+
+    class FakeFetcher:
+        token, owner, name, rate, rate_consumed = "t", "o", "n", (0, 0, 0), 3
+
+        def get_issue_detail(self, number: int):
+            return {"events": [{"type": "labeled"}]}
+
+    log = GitHubFetchLog(owner="o", name="n", rate_graphql=0)
+    timeline_fetcher = upd.IssueTimelineFetcher
+    upd.IssueTimelineFetcher = FakeTimelineFetcher
+    try:
+        fetcher = FakeFetcher()
+        events = upd._fetch_issue_events(fetcher, [1, 2], log=log)
+    finally:
+        upd.IssueTimelineFetcher = timeline_fetcher
+    assert events == {1: [{"type": "closed"}], 2: [{"type": "labeled"}]}
+    # GraphQL cost is kept apart from the REST requests of the fetcher
+    assert log.rate_graphql == 7 and fetcher.rate_consumed == 3
+
+
+def test_update_repo_stats(mock_mongodb):
+    # a repository without fixture data, so all of its statistics are known
+    owner, name = "o", "n"
+    for num, (created, closed, is_pull) in enumerate(
+        [
+            (datetime(2022, 1, 1), datetime(2022, 1, 2), False),
+            (datetime(2022, 1, 5), datetime(2022, 1, 8), False),
+            (datetime(2022, 3, 1), datetime(2022, 3, 11), False),
+            (datetime(2022, 3, 2), None, False),
+            (datetime(2022, 3, 3), datetime(2022, 3, 4), True),
+        ]
+    ):
+        RepoIssue(
+            owner=owner,
+            name=name,
+            number=num,
+            user="a1",
+            state="open" if closed is None else "closed",
+            created_at=created.replace(tzinfo=timezone.utc),
+            closed_at=closed.replace(tzinfo=timezone.utc) if closed else None,
+            title="",
+            labels=[],
+            is_pull=is_pull,
+        ).save()
+    for i, month in enumerate([1, 1, 2]):
+        RepoStar(
+            owner=owner,
+            name=name,
+            user=f"u{i}",
+            starred_at=datetime(2022, month, 1, tzinfo=timezone.utc),
+        ).save()
+
+    closed = RepoIssue.objects(owner=owner, name=name, state="closed", is_pull=False)
+    assert upd._aggregate_median_close_time(closed) == 3 * 24 * 3600
+    assert upd._aggregate_median_close_time(closed.filter(number=0)) == 24 * 3600
+    assert upd._aggregate_median_close_time(closed.filter(number=-1)) is None
+    stars = upd._aggregate_by_month(
+        RepoStar.objects(owner=owner, name=name), "starred_at"
+    )
+    assert [(c.month, c.count) for c in stars] == [
+        (datetime(2022, 1, 1, tzinfo=timezone.utc), 2),
+        (datetime(2022, 2, 1, tzinfo=timezone.utc), 1),
+    ]
+
+    repo = Repo(owner=owner, name=name)
+    upd._update_repo_stats(repo)
+    assert repo.median_issue_close_time == 3 * 24 * 3600
+    assert [(c.month.month, c.count) for c in repo.monthly_stars] == [(1, 2), (2, 1)]
+    assert [(c.month.month, c.count) for c in repo.monthly_issues] == [(1, 2), (3, 2)]
+    assert [(c.month.month, c.count) for c in repo.monthly_pulls] == [(3, 1)]
+    assert repo.monthly_commits == []
+
+    # even number of closed issues, the median is the mean of the middle two
+    RepoIssue.objects(owner=owner, name=name, number=2).delete()
+    upd._update_repo_stats(repo)
+    assert repo.median_issue_close_time == 2 * 24 * 3600
+
+
+def test_update_stars_checkpoint(mock_mongodb):
+    # a repository without fixture stars, so stored stars can be counted
+    def star(i: int):
+        return {
+            "owner": "o",
+            "name": "n",
+            "user": f"user{i}",
+            "starred_at": datetime(2022, 1, i + 1, tzinfo=timezone.utc),
+        }
+
+    class FakeFetcher:
+        rate, fail = (0, 0, 0), True
+
+        def iter_stars(self, since, start_page=None):
+            self.start_page = start_page
+            for p in reversed(range(0, 3 if start_page is None else start_page + 1)):
+                if p == 1 and self.fail:
+                    raise RuntimeError("token exhausted")
+                yield p, [star(p * 2), star(p * 2 + 1)]
+
+    checkpoint = GitHubFetchCheckpoint(
+        owner="o",
+        name="n",
+        since=datetime(2022, 1, 1, tzinfo=timezone.utc),
+        watermark=datetime(2022, 2, 1, tzinfo=timezone.utc),
+        updated_at=datetime(2022, 2, 1, tzinfo=timezone.utc),
+    )
+    checkpoint.save()
+    fetcher = FakeFetcher()
+    try:
+        upd._update_stars(fetcher, checkpoint.since, None, checkpoint)
+    except RuntimeError:
+        pass
+    checkpoint = GitHubFetchCheckpoint.objects(owner="o", name="n").first()
+    assert checkpoint.stars_page == 1
+    assert RepoStar.objects(owner="o", name="n").count() == 2
+
+    fetcher.fail = False
+    stars = upd._update_stars(fetcher, checkpoint.since, None, checkpoint)
+    assert fetcher.start_page == 1 and len(stars) == 4
+    assert RepoStar.objects(owner="o", name="n").count() == 6
+
+
+def test_user_refresh_queue(mock_mongodb):
+    now = datetime.utcnow()
+    User(login="fresh", _created_at=now, _updated_at=now).save()
+    User(
+        login="stale",
+        _created_at=now - timedelta(days=30),
+        _updated_at=now - timedelta(days=30),
+    ).save()
+
+    assert upd.enqueue_users(["fresh", "stale", "new"]) == 2
+    assert upd.enqueue_users(["stale", "other"]) == 2
+    assert sorted(UserRefreshRequest.objects().scalar("login")) == [
+        "new",
+        "other",
+        "stale",
+    ]
+
+    claim, logins = upd._claim_users(limit=2)
+    assert len(logins) == 2
+    _, others = upd._claim_users(limit=2)
+    assert len(others) == 1 and not set(logins) & set(others)
+    UserRefreshRequest.objects().update(set__claim=None, set__claimed_at=None)
+
+    upd.enqueue_users([f"user{i}" for i in range(57)])
+    fetched, tokens = [], set()
+
+    def fake_update_users(token, logins):
+        fetched.extend(logins)
+        tokens.add(token)
+        return len(logins)
+
+    update_users = upd.update_users
+    upd.update_users = fake_update_users
+    try:
+        # a repository only drains its own users
+        assert upd.drain_user_queue(["token1"], ["user0", "user1", "x"]) == (2, 2)
+        assert sorted(fetched) == ["user0", "user1"]
+        # rate limit costs of all workers are summed up
+        assert upd.drain_user_queue(["token1", "token2"]) == (58, 58)
+    finally:
+        upd.update_users = update_users
+    assert len(fetched) == len(set(fetched)) == 60
+    assert tokens <= {"token1", "token2"}
+    assert UserRefreshRequest.objects().count() == 0
+
+
+def test_save_user_contributions(mock_mongodb):
+    repo = {"nameWithOwner": "o/n", "stargazerCount": 1}
+    issues = {
+        "nodes": [
+            {"number": 1, "state": "OPEN", "repository": repo, "createdAt": day}
+            for day in ["2022-01-01T00:00:00Z", "2022-01-02T00:00:00Z"]
+        ]
+    }
+    commits = [
+        {
+            "repository": repo,
+            "contributions": {
+                "nodes": [{"commitCount": 2, "occurredAt": "2022-01-01T00:00:00Z"}]
+            },
+        }
+    ]
+    for _ in range(2):  # refetched contributions are not duplicated
+        user, _ = upd._prepare_user("u")
+        contributions = []
+        callbacks = upd._user_callbacks(user, contributions)
+        callbacks["issues"](issues)
+        callbacks["commitContributionsByRepository"](commits)
+        upd._save_user(user, contributions)
+    assert UserContribution.objects(login="u", kind="issue").count() == 1
+    assert UserContribution.objects(login="u", kind="commit").first().commit_count == 2
@@ -0,0 +1,44 @@
+import gfibot.check_tokens as ct
+
+from datetime import datetime, timedelta, timezone
+
+from gfibot.collections import *
+
+
+def test_token_registry(mock_mongodb):
+    reset_at = datetime.now(timezone.utc) + timedelta(minutes=30)
+    probed = []
+
+    def fake_probe_token(token):
+        probed.append(token)
+        if token == "token-bad":
+            return False, []
+        return True, [("rest", 100, 5000, reset_at), ("graphql", 50, 5000, reset_at)]
+
+    probe_token = ct._probe_token
+    ct._probe_token = fake_probe_token
+    try:
+        tokens = ["token-a", "token-bad", "token-b"]
+        assert ct.get_cached_valid_tokens(tokens) == ["token-a", "token-b"]
+        assert sorted(probed) == sorted(tokens)
+        assert (
+            TokenQuota.objects(token="token-a", api="graphql").first().remaining == 50
+        )
+
+        # later lookups are served from the registry
+        probed.clear()
+        assert ct.get_cached_valid_tokens(tokens) == ["token-a", "token-b"]
+        assert probed == []
+
+        # only tokens without a recent check are probed
+        TokenStatus.objects(token="token-b").update_one(
+            set__checked_at=datetime.now(timezone.utc) - 3 * ct.TOKEN_CHECK_INTERVAL
+        )
+        ct.mark_token_invalid("token-a")
+        assert ct.get_cached_valid_tokens(tokens + ["token-c"]) == [
+            "token-b",
+            "token-c",
+        ]
+        assert sorted(probed) == ["token-b", "token-c"]
+    finally:
+        ct._probe_token = probe_token
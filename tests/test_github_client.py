@@ -0,0 +1,62 @@
+import json
+import threading
+
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import gfibot.github_client as github_client
+
+from gfibot.collections import *
+
+
+def test_github_client(mock_mongodb):
+    responses, paths = [], []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            paths.append((self.path, self.headers["Authorization"]))
+            status, headers, body = responses.pop(0)
+            body = json.dumps(body).encode()
+            self.send_response(status)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_url = github_client.GITHUB_API_URL
+    github_client.GITHUB_API_URL = "http://127.0.0.1:%d" % server.server_port
+    reset = int(datetime.now(timezone.utc).timestamp()) + 600
+    quota = {
+        "X-RateLimit-Limit": "5000",
+        "X-RateLimit-Remaining": "42",
+        "X-RateLimit-Reset": str(reset),
+        "X-RateLimit-Resource": "core",
+    }
+    try:
+        # secondary rate limits are retried as asked by Retry-After
+        responses.append((403, {"Retry-After": "0"}, {"message": "secondary"}))
+        responses.append((200, quota, {"ok": True}))
+        r = github_client.get("/repos/a/b", "token-a")
+        assert r.status_code == 200 and r.json() == {"ok": True}
+        assert paths == [("/repos/a/b", "token token-a")] * 2
+        assert TokenQuota.objects(token="token-a", api="rest").first().remaining == 42
+
+        # waits longer than max_wait are left to the caller
+        responses.append((429, {"Retry-After": "3600"}, {}))
+        assert github_client.get("/repos/a/b", max_wait=1).status_code == 429
+
+        # other client errors are not retried
+        responses.append((404, {}, {}))
+        assert github_client.get("/repos/a/c").status_code == 404
+        assert len(responses) == 0 and len(paths) == 4
+    finally:
+        github_client.GITHUB_API_URL = api_url
+        server.shutdown()
@@ -0,0 +1,28 @@
+from datetime import datetime, timedelta, timezone
+
+from gfibot.collections import *
+from gfibot.token_broker import TokenBroker, report_quota
+
+
+def test_token_broker(mock_mongodb):
+    now = datetime.now(timezone.utc)
+    broker = TokenBroker(["token-a", "token-b", "token-c"])
+
+    report_quota("token-a", "rest", 10, 5000, now + timedelta(minutes=30))
+    report_quota("token-b", "rest", 3000, 5000, now + timedelta(minutes=30))
+    # tokens never reported are assumed to have full quota
+    assert broker.acquire("rest") == "token-c"
+
+    report_quota("token-c", "rest", 0, 5000, now + timedelta(minutes=30))
+    assert broker.acquire("rest", cost=100) == "token-b"
+    quota = TokenQuota.objects(token="token-b", api="rest").first()
+    assert quota.remaining == 2900
+
+    # an expired window counts as fully refilled
+    report_quota("token-a", "rest", 10, 5000, now - timedelta(minutes=1))
+    assert broker.acquire("rest") == "token-a"
+
+    # rest and graphql quotas are tracked separately
+    report_quota("token-a", "graphql", 0, None, now + timedelta(minutes=30))
+    assert TokenQuota.objects(token="token-a", api="graphql").first().limit == 5000
+    assert broker.acquire("graphql") != "token-a"